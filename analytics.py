@@ -0,0 +1,347 @@
+import os
+import sys
+import json
+import collections
+import numpy as np
+import pandas as pd
+
+
+class RollingMean:
+    """
+    Rolling mean of every key (e.g. the cell count of every species) over the last 'window' time points,
+    updated as the time points are recorded. A key missing from a time point counts as zero there, as in the
+    wide CSV files once their NaNs are filled. Only the time points with a full window have a mean.
+    """
+
+    def __init__(self, window=7):
+        """
+        Parameters:
+            window (int): Number of time points averaged.
+        """
+        self.window = window
+        self._recent = collections.deque()  # values of the last 'window' time points
+        self._sums = dict()  # sum of every key over them
+        self.means = []  # (time point, mean of every key seen so far)
+
+    def update(self, t, data):
+        self._recent.append(dict(data))
+        for key, value in data.items():
+            self._sums[key] = self._sums.get(key, 0) + value
+        if len(self._recent) > self.window:
+            for key, value in self._recent.popleft().items():
+                self._sums[key] -= value
+        if len(self._recent) == self.window:
+            self.means.append((t, {key: value / self.window for key, value in self._sums.items()}))
+
+    def get_state(self):
+        # The stored dictionaries are never modified, so copying the containers is enough
+        return {"window": self.window, "recent": list(self._recent), "sums": dict(self._sums),
+                "means": list(self.means)}
+
+    def set_state(self, state):
+        self.window = state["window"]
+        self._recent = collections.deque(state["recent"])
+        self._sums = dict(state["sums"])
+        self.means = list(state["means"])
+
+    def to_frame(self):
+        """
+        Returns:
+            pd.DataFrame: One row per key (sorted), one column per time point with a full window.
+        """
+        columns = {str(t): means for t, means in self.means}
+        return pd.DataFrame(columns).fillna(0).sort_index()
+
+
+class GrowthStats:
+    """
+    Growth rates of every species between consecutive time points, as the change of log(cell count + 1) per
+    hour, summarised as they are recorded: the mean growth rate of every species in each month, and the running
+    covariance of the growth rates of the species (Welford's algorithm). A species missing from a time point
+    has no cells there.
+    """
+
+    def __init__(self, points_per_month=31):
+        """
+        Parameters:
+            points_per_month (int): Number of time points in a month (31 daily points by default).
+        """
+        self.points_per_month = points_per_month
+        self.points = 0  # time points recorded
+        self._last_t = None
+        self._last_logs = dict()  # log(cell count + 1) of every species seen, at the last time point
+        self._month_steps = []  # number of growth rates in each month
+        self._month_sums = []  # sum of the growth rates of every species in each month
+        self.keys = []  # species in the order of the covariance matrix
+        self._index = dict()
+        self._steps = 0  # growth rates in the covariance
+        self._mean = np.zeros(0)
+        self._comoment = np.zeros((0, 0))  # sum of the products of the deviations from the mean
+
+    def update(self, t, microbiome):
+        month = self.points // self.points_per_month
+        self.points += 1
+        logs = {species: float(np.log(count + 1)) for species, count in microbiome.items()}
+        if self._last_t is None:
+            self._last_t = t
+            self._last_logs = logs
+            return
+
+        # Species seen before but gone are at log(0 + 1) = 0, new ones were there before too
+        rates = {species: (logs.get(species, 0.0) - self._last_logs.get(species, 0.0)) / (t - self._last_t)
+                 for species in self._last_logs.keys() | logs.keys()}
+        self._last_t = t
+        self._last_logs = {species: logs.get(species, 0.0) for species in rates}
+
+        while len(self._month_steps) <= month:
+            self._month_steps.append(0)
+            self._month_sums.append(dict())
+        self._month_steps[month] += 1
+        sums = self._month_sums[month]
+        for species, rate in rates.items():
+            sums[species] = sums.get(species, 0.0) + rate
+
+        # A species seen for the first time had a growth rate of zero at every earlier step, so its mean and
+        # co-moments so far are all zero
+        new_species = sorted(species for species in rates if species not in self._index)
+        if new_species:
+            for species in new_species:
+                self._index[species] = len(self.keys)
+                self.keys.append(species)
+            self._mean = np.pad(self._mean, (0, len(new_species)))
+            self._comoment = np.pad(self._comoment, (0, len(new_species)))
+        x = np.zeros(len(self.keys))
+        x[[self._index[species] for species in rates]] = list(rates.values())
+        self._steps += 1
+        delta = x - self._mean
+        self._mean += delta / self._steps
+        self._comoment += np.outer(delta, x - self._mean)
+
+    def get_state(self):
+        return {"points_per_month": self.points_per_month, "points": self.points, "last_t": self._last_t,
+                "last_logs": dict(self._last_logs), "month_steps": list(self._month_steps),
+                "month_sums": [dict(sums) for sums in self._month_sums], "keys": list(self.keys),
+                "steps": self._steps, "mean": self._mean.copy(), "comoment": self._comoment.copy()}
+
+    def set_state(self, state):
+        self.points_per_month = state["points_per_month"]
+        self.points = state["points"]
+        self._last_t = state["last_t"]
+        self._last_logs = dict(state["last_logs"])
+        self._month_steps = list(state["month_steps"])
+        self._month_sums = [dict(sums) for sums in state["month_sums"]]
+        self.keys = list(state["keys"])
+        self._index = {species: i for i, species in enumerate(self.keys)}
+        self._steps = state["steps"]
+        self._mean = state["mean"].copy()
+        self._comoment = state["comoment"].copy()
+
+    def monthly_frame(self):
+        """
+        Returns:
+            pd.DataFrame: Mean growth rate (per hour) of every species (rows, sorted) in every month with at
+                least one growth rate (columns, from 0).
+        """
+        species = sorted(self.keys)
+        columns = {month: [sums.get(s, 0.0) / steps for s in species]
+                   for month, (steps, sums) in enumerate(zip(self._month_steps, self._month_sums)) if steps}
+        return pd.DataFrame(columns, index=species)
+
+    def covariance_frame(self):
+        """
+        Returns:
+            pd.DataFrame: Sample covariance matrix of the growth rates of the species (NaN before two steps).
+        """
+        covariance = self._comoment / (self._steps - 1) if self._steps > 1 else np.full(self._comoment.shape, np.nan)
+        df = pd.DataFrame(covariance, index=self.keys, columns=self.keys)
+        return df.sort_index().sort_index(axis=1)
+
+
+class AmountStats:
+    """
+    Running count, mean, standard deviation, minimum and maximum of the amount of every metabolite over the
+    time points. Negative amounts are solver noise and count as zero, and a metabolite missing from a time
+    point has an amount of zero there, so the statistics are those of the rows of the wide CSV files once their
+    NaNs and negative values are set to zero.
+    """
+
+    def __init__(self):
+        self.points = 0  # time points recorded
+        self._stats = dict()  # (count, mean, sum of squared deviations, min, max) of the recorded amounts
+
+    def update(self, t, metabolome):
+        self.points += 1
+        for metabolite, amount in metabolome.items():
+            amount = max(float(amount), 0.0)
+            stats = self._stats.get(metabolite)
+            if stats is None:
+                self._stats[metabolite] = (1, amount, 0.0, amount, amount)
+                continue
+            count, mean, m2, low, high = stats
+            count += 1
+            delta = amount - mean
+            mean += delta / count
+            self._stats[metabolite] = (count, mean, m2 + delta * (amount - mean), min(low, amount), max(high, amount))
+
+    def get_state(self):
+        # The tuples are replaced rather than modified, so copying the dictionary is enough
+        return {"points": self.points, "stats": dict(self._stats)}
+
+    def set_state(self, state):
+        self.points = state["points"]
+        self._stats = dict(state["stats"])
+
+    def to_frame(self):
+        """
+        Returns:
+            pd.DataFrame: Count of time points, mean, standard deviation (of the population, as np.std), minimum
+                and maximum of the amount (in mmol) of every metabolite (rows, sorted).
+        """
+        rows = dict()
+        n = self.points
+        for metabolite, (count, mean, m2, low, high) in self._stats.items():
+            # Merge in the time points where the metabolite was missing, with an amount of zero
+            missing = n - count
+            m2 += mean ** 2 * count * missing / n
+            mean = mean * count / n
+            if missing:
+                low, high = min(low, 0.0), max(high, 0.0)
+            rows[metabolite] = {"count": n, "mean": mean, "std": np.sqrt(m2 / n), "min": low, "max": high}
+        return pd.DataFrame.from_dict(rows, orient="index", columns=["count", "mean", "std", "min", "max"]).sort_index()
+
+
+class CompartmentSummary:
+    """
+    Analytics of one compartment, updated every time its microbiome and metabolome are recorded, so that the
+    analysis does not have to reload the full time series: rolling means of the cell counts, monthly growth
+    rates and covariance of the growth rates of the species, and statistics of the metabolite amounts.
+    """
+
+    def __init__(self, window=7, points_per_month=31):
+        """
+        Parameters:
+            window (int): Number of time points in the rolling means of the cell counts.
+            points_per_month (int): Number of time points in a month of growth rates.
+        """
+        self.cell_counts = RollingMean(window)
+        self.growth = GrowthStats(points_per_month)
+        self.metabolites = AmountStats()
+
+    def update(self, t, microbiome, metabolome):
+        """
+        Adds the time point 't'.
+
+        Parameters:
+            t (int): Time point of data collection.
+            microbiome (dict): Cell count of every species.
+            metabolome (dict): Amount of every metabolite (in mmol).
+        """
+        self.cell_counts.update(t, microbiome)
+        self.growth.update(t, microbiome)
+        self.metabolites.update(t, metabolome)
+
+    def update_from_frames(self, microbiome, metabolome):
+        """
+        Adds every time point of the wide tables written by a StreamingRecorder, e.g. to summarise a run from
+        before the analytics were computed during the simulation.
+
+        Parameters:
+            microbiome (pd.DataFrame): Cell counts, one row per species and one column per time point.
+            metabolome (pd.DataFrame): Metabolite amounts, with the same columns.
+        """
+        for column in microbiome.columns:
+            self.update(int(column), microbiome[column].dropna().to_dict(), metabolome[column].dropna().to_dict())
+
+    def get_state(self):
+        """
+        Returns:
+            dict: State of the aggregators, sharing nothing that later updates modify.
+        """
+        return {"cell_counts": self.cell_counts.get_state(), "growth": self.growth.get_state(),
+                "metabolites": self.metabolites.get_state()}
+
+    def set_state(self, state):
+        self.cell_counts.set_state(state["cell_counts"])
+        self.growth.set_state(state["growth"])
+        self.metabolites.set_state(state["metabolites"])
+
+    def tables(self):
+        """
+        Returns:
+            dict: Rolling mean cell counts, monthly growth rates, covariance and correlation of the growth rates,
+                and metabolite statistics, as DataFrames.
+        """
+        covariance = self.growth.covariance_frame()
+        std = np.sqrt(np.diag(covariance.values))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            correlation = covariance / np.outer(std, std)
+        return {"rolling_cell_counts": self.cell_counts.to_frame(),
+                "monthly_growth_rates": self.growth.monthly_frame(),
+                "growth_covariance": covariance,
+                "growth_correlation": correlation,
+                "metabolite_stats": self.metabolites.to_frame()}
+
+
+def save_summary(path, summaries):
+    """
+    Writes the tables of compartment summaries to a JSON file.
+
+    Parameters:
+        path (str): Path of the JSON file.
+        summaries (dict): CompartmentSummary of each compartment, by name.
+    """
+    data = {name: {"window": summary.cell_counts.window,
+                   "points_per_month": summary.growth.points_per_month,
+                   "tables": {table: df.to_dict(orient="split") for table, df in summary.tables().items()}}
+            for name, summary in summaries.items()}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+
+
+def load_summary(path):
+    """
+    Reads a summary written by save_summary().
+
+    Parameters:
+        path (str): Path of the JSON file, e.g. "<run name>_summary.json" in the results folder of a run.
+
+    Returns:
+        dict: Tables (DataFrames, see CompartmentSummary.tables()) of each compartment, by name.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    summaries = dict()
+    for name, summary in data.items():
+        summaries[name] = {table: pd.DataFrame(**split) for table, split in summary["tables"].items()}
+        summaries[name]["monthly_growth_rates"].columns = summaries[name]["monthly_growth_rates"].columns.astype(int)
+    return summaries
+
+
+def summarise_results(results_dir, window=7, points_per_month=31):
+    """
+    Computes and writes the summary of a finished run from its CSV files.
+
+    Parameters:
+        results_dir (str): Results folder of the run, named after the run.
+        window (int): Number of time points in the rolling means of the cell counts.
+        points_per_month (int): Number of time points in a month of growth rates.
+
+    Returns:
+        str: Path of the summary file.
+    """
+    run_name = os.path.basename(os.path.normpath(results_dir))
+    summaries = dict()
+    for compartment in ("small_intestine", "large_intestine"):
+        frames = [pd.read_csv(os.path.join(results_dir, f"{run_name}_{compartment}_{quantity}.csv"), index_col=0)
+                  for quantity in ("microbiome", "metabolome")]
+        summaries[compartment] = CompartmentSummary(window, points_per_month)
+        summaries[compartment].update_from_frames(*frames)
+    path = os.path.join(results_dir, f"{run_name}_summary.json")
+    save_summary(path, summaries)
+    return path
+
+
+if __name__ == "__main__":
+    # Summarise the runs given as results folders, e.g. those simulated before the summaries were written
+    for results_dir in sys.argv[1:]:
+        print(f"Saved {summarise_results(results_dir)}")
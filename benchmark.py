@@ -0,0 +1,428 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import statistics
+import numpy as np
+import pandas as pd
+from cobra import Model, Reaction, Metabolite
+from cobra.io import write_sbml_model
+from compile_models import compile_model, reduced_models_variable
+from worker_pool import create_pool, start_daemons
+from recorder import StreamingRecorder
+from input_schedule import InputSchedule
+from solution_cache import SolutionCache
+from sample_diet import load_diet, gas_volume_stats
+from sample_phyla import load_representative_strains
+from utilities import SmallIntestine, LargeIntestine
+from simulate import simulate
+
+# Directory of the generated synthetic models, and file of the golden outputs
+benchmark_dir = "benchmark_models"
+golden_file = "benchmark_golden.json"
+
+diet_file = "keto_diet.csv"
+strains_file = "representative_strains.json"
+path_to_agora = "AGORA_1_03_sbml"
+
+
+def synthetic_model(model_id, exchange_ids, num_metabolites, num_reactions, seed):
+    """
+    Generates a random constraint-based model of a given size.
+
+    The model takes up its exchange metabolites into a chain of internal metabolites that ends in a biomass
+    reaction, and secretes some of them again. The remaining reactions are random conversions of one internal
+    metabolite into another (reversible or not), or irreversible condensations of two into one, so the model
+    cannot create mass and its growth is limited by the exchange bounds like that of an AGORA model.
+
+    Parameters:
+        model_id (str): ID of the model.
+        exchange_ids (list): IDs of the exchanged metabolites (e.g. "glc_D[e]").
+        num_metabolites (int): Number of internal metabolites (at least 3).
+        num_reactions (int): Approximate number of reactions.
+        seed (int): Seed of the random generator.
+
+    Returns:
+        cobra.Model: The model.
+    """
+    rng = np.random.default_rng(seed)
+    model = Model(model_id)
+    internal = [Metabolite(f"syn{i}[c]", name=f"Synthetic metabolite {i}", compartment="c")
+                for i in range(num_metabolites)]
+    external = [Metabolite(metabolite_id, name=metabolite_id, compartment="e") for metabolite_id in exchange_ids]
+
+    reactions = []
+    for j, metabolite in enumerate(external):
+        exchange = Reaction(f"EX_{metabolite.id[:-3]}(e)", lower_bound=-1000, upper_bound=1000)
+        exchange.add_metabolites({metabolite: -1})
+        uptake = Reaction(f"UPT{j}", lower_bound=0, upper_bound=1000)
+        uptake.add_metabolites({metabolite: -1, internal[int(rng.integers(max(1, num_metabolites // 4)))]: 1})
+        reactions += [exchange, uptake]
+        if rng.random() < 0.3:
+            secretion = Reaction(f"SEC{j}", lower_bound=0, upper_bound=1000)
+            secretion.add_metabolites({internal[int(rng.integers(num_metabolites))]: -1, metabolite: 1})
+            reactions.append(secretion)
+
+    for i in range(1, num_metabolites):
+        reaction = Reaction(f"CHN{i}", lower_bound=0, upper_bound=1000)
+        reaction.add_metabolites({internal[i - 1]: -1, internal[i]: 1})
+        reactions.append(reaction)
+
+    k = 0
+    while len(reactions) < num_reactions - 1:
+        a, b, c = rng.choice(num_metabolites, 3, replace=False).tolist()
+        if rng.random() < 0.5:
+            reaction = Reaction(f"RXN{k}", lower_bound=-1000 if rng.random() < 0.5 else 0, upper_bound=1000)
+            reaction.add_metabolites({internal[a]: -1, internal[b]: 1})
+        else:
+            reaction = Reaction(f"RXN{k}", lower_bound=0, upper_bound=1000)
+            reaction.add_metabolites({internal[a]: -1, internal[b]: -1, internal[c]: 1})
+        reactions.append(reaction)
+        k += 1
+
+    biomass = Reaction("biomass", lower_bound=0, upper_bound=1000)
+    biomass.add_metabolites({metabolite: -1 for metabolite in internal[-3:]})
+    reactions.append(biomass)
+
+    model.add_reactions(reactions)
+    model.compartments = {"c": "cytosol", "e": "extracellular"}
+    model.objective = "biomass"
+    return model
+
+
+def synthetic_model_file(name, num_exchanges, num_metabolites, num_reactions, seed, directory=benchmark_dir):
+    """
+    Writes (once) and compiles a synthetic model exchanging diet metabolites and gases.
+
+    Returns:
+        str: Absolute path of the SBML file. An absolute path can be used as the species name of an AGORA model.
+    """
+    path = os.path.abspath(os.path.join(directory, f"{name}.xml"))
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        rng = np.random.default_rng(seed)
+        candidates = list(load_diet(diet_file)[0]) + list(gas_volume_stats.keys())
+        exchange_ids = sorted(rng.choice(candidates, min(num_exchanges, len(candidates)), replace=False).tolist())
+        write_sbml_model(synthetic_model(name, exchange_ids, num_metabolites, num_reactions, seed), path)
+    compile_model(path)
+    return path
+
+
+def host_models():
+    return (synthetic_model_file("synthetic_small_intestine", 120, 400, 1500, 1),
+            synthetic_model_file("synthetic_large_intestine", 120, 400, 1500, 2))
+
+
+def synthetic_species(count, num_reactions):
+    return [synthetic_model_file(f"synthetic_species_{num_reactions}_{i}", 40, num_reactions // 4, num_reactions,
+                                 1000 + i) for i in range(count)]
+
+
+def synthetic_strain_library(count, num_reactions):
+    # Folder of synthetic species models outside the AGORA folder, for simulate() to sample its inoculum from
+    directory = os.path.join(benchmark_dir, "strain_library")
+    for i in range(count):
+        synthetic_model_file(f"synthetic_species_{num_reactions}_{i}", 40, num_reactions // 4, num_reactions, 1000 + i,
+                             directory)
+    return directory
+
+
+def agora_species(count):
+    return [strain + ".xml" for strain in load_representative_strains(strains_file)[0][:count]]
+
+
+def species_name(species):
+    return os.path.basename(species)
+
+
+# Cases. Each case function gets the worker pool and a seed, and returns a function that runs the timed code
+# once and returns its outputs (numbers, or dicts and lists of them).
+
+def metabolise_case(compartment_class, species_list):
+    def setup(pool, seed):
+        small_intestine_host, large_intestine_host = host_models()
+        model_path = small_intestine_host if compartment_class is SmallIntestine else large_intestine_host
+        compartment = compartment_class(pool=pool, rng=np.random.default_rng(seed), model_path=model_path)
+        metabolome, _ = next(InputSchedule(diet_file, strains_file, seed))
+        compartment.add_to_metabolome(metabolome)
+        counts = np.random.default_rng(seed).integers(10 ** 8, 10 ** 10, size=len(species_list))
+        compartment.add_to_microbiome(dict(zip(species_list, counts.tolist())))
+        initial_state = compartment.get_state()
+
+        def run():
+            compartment.set_state(initial_state)
+            growth_rates = compartment.metabolise()
+            return {"growth_rates": {species_name(species): rate for species, rate in growth_rates.items()},
+                    "host_growth_rate": compartment.growth_rate,
+                    "metabolome": compartment.metabolome}
+        return run
+    return setup
+
+
+def transfer_case(compartment_class, num_species):
+    def setup(pool, seed):
+        small_intestine_host, large_intestine_host = host_models()
+        rng = np.random.default_rng(seed)
+        microbiome = {f"species_{i}.xml": int(count) for i, count in
+                      enumerate(rng.integers(10 ** 8, 10 ** 10, size=num_species))}
+        growth_rates = {species: float(rate) for species, rate in zip(microbiome, rng.exponential(0.05, num_species))}
+        large_intestine = LargeIntestine(pool=pool, model_path=large_intestine_host)
+        small_intestine = SmallIntestine(pool=pool, model_path=small_intestine_host) \
+            if compartment_class is SmallIntestine else None
+
+        def run():
+            large_intestine.rng = np.random.default_rng(seed)
+            if small_intestine is not None:
+                small_intestine.rng = np.random.default_rng(seed)
+                small_intestine.microbiome = dict(microbiome)
+                large_intestine.microbiome = dict()
+                small_intestine.transfer(large_intestine, growth_rates)
+                return {"retained": small_intestine.microbiome, "transferred": large_intestine.microbiome}
+            large_intestine.microbiome = dict(microbiome)
+            large_intestine.transfer(growth_rates)
+            return {"retained": large_intestine.microbiome}
+        return run
+    return setup
+
+
+def recorder_case(num_keys, num_steps):
+    def setup(pool, seed):
+        values = np.random.default_rng(seed).random((num_steps, num_keys))
+        keys = [f"metabolite_{i}[e]" for i in range(num_keys)]
+
+        def run():
+            with tempfile.TemporaryDirectory() as directory:
+                recorder = StreamingRecorder(os.path.join(directory, "metabolome.csv"))
+                for t in range(num_steps):
+                    recorder.record(t, dict(zip(keys, values[t].tolist())))
+                recorder.finalise()
+                frame = recorder.to_frame()
+            return {"shape": list(frame.shape), "column_sums": frame.sum(axis=0).tolist()}
+        return run
+    return setup
+
+
+def simulate_case(days, library=None):
+    def setup(pool, seed):
+        hosts = host_models()
+        strain_library = library() if library is not None else strains_file
+
+        def run():
+            with tempfile.TemporaryDirectory() as directory:
+                simulate(24 * days, diet_file, seed=seed, pool=pool, run_name="benchmark", results_root=directory,
+                         verbose=False, checkpoint_every=None, solution_cache=SolutionCache(), host_models=hosts,
+                         strain_library=strain_library)
+                outputs = dict()
+                for file in sorted(os.listdir(os.path.join(directory, "benchmark"))):
+                    if file.endswith(".csv"):
+                        # Last time point of every output
+                        frame = pd.read_csv(os.path.join(directory, "benchmark", file), index_col=0)
+                        outputs[file[len("benchmark_"):-len(".csv")]] = frame.iloc[:, -1].dropna().to_dict()
+            return outputs
+        return run
+    return setup
+
+
+def benchmark_cases(quick=False):
+    """
+    Returns:
+        dict: Case function of every case, by name. Cases with the same name but a different worker count share
+            their golden outputs.
+    """
+    cases = dict()
+    agora_counts = [1, 9] if quick else [1, 3, 9]
+    for count in agora_counts:
+        cases[f"metabolise_small_intestine_agora_{count}"] = metabolise_case(SmallIntestine, agora_species(count))
+        cases[f"metabolise_large_intestine_agora_{count}"] = metabolise_case(LargeIntestine, agora_species(count))
+    for count, num_reactions in ([(4, 200)] if quick else [(4, 200), (16, 200), (4, 2000)]):
+        species_list = synthetic_species(count, num_reactions)
+        cases[f"metabolise_small_intestine_synthetic_{count}x{num_reactions}"] = metabolise_case(SmallIntestine,
+                                                                                                 species_list)
+        cases[f"metabolise_large_intestine_synthetic_{count}x{num_reactions}"] = metabolise_case(LargeIntestine,
+                                                                                                 species_list)
+    for num_species in ([10, 1000] if quick else [10, 100, 1000]):
+        cases[f"transfer_small_intestine_{num_species}"] = transfer_case(SmallIntestine, num_species)
+        cases[f"transfer_large_intestine_{num_species}"] = transfer_case(LargeIntestine, num_species)
+    for num_keys, num_steps in ([(300, 100)] if quick else [(300, 100), (300, 730)]):
+        cases[f"recorder_{num_keys}x{num_steps}"] = recorder_case(num_keys, num_steps)
+    cases["simulate_1_day"] = simulate_case(1)
+    # The species models are then loaded from the library, not from the AGORA folder
+    cases["simulate_1_day_strain_library"] = simulate_case(1, lambda: synthetic_strain_library(4, 200))
+    return cases
+
+
+def to_jsonable(value):
+    if isinstance(value, dict):
+        return {str(key): to_jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [to_jsonable(item) for item in value]
+    if isinstance(value, (np.integer, int)) and not isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (np.floating, float)):
+        return float(value)
+    return value
+
+
+def compare(expected, actual, rtol, atol, path=""):
+    """
+    Compares outputs with golden outputs. Numbers may differ by atol + rtol * |expected|, and a key missing on
+    one side counts as 0 (e.g. a metabolite pruned from one metabolome but not the other).
+
+    Returns:
+        tuple: Largest absolute difference, and a description of the first mismatch (None if there is none).
+    """
+    if isinstance(expected, dict) or isinstance(actual, dict):
+        if not (isinstance(expected, dict) and isinstance(actual, dict)):
+            return np.inf, f"{path}: expected {type(expected).__name__}, got {type(actual).__name__}"
+        largest, mismatch = 0.0, None
+        for key in sorted(set(expected) | set(actual)):
+            difference, key_mismatch = compare(expected.get(key, 0), actual.get(key, 0), rtol, atol, f"{path}/{key}")
+            largest = max(largest, difference)
+            mismatch = mismatch or key_mismatch
+        return largest, mismatch
+    if isinstance(expected, list) or isinstance(actual, list):
+        if not (isinstance(expected, list) and isinstance(actual, list)) or len(expected) != len(actual):
+            return np.inf, f"{path}: expected {expected!r}, got {actual!r}"
+        largest, mismatch = 0.0, None
+        for i, (expected_item, actual_item) in enumerate(zip(expected, actual)):
+            difference, item_mismatch = compare(expected_item, actual_item, rtol, atol, f"{path}/{i}")
+            largest = max(largest, difference)
+            mismatch = mismatch or item_mismatch
+        return largest, mismatch
+    if isinstance(expected, (int, float)) and isinstance(actual, (int, float)):
+        if np.isnan(expected) and np.isnan(actual):
+            return 0.0, None
+        difference = abs(actual - expected)
+        if not difference <= atol + rtol * abs(expected):
+            return difference, f"{path}: expected {expected!r}, got {actual!r}"
+        return difference, None
+    if expected != actual:
+        return np.inf, f"{path}: expected {expected!r}, got {actual!r}"
+    return 0.0, None
+
+
+def run_benchmarks(pattern=".*", workers=None, repeats=3, quick=False, update_golden=False, rtol=1e-6, atol=1e-9,
+                   seed=5240, backend="process"):
+    """
+    Runs the benchmark cases and checks their outputs against the golden outputs.
+
+    Every case is run once cold (right after its setup, e.g. with the species models not yet loaded by the
+    workers) and then 'repeats' times warm, from the same initial state. Every run must give the golden outputs,
+    whatever the worker count and the backend.
+
+    Parameters:
+        pattern (str): Regular expression selecting the cases to run, by name.
+        workers (list): Worker counts to run the cases with (default: 1 and the number of CPUs).
+        repeats (int): Number of warm runs of every case.
+        quick (bool): Whether to run the smaller set of cases.
+        update_golden (bool): Whether to store the outputs as the new golden outputs instead of checking them.
+        rtol (float): Relative tolerance of the check.
+        atol (float): Absolute tolerance of the check.
+        seed (int): Seed of the inputs of every case.
+        backend (str): Backend of the worker pool (see worker_pool.create_pool()). With the remote backend, one
+            worker daemon per worker is started on this machine.
+
+    Returns:
+        dict: Timings and check result of every case and worker count.
+    """
+    logging.getLogger("cobra").setLevel(logging.ERROR)
+    # The golden outputs are those of the full models; the workers started below inherit the setting
+    os.environ[reduced_models_variable] = "0"
+    workers = sorted(set(workers or [1, os.cpu_count()]))
+    golden = dict()
+    if os.path.exists(golden_file):
+        with open(golden_file, "r", encoding="utf-8") as f:
+            golden = json.load(f)
+
+    cases = {name: case for name, case in benchmark_cases(quick).items() if re.search(pattern, name)}
+    results = dict()
+    for num_workers in workers:
+        daemons, addresses, authkey = [], None, None
+        if backend == "remote":
+            authkey = os.urandom(16)
+            daemons, addresses = start_daemons(num_workers, authkey)
+        pool = create_pool(backend, num_workers, addresses=addresses, authkey=authkey)
+        try:
+            for name, case in cases.items():
+                run = case(pool, seed)
+
+                timings = []
+                outputs = []
+                for _ in range(repeats + 1):
+                    start = time.perf_counter()
+                    output = run()
+                    timings.append(time.perf_counter() - start)
+                    outputs.append(to_jsonable(output))
+
+                if update_golden and name not in golden:
+                    golden[name] = outputs[0]
+                largest, mismatch = 0.0, None if name in golden else "no golden outputs"
+                for output in outputs:
+                    if name in golden:
+                        difference, output_mismatch = compare(golden[name], output, rtol, atol)
+                        largest = max(largest, difference)
+                        mismatch = mismatch or output_mismatch
+
+                key = f"{name}[workers={num_workers}]"
+                results[key] = {"cold": timings[0], "warm": statistics.median(timings[1:]) if repeats else None,
+                                "max_difference": largest, "mismatch": mismatch}
+                warm = f"{results[key]['warm']:9.3f} s" if repeats else " " * 11
+                print(f"{key:70s} cold {timings[0]:9.3f} s  warm {warm}  "
+                      f"{'OK' if mismatch is None else 'FAILED: ' + mismatch}", flush=True)
+        finally:
+            pool.shutdown()
+            for daemon in daemons:
+                daemon.terminate()
+
+    if update_golden:
+        with open(golden_file, "w", encoding="utf-8") as f:
+            json.dump(golden, f, indent=1, sort_keys=True)
+    return results
+
+
+def compare_timings(results, baseline):
+    """
+    Prints the speed-up of every case over a baseline (results of an earlier run).
+    """
+    for key, result in results.items():
+        if key in baseline and result["warm"] and baseline[key]["warm"]:
+            print(f"{key:70s} {baseline[key]['warm'] / result['warm']:6.2f}x")
+
+
+if __name__ == "__main__":
+    from multiprocessing import freeze_support
+
+    freeze_support()  # Freeze support for multiprocessing
+
+    parser = argparse.ArgumentParser(description="Time the simulation hot paths and check their outputs.")
+    parser.add_argument("--cases", default=".*", help="regular expression selecting the cases to run")
+    parser.add_argument("--workers", type=int, nargs="+", default=None, help="worker counts to run the cases with")
+    parser.add_argument("--backend", choices=["serial", "thread", "process", "remote"], default="process",
+                        help="backend of the worker pool (remote starts local worker daemons)")
+    parser.add_argument("--repeats", type=int, default=3, help="number of warm runs of every case")
+    parser.add_argument("--quick", action="store_true", help="run a smaller set of cases")
+    parser.add_argument("--update-golden", action="store_true",
+                        help=f"store the outputs of cases missing from {golden_file} instead of checking them")
+    parser.add_argument("--rtol", type=float, default=1e-6, help="relative tolerance of the output check")
+    parser.add_argument("--atol", type=float, default=1e-9, help="absolute tolerance of the output check")
+    parser.add_argument("--output", default=None, help="JSON file to write the timings to")
+    parser.add_argument("--baseline", default=None, help="JSON file of earlier timings to compare with")
+    parser.add_argument("--clean", action="store_true", help=f"regenerate the synthetic models in {benchmark_dir}")
+    args = parser.parse_args()
+
+    if args.clean:
+        shutil.rmtree(benchmark_dir, ignore_errors=True)
+    results = run_benchmarks(args.cases, args.workers, args.repeats, args.quick, args.update_golden, args.rtol,
+                             args.atol, backend=args.backend)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            compare_timings(results, json.load(f))
+    sys.exit(0 if all(result["mismatch"] is None for result in results.values()) else 1)
@@ -0,0 +1,64 @@
+import os
+import pickle
+import threading
+
+
+class Checkpointer:
+    """
+    Writes simulation checkpoints in the background. The caller hands over a snapshot (plain dicts
+    and arrays that the simulation no longer mutates), which is pickled and written to a temporary
+    file by a worker thread and then renamed over the previous checkpoint. A crash during a write
+    therefore always leaves the last complete checkpoint in place, and the simulation only waits
+    if the previous write has not finished yet.
+    """
+
+    def __init__(self, path):
+        """
+        Parameters:
+            path (str): Path of the checkpoint file.
+        """
+        self.path = path
+        self.writes = 0
+        self._thread = None
+
+    def _write(self, snapshot):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.path)
+
+    def save(self, snapshot):
+        """
+        Starts writing a checkpoint.
+
+        Parameters:
+            snapshot (dict): State to write. It must not be modified afterwards.
+        """
+        self.wait()
+        self._thread = threading.Thread(target=self._write, args=(snapshot,), daemon=True)
+        self._thread.start()
+        self.writes += 1
+
+    def wait(self):
+        """
+        Waits for the checkpoint being written, if any, to be complete.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def load_checkpoint(path):
+    """
+    Reads a checkpoint written by a Checkpointer.
+
+    Parameters:
+        path (str): Path of the checkpoint file.
+
+    Returns:
+        dict: The saved snapshot.
+    """
+    with open(path, "rb") as f:
+        return pickle.load(f)
@@ -1,4 +1,19 @@
+import os
+import json
+import hashlib
+import logging
+import argparse
+import concurrent.futures
 from libsbml import readSBML, writeSBMLToFile
+from compile_models import file_hash, compiled_dir
+
+# Source hash of every cleaned file, so that a re-run only cleans new or changed models
+manifest_path = os.path.join(compiled_dir, "clean_manifest.json")
+
+# Host model whose IDs are too long for cobra, cleaned when no path is given
+large_intestine_source = "MODEL1310110043_url_large.xml"
+
+logger = logging.getLogger(__name__)
 
 
 def truncate_id(original_id, max_len=250):
@@ -10,10 +25,12 @@ def truncate_id(original_id, max_len=250):
     max_len (int): The maximum allowed length for the identifier. Default is 250 characters.
 
     Returns:
-    str: A truncated identifier, with a hash added to ensure uniqueness.
+    str: A truncated identifier, with a digest of the original added to ensure uniqueness. The digest
+    does not depend on the process, so an ID is always truncated the same way.
     """
-    # Truncate the ID to half of the max_len, then append a hash-based suffix
-    return original_id[:max_len // 2] + "_" + str(abs(hash(original_id)) % 10 ** 6)
+    # Truncate the ID to half of the max_len, then append a digest-based suffix
+    digest = hashlib.sha256(original_id.encode("utf-8")).hexdigest()
+    return original_id[:max_len // 2] + "_" + str(int(digest, 16) % 10 ** 6)
 
 
 def fix_long_ids(sbml_path, output_path, max_len=256):
@@ -26,6 +43,9 @@ def fix_long_ids(sbml_path, output_path, max_len=256):
     output_path (str): Path where the cleaned SBML file will be saved.
     max_len (int): The maximum allowed length for any identifier in the SBML model. Default is 256 characters.
 
+    Returns:
+    int: Number of IDs truncated.
+
     This function processes the following collections in the SBML model:
     - Reactions
     - Species
@@ -37,7 +57,10 @@ def fix_long_ids(sbml_path, output_path, max_len=256):
     # Read the SBML model from the input file
     doc = readSBML(sbml_path)
     model = doc.getModel()
+    if model is None:
+        raise ValueError(f"no model could be read ({doc.getNumErrors()} errors)")
 
+    truncated = 0
     # Process the key collections: reactions, species, parameters, and compartments
     for collection in [
         model.getListOfReactions(),
@@ -52,16 +75,113 @@ def fix_long_ids(sbml_path, output_path, max_len=256):
                 # Truncate the ID and create a new, unique identifier
                 new_id = truncate_id(obj.getId(), max_len)
 
-                # Print the truncation action for clarity
-                print(f"Truncating ID:\n   Old: {obj.getId()}\n   New: {new_id}")
+                # Log the truncation (there can be many in a model, so only at debug level)
+                logger.debug("Truncating ID %s to %s", obj.getId(), new_id)
 
                 # Set the new truncated ID and optionally update the name
                 obj.setId(new_id)
                 obj.setName(new_id)  # Optional: update the name too
+                truncated += 1
 
     # Write the cleaned SBML model to the output file
-    writeSBMLToFile(doc, output_path)
-    print(f"\nClean model saved to: {output_path}")
+    if not writeSBMLToFile(doc, output_path):
+        raise OSError(f"could not write {output_path}")
+    return truncated
+
+
+def _cleaned_file(sbml_path, output_path, max_len):
+    # Worker task: clean one file, and return the hash of its source and the number of IDs truncated, or None
+    # if it cannot be cleaned
+    try:
+        source_hash = file_hash(sbml_path)
+        return source_hash, fix_long_ids(sbml_path, output_path, max_len)
+    except Exception as e:
+        print(f"Skipping {sbml_path}: {e}")
+        return None
+
+
+def clean_files(jobs, max_len=256, max_workers=None):
+    """
+    Cleans several SBML files, in parallel. Files whose cleaned copy was written from a source with the same
+    hash (and the same maximum length) by an earlier run are not cleaned again.
+
+    Parameters:
+        jobs (list): (source path, output path) of each file.
+        max_len (int): The maximum allowed length for any identifier.
+        max_workers (int): Number of worker processes (default: number of CPUs).
+
+    Returns:
+        dict: Number of IDs truncated in each source file that was cleaned by this run.
+    """
+    manifest = dict()
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+
+    def unchanged(source, output):
+        entry = manifest.get(output)
+        return entry is not None and os.path.exists(output) and entry["source"] == source and \
+            entry["max_len"] == max_len and entry["hash"] == file_hash(source)
+
+    stale = [(source, output) for source, output in jobs if not unchanged(source, output)]
+    truncated = dict()
+    if stale:
+        print(f"Cleaning {len(stale)} models ({len(jobs) - len(stale)} unchanged)")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(_cleaned_file, [source for source, _ in stale], [output for _, output in stale],
+                                   [max_len] * len(stale), chunksize=8)
+            for (source, output), result in zip(stale, results):
+                if result is not None:
+                    manifest[output] = {"source": source, "hash": result[0], "max_len": max_len, "truncated": result[1]}
+                    truncated[source] = result[1]
+        os.makedirs(compiled_dir, exist_ok=True)
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+
+    return truncated
+
+
+def clean_jobs(paths, output_dir=None):
+    """
+    Lists the files to clean and where their cleaned copies go.
+
+    Parameters:
+        paths (list): SBML files and directories of SBML files.
+        output_dir (str): Directory of the cleaned copies, under the names of their sources. If not given, each
+            copy is written next to its source, as "<name>_cleaned.xml".
+
+    Returns:
+        list: (source path, output path) of each file.
+    """
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            sources += [os.path.join(path, file) for file in sorted(os.listdir(path))
+                        if file.endswith(".xml") and not file.endswith("_cleaned.xml")]
+        else:
+            sources.append(path)
+
+    if output_dir is None:
+        return [(source, os.path.splitext(source)[0] + "_cleaned.xml") for source in sources]
+    return [(source, os.path.join(output_dir, os.path.basename(source))) for source in sources]
+
+
+if __name__ == "__main__":
+    from multiprocessing import freeze_support
+
+    freeze_support()  # Freeze support for multiprocessing
 
+    parser = argparse.ArgumentParser(description="Truncate the IDs that are too long in SBML models.")
+    parser.add_argument("paths", nargs="*", default=[large_intestine_source],
+                        help="SBML files and directories of SBML files (default: the large intestine host model)")
+    parser.add_argument("--output-dir", default=None,
+                        help="directory of the cleaned models (default: '<name>_cleaned.xml' next to each model)")
+    parser.add_argument("--max-len", type=int, default=256, help="maximum length of an ID")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args()
 
-fix_long_ids("MODEL1310110043_url_large.xml", "MODEL1310110043_url_large_cleaned.xml")
+    jobs = clean_jobs(args.paths, args.output_dir)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    truncated = clean_files(jobs, max_len=args.max_len, max_workers=args.workers)
+    print(f"\n{len(truncated)} models cleaned, {sum(truncated.values())} IDs truncated")
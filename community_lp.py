@@ -0,0 +1,166 @@
+import os
+import numpy as np
+import swiglpk
+from compile_models import CompiledModel, load_compiled_model, file_hash, glpk_bound_type
+from cobra.io import read_sbml_model
+from metabolites import registry
+
+
+def load_species_model(species, path_to_agora="AGORA_1_03_sbml"):
+    """
+    Returns the compiled model of an AGORA species, compiling it in memory if it has not been compiled yet.
+    """
+    filepath = os.path.join(path_to_agora, species)
+    compiled = load_compiled_model(filepath)
+    if compiled is None:
+        compiled = CompiledModel.from_cobra(read_sbml_model(filepath), file_hash(filepath))
+    return compiled
+
+
+class CommunityLP:
+    """
+    One linear program for all the species of a compartment: the species models are placed on the
+    diagonal of a sparse constraint matrix, and a coupling row per exchanged metabolite keeps the amount
+    taken up by the whole community within what the compartment holds (the shared pool). The community
+    biomass production is maximised, and each species' exchanges keep the lower bounds it would have on
+    its own, so the growth rates match the per-species solves whenever the pool is not overdrawn.
+
+    The problem is built once for a given set of species and solved in the parent process at every step,
+    without any worker round trips. Every solve starts from scratch (with the LP presolver), so a step only
+    depends on its inputs (and a resumed run gives the same results).
+    """
+
+    def __init__(self, species_list, path_to_agora="AGORA_1_03_sbml"):
+        """
+        Parameters:
+            species_list (list): AGORA model file names.
+            path_to_agora (str): Directory holding the AGORA models.
+        """
+        self.species_list = list(species_list)
+        models = [load_species_model(species, path_to_agora) for species in self.species_list]
+
+        # Registry indices of the exchanged metabolites, and the union of them (one coupling row each)
+        self.exchange_metabolites = [registry.register(model.exchange_metabolite_ids()) for model in models]
+        self.pool_metabolites = np.unique(np.concatenate(self.exchange_metabolites))
+        pool_row = {metabolite: i for i, metabolite in enumerate(self.pool_metabolites.tolist())}
+
+        num_rows = sum(len(model.metabolite_ids) for model in models) + len(self.pool_metabolites)
+        num_cols = sum(len(model.reaction_ids) for model in models)
+        self.problem = swiglpk.glp_create_prob()
+        swiglpk.glp_set_obj_dir(self.problem, swiglpk.GLP_MAX)
+        swiglpk.glp_add_rows(self.problem, num_rows)
+        swiglpk.glp_add_cols(self.problem, num_cols)
+
+        rows, cols, values = [], [], []
+        self.exchange_cols = []  # GLPK column of each exchange reaction, per species
+        self.objective_cols = []  # GLPK columns and coefficients of the biomass objective, per species
+        row_offset, col_offset = 0, 0
+        coupling_offset = num_rows - len(self.pool_metabolites)
+        for model, exchange_metabolites in zip(models, self.exchange_metabolites):
+            # Block of the species: steady state of its metabolites
+            rows.append(model.stoichiometry_rows + row_offset + 1)
+            cols.append(model.stoichiometry_cols + col_offset + 1)
+            values.append(model.stoichiometry_values)
+            for i in range(len(model.metabolite_ids)):
+                swiglpk.glp_set_row_bnds(self.problem, row_offset + i + 1, swiglpk.GLP_FX, 0.0, 0.0)
+            for j, (lower_bound, upper_bound) in enumerate(zip(model.lower_bounds.tolist(),
+                                                               model.upper_bounds.tolist())):
+                swiglpk.glp_set_col_bnds(self.problem, col_offset + j + 1, glpk_bound_type(lower_bound, upper_bound),
+                                         lower_bound, upper_bound)
+
+            # Coupling: the exchange fluxes enter the row of the metabolite in the shared pool. Their
+            # coefficients (biomass times step length) are set at every solve.
+            exchange_cols = model.exchange_reactions.astype(np.int64) + col_offset + 1
+            self.exchange_cols.append(exchange_cols)
+            rows.append(np.array([coupling_offset + pool_row[m] + 1 for m in exchange_metabolites.tolist()]))
+            cols.append(exchange_cols)
+            values.append(np.ones(len(exchange_cols)))
+
+            objective = np.flatnonzero(model.objective)
+            self.objective_cols.append((objective + col_offset + 1, model.objective[objective]))
+
+            row_offset += len(model.metabolite_ids)
+            col_offset += len(model.reaction_ids)
+
+        rows, cols, values = np.concatenate(rows), np.concatenate(cols), np.concatenate(values)
+        ia, ja, ar = swiglpk.intArray(len(rows) + 1), swiglpk.intArray(len(rows) + 1), swiglpk.doubleArray(
+            len(rows) + 1)
+        for k, (row, col, value) in enumerate(zip(rows.tolist(), cols.tolist(), values.tolist()), start=1):
+            ia[k], ja[k], ar[k] = row, col, value
+        swiglpk.glp_load_matrix(self.problem, len(rows), ia, ja, ar)
+
+        # Position of each coupling coefficient, to update them in place
+        self.coupling_rows = [np.array([coupling_offset + pool_row[m] + 1 for m in exchange_metabolites.tolist()])
+                              for exchange_metabolites in self.exchange_metabolites]
+        self.coupling_offset = coupling_offset
+
+        self.parameters = swiglpk.glp_smcp()
+        swiglpk.glp_init_smcp(self.parameters)
+        self.parameters.msg_lev = swiglpk.GLP_MSG_OFF
+        self.parameters.presolve = swiglpk.GLP_ON  # several times faster than starting from the standard basis
+        self.solves = 0
+        self.iterations = 0
+
+    def solve(self, lower_bounds, biomasses, duration, availability):
+        """
+        Solves the community problem of one step.
+
+        Parameters:
+            lower_bounds (list): Exchange lower bounds of each species, in the order of model.exchanges.
+            biomasses (list): Biomass of each species (in gDCW).
+            duration (float): Length of the step (in hours).
+            availability (np.ndarray): Metabolome of the compartment (in mmol, indexed by the registry).
+
+        Returns:
+            list or None: Growth rate and exchange fluxes of each species, or None if the problem has no
+                optimal solution.
+        """
+        problem = self.problem
+        for k in range(len(self.species_list)):
+            for col, lower_bound in zip(self.exchange_cols[k].tolist(), lower_bounds[k].tolist()):
+                upper_bound = swiglpk.glp_get_col_ub(problem, col)
+                swiglpk.glp_set_col_bnds(problem, col, glpk_bound_type(lower_bound, upper_bound), lower_bound,
+                                         upper_bound)
+            objective_cols, objective_coefficients = self.objective_cols[k]
+            for col, coefficient in zip(objective_cols.tolist(), objective_coefficients.tolist()):
+                swiglpk.glp_set_obj_coef(problem, col, coefficient * biomasses[k])
+
+        # Coupling rows: sum over species of biomass * duration * exchange flux >= -available amount. The pool
+        # may be overdrawn by as much as the minimal uptake (1e-6) that every species is allowed regardless.
+        coefficients = [dict() for _ in self.pool_metabolites]
+        for k, biomass in enumerate(biomasses):
+            for row, col in zip(self.coupling_rows[k].tolist(), self.exchange_cols[k].tolist()):
+                coefficients[row - self.coupling_offset - 1][col] = biomass * duration
+        slack = 1e-6 * duration * np.sum(biomasses)
+        for i, metabolite in enumerate(self.pool_metabolites.tolist()):
+            row_cols = list(coefficients[i].keys())
+            ind, val = swiglpk.intArray(len(row_cols) + 1), swiglpk.doubleArray(len(row_cols) + 1)
+            for k, col in enumerate(row_cols, start=1):
+                ind[k], val[k] = col, coefficients[i][col]
+            swiglpk.glp_set_mat_row(problem, self.coupling_offset + i + 1, len(row_cols), ind, val)
+            available = availability[metabolite] if metabolite < len(availability) else 0.0
+            swiglpk.glp_set_row_bnds(problem, self.coupling_offset + i + 1, swiglpk.GLP_LO,
+                                     -max(available, 0.0) - slack, 0.0)
+
+        iterations = swiglpk.glp_get_it_cnt(problem)
+        status = swiglpk.glp_simplex(problem, self.parameters)
+        self.solves += 1
+        self.iterations += swiglpk.glp_get_it_cnt(problem) - iterations
+        if status != 0 or swiglpk.glp_get_status(problem) != swiglpk.GLP_OPT:
+            return None
+
+        results = []
+        for k in range(len(self.species_list)):
+            objective_cols, objective_coefficients = self.objective_cols[k]
+            growth_rate = sum(coefficient * swiglpk.glp_get_col_prim(problem, col) for col, coefficient in
+                              zip(objective_cols.tolist(), objective_coefficients.tolist()))
+            exchange_fluxes = np.array([swiglpk.glp_get_col_prim(problem, col)
+                                        for col in self.exchange_cols[k].tolist()])
+            results.append((growth_rate, exchange_fluxes))
+        return results
+
+    def __del__(self):
+        if getattr(self, "problem", None) is not None:
+            swiglpk.glp_delete_prob(self.problem)
+            self.problem = None
+
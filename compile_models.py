@@ -0,0 +1,317 @@
+import os
+import hashlib
+import logging
+import numpy as np
+import swiglpk
+from cobra import Model, Reaction, Metabolite
+from cobra.io import read_sbml_model
+
+# Directory holding the compiled (.npz) versions of the SBML models
+compiled_dir = "compiled_models"
+
+# Environment variable that, set to "0", makes every process load the full models even where reduced forms of them
+# have been written (see compress_models.py)
+reduced_models_variable = "USE_REDUCED_MODELS"
+
+# Digest of every SBML file load_compiled_model() looked up, by (path, modification time, size), so that a model
+# loaded again (e.g. after it was evicted from a model cache) is found without reading its whole file
+_source_hashes = dict()
+
+
+def file_hash(filepath):
+    """
+    Computes the SHA-256 digest of a file.
+
+    Parameters:
+        filepath (str): Path to the file.
+
+    Returns:
+        str: Hexadecimal digest of the file contents.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cached_file_hash(sbml_path):
+    """
+    Returns the digest of an SBML file (see file_hash()), only reading the file again if its modification time
+    or size changed since the last call.
+
+    Parameters:
+        sbml_path (str): Path to the SBML file.
+
+    Returns:
+        str: Hexadecimal digest of the file contents.
+    """
+    stat = os.stat(sbml_path)
+    key = (os.path.abspath(sbml_path), stat.st_mtime_ns, stat.st_size)
+    if key not in _source_hashes:
+        _source_hashes[key] = file_hash(sbml_path)
+    return _source_hashes[key]
+
+
+def glpk_bound_type(lower_bound, upper_bound):
+    """
+    Returns the GLPK bound type of a variable of a compiled model, for glp_set_col_bnds().
+
+    Parameters:
+        lower_bound (float): Lower bound of the variable (-inf if it has none).
+        upper_bound (float): Upper bound of the variable (inf if it has none).
+
+    Returns:
+        int: GLP_FX, GLP_FR, GLP_LO, GLP_UP or GLP_DB.
+    """
+    if lower_bound == upper_bound:
+        return swiglpk.GLP_FX
+    if np.isinf(lower_bound) and np.isinf(upper_bound):
+        return swiglpk.GLP_FR
+    if np.isinf(upper_bound):
+        return swiglpk.GLP_LO
+    if np.isinf(lower_bound):
+        return swiglpk.GLP_UP
+    return swiglpk.GLP_DB
+
+
+def compiled_path(sbml_path, source_hash=None, cache_dir=compiled_dir, reduced=False):
+    """
+    Returns the path of the compiled form of an SBML file. The path contains the hash of the
+    source file, so a compiled model is never used once its SBML file has changed.
+
+    Parameters:
+        sbml_path (str): Path to the SBML file.
+        source_hash (str): Precomputed hash of the SBML file (computed if not given).
+        cache_dir (str): Directory holding the compiled models.
+        reduced (bool): Whether to return the path of the reduced form instead (see compress_models.py).
+
+    Returns:
+        str: Path to the compiled model.
+    """
+    if source_hash is None:
+        source_hash = file_hash(sbml_path)
+    stem = os.path.splitext(os.path.basename(sbml_path))[0]
+    return os.path.join(cache_dir, f"{stem}.{source_hash[:16]}{'.reduced' if reduced else ''}.npz")
+
+
+class CompiledModel:
+    """
+    Compact, array-based form of a constraint-based model: sparse stoichiometry, flux bounds,
+    objective and the exchange reaction → metabolite index. Loading one takes milliseconds, and
+    it can be turned back into a cobra model that solves identically to the parsed SBML (unless it
+    is the reduced form of the model, see compress_models.py).
+    """
+
+    def __init__(self, arrays):
+        self.model_id = str(arrays["model_id"])
+        self.model_name = str(arrays["model_name"])
+        self.compartment_ids = arrays["compartment_ids"]
+        self.compartment_names = arrays["compartment_names"]
+        self.metabolite_ids = arrays["metabolite_ids"]
+        self.metabolite_names = arrays["metabolite_names"]
+        self.metabolite_compartments = arrays["metabolite_compartments"]
+        self.reaction_ids = arrays["reaction_ids"]
+        self.reaction_names = arrays["reaction_names"]
+        self.lower_bounds = arrays["lower_bounds"]
+        self.upper_bounds = arrays["upper_bounds"]
+        self.objective = arrays["objective"]
+        self.stoichiometry_rows = arrays["stoichiometry_rows"]  # metabolite indices
+        self.stoichiometry_cols = arrays["stoichiometry_cols"]  # reaction indices
+        self.stoichiometry_values = arrays["stoichiometry_values"]
+        self.exchange_reactions = arrays["exchange_reactions"]  # reaction indices of the exchanges
+        self.exchange_metabolites = arrays["exchange_metabolites"]  # metabolite exchanged by each of them
+        self.source_hash = str(arrays["source_hash"])
+        # "full", or "reduced" for a model written by compress_models.py (models compiled before it are full)
+        self.variant = str(arrays["variant"]) if "variant" in arrays else "full"
+
+    @classmethod
+    def from_cobra(cls, model, source_hash=""):
+        metabolite_index = {metabolite.id: i for i, metabolite in enumerate(model.metabolites)}
+        reaction_index = {reaction.id: j for j, reaction in enumerate(model.reactions)}
+
+        rows, cols, values = [], [], []
+        for j, reaction in enumerate(model.reactions):
+            for metabolite, coefficient in reaction.metabolites.items():
+                rows.append(metabolite_index[metabolite.id])
+                cols.append(j)
+                values.append(coefficient)
+
+        exchanges = model.exchanges
+        return cls({
+            "model_id": model.id or "",
+            "model_name": model.name or "",
+            "compartment_ids": np.array(list(model.compartments.keys()), dtype=str),
+            "compartment_names": np.array([name or "" for name in model.compartments.values()], dtype=str),
+            "metabolite_ids": np.array([metabolite.id for metabolite in model.metabolites], dtype=str),
+            "metabolite_names": np.array([metabolite.name or "" for metabolite in model.metabolites], dtype=str),
+            "metabolite_compartments": np.array([metabolite.compartment or "" for metabolite in model.metabolites],
+                                                dtype=str),
+            "reaction_ids": np.array([reaction.id for reaction in model.reactions], dtype=str),
+            "reaction_names": np.array([reaction.name or "" for reaction in model.reactions], dtype=str),
+            "lower_bounds": np.array([reaction.lower_bound for reaction in model.reactions], dtype=np.float64),
+            "upper_bounds": np.array([reaction.upper_bound for reaction in model.reactions], dtype=np.float64),
+            "objective": np.array([reaction.objective_coefficient for reaction in model.reactions], dtype=np.float64),
+            "stoichiometry_rows": np.array(rows, dtype=np.int32),
+            "stoichiometry_cols": np.array(cols, dtype=np.int32),
+            "stoichiometry_values": np.array(values, dtype=np.float64),
+            "exchange_reactions": np.array([reaction_index[exchange.id] for exchange in exchanges], dtype=np.int32),
+            "exchange_metabolites": np.array([metabolite_index[next(iter(exchange.metabolites)).id]
+                                              for exchange in exchanges], dtype=np.int32),
+            "source_hash": source_hash,
+            "variant": "full",
+        })
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls({key: arrays[key] for key in arrays.files})
+
+    def save(self, path):
+        np.savez_compressed(path, **{key: np.asarray(value) for key, value in vars(self).items()})
+
+    def model_key(self):
+        """
+        Returns:
+            str: Identifier of the model solutions are cached under: the hash of its SBML file, followed by
+                its variant if it is not the full model.
+        """
+        return self.source_hash if self.variant == "full" else f"{self.source_hash}.{self.variant}"
+
+    def exchange_metabolite_ids(self):
+        return self.metabolite_ids[self.exchange_metabolites].tolist()
+
+    def exchange_metabolite_names(self):
+        return self.metabolite_names[self.exchange_metabolites].tolist()
+
+    def to_cobra(self):
+        """
+        Rebuilds the cobra model. Metabolites and reactions are added in their original order,
+        so the LP (and therefore every solution) is the same as for the model read from SBML.
+
+        Returns:
+            cobra.Model: The rebuilt model.
+        """
+        model = Model(self.model_id, name=self.model_name)
+
+        metabolites = [Metabolite(metabolite_id, name=name, compartment=compartment)
+                       for metabolite_id, name, compartment in
+                       zip(self.metabolite_ids.tolist(), self.metabolite_names.tolist(),
+                           self.metabolite_compartments.tolist())]
+        model.add_metabolites(metabolites)
+
+        reactions = [Reaction(reaction_id, name=name, lower_bound=lower_bound, upper_bound=upper_bound)
+                     for reaction_id, name, lower_bound, upper_bound in
+                     zip(self.reaction_ids.tolist(), self.reaction_names.tolist(),
+                         self.lower_bounds.tolist(), self.upper_bounds.tolist())]
+        stoichiometry = [dict() for _ in reactions]
+        for row, col, value in zip(self.stoichiometry_rows.tolist(), self.stoichiometry_cols.tolist(),
+                                   self.stoichiometry_values.tolist()):
+            stoichiometry[col][metabolites[row]] = value
+        for reaction, coefficients in zip(reactions, stoichiometry):
+            reaction.add_metabolites(coefficients)
+        model.add_reactions(reactions)
+
+        model.compartments = dict(zip(self.compartment_ids.tolist(), self.compartment_names.tolist()))
+        model.objective = {reactions[j]: coefficient for j, coefficient in enumerate(self.objective.tolist())
+                           if coefficient != 0}
+        return model
+
+
+def compile_model(sbml_path, cache_dir=compiled_dir):
+    """
+    Compiles an SBML file into its array form, replacing any stale compiled version of it.
+
+    Parameters:
+        sbml_path (str): Path to the SBML file.
+        cache_dir (str): Directory holding the compiled models.
+
+    Returns:
+        str: Path to the compiled model.
+    """
+    source_hash = file_hash(sbml_path)
+    output_path = compiled_path(sbml_path, source_hash, cache_dir)
+    if os.path.exists(output_path):
+        return output_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(sbml_path))[0]
+    for file in os.listdir(cache_dir):
+        # Compiled and reduced forms of earlier versions of the file
+        rest = file[len(stem) + 1:]
+        if file.startswith(stem + ".") and (rest.count(".") == 1 or rest.endswith(".reduced.npz") and
+                                            rest.count(".") == 2):
+            os.remove(os.path.join(cache_dir, file))
+
+    CompiledModel.from_cobra(read_sbml_model(sbml_path), source_hash).save(output_path)
+    return output_path
+
+
+def use_reduced_models():
+    """
+    Returns:
+        bool: Whether the reduced forms of the models are loaded where they have been written, i.e. unless the
+            USE_REDUCED_MODELS environment variable is "0".
+    """
+    return os.environ.get(reduced_models_variable, "1") != "0"
+
+
+def load_compiled_model(sbml_path, cache_dir=compiled_dir, reduced=None):
+    """
+    Loads the compiled form of an SBML file if it is present and up to date.
+
+    Parameters:
+        sbml_path (str): Path to the SBML file.
+        cache_dir (str): Directory holding the compiled models.
+        reduced (bool): Whether to load the reduced form of the model instead, when it has been written by
+            compress_models.py. It has the same exchanges and growth rates, with fewer reactions. By default it
+            is, unless the USE_REDUCED_MODELS environment variable is "0" (see use_reduced_models()).
+
+    Returns:
+        CompiledModel or None: The compiled model, or None if it has not been compiled.
+    """
+    source_hash = cached_file_hash(sbml_path)
+    if reduced is None:
+        reduced = use_reduced_models()
+    if reduced:
+        path = compiled_path(sbml_path, source_hash, cache_dir, reduced=True)
+        if os.path.exists(path):
+            model = CompiledModel.load(path)
+            model.variant = "reduced"  # also for the reduced models written before the variant was stored
+            return model
+    path = compiled_path(sbml_path, source_hash, cache_dir)
+    if not os.path.exists(path):
+        return None
+    return CompiledModel.load(path)
+
+
+def read_model(sbml_path, cache_dir=compiled_dir):
+    """
+    Reads a cobra model, going through its compiled form when one is present.
+
+    Parameters:
+        sbml_path (str): Path to the SBML file.
+        cache_dir (str): Directory holding the compiled models.
+
+    Returns:
+        cobra.Model: The model.
+    """
+    compiled = load_compiled_model(sbml_path, cache_dir)
+    if compiled is None:
+        return read_sbml_model(sbml_path)
+    return compiled.to_cobra()
+
+
+if __name__ == "__main__":
+    logging.getLogger("cobra").setLevel(logging.ERROR)
+
+    path_to_agora = "AGORA_1_03_sbml"
+    sbml_files = [os.path.join(path_to_agora, file) for file in sorted(os.listdir(path_to_agora))
+                  if file.endswith(".xml")]
+    sbml_files += ["MODEL1310110020_url_small.xml", "MODEL1310110043_url_large_cleaned.xml"]
+
+    for sbml_file in sbml_files:
+        if not os.path.exists(sbml_file):
+            print(f"Skipping {sbml_file}: not found")
+            continue
+        print(f"{sbml_file} -> {compile_model(sbml_file)}")
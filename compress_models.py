@@ -0,0 +1,362 @@
+import os
+import json
+import time
+import logging
+import argparse
+import collections
+import concurrent.futures
+import numpy as np
+import swiglpk
+from compile_models import CompiledModel, compile_model, compiled_path, file_hash, compiled_dir, glpk_bound_type
+
+# Size, solve time and outcome of the reduction of every model, so that a re-run only reduces new or changed models
+report_path = os.path.join(compiled_dir, "compression_report.json")
+
+# Fluxes smaller than this (in mmol/gDCW/h) are taken as zero when looking for blocked reactions
+flux_tolerance = 1e-9
+
+# Largest difference of growth rate allowed between a model and its reduced form, relative and absolute (in 1/h).
+# GLPK's primal feasibility tolerance (1e-7) is close to the smallest uptake bounds the simulator gives (1e-6), so
+# growth rates of that order come out of the solver with about that much noise, whatever the model.
+growth_tolerance = 1e-5
+growth_absolute_tolerance = 1e-6
+
+
+def _problem(model, lower_bounds):
+    # GLPK problem of the steady state of 'model', with the given reaction lower bounds and no objective
+    problem = swiglpk.glp_create_prob()
+    swiglpk.glp_add_rows(problem, len(model.metabolite_ids))
+    swiglpk.glp_add_cols(problem, len(model.reaction_ids))
+    for i in range(len(model.metabolite_ids)):
+        swiglpk.glp_set_row_bnds(problem, i + 1, swiglpk.GLP_FX, 0.0, 0.0)
+    for j, (lower_bound, upper_bound) in enumerate(zip(lower_bounds.tolist(), model.upper_bounds.tolist())):
+        swiglpk.glp_set_col_bnds(problem, j + 1, glpk_bound_type(lower_bound, upper_bound), lower_bound, upper_bound)
+
+    size = len(model.stoichiometry_values)
+    ia, ja, ar = swiglpk.intArray(size + 1), swiglpk.intArray(size + 1), swiglpk.doubleArray(size + 1)
+    for k, (row, col, value) in enumerate(zip(model.stoichiometry_rows.tolist(), model.stoichiometry_cols.tolist(),
+                                              model.stoichiometry_values.tolist()), start=1):
+        ia[k], ja[k], ar[k] = row + 1, col + 1, value
+    swiglpk.glp_load_matrix(problem, size, ia, ja, ar)
+    return problem
+
+
+def _parameters():
+    parameters = swiglpk.glp_smcp()
+    swiglpk.glp_init_smcp(parameters)
+    parameters.msg_lev = swiglpk.GLP_MSG_OFF
+    return parameters
+
+
+def blocked_reactions(model):
+    """
+    Finds the reactions that cannot carry flux under any uptake bounds the simulator gives the exchanges. The
+    simulator only lowers the lower bounds of the exchange reactions, so the flux variability of every reaction
+    is looked at with all the exchanges open to unlimited uptake: a reaction that is blocked then is blocked
+    under any bounds. Every solution found shows that all the reactions it uses carry flux, which rules most of
+    them out without solving for them.
+
+    Parameters:
+        model (CompiledModel): The model.
+
+    Returns:
+        np.ndarray: Whether each reaction is blocked.
+
+    Raises:
+        RuntimeError: If the model has no steady state, or a solve fails.
+    """
+    lower_bounds = model.lower_bounds.copy()
+    lower_bounds[model.exchange_reactions] = -np.inf
+    problem = _problem(model, lower_bounds)
+    parameters = _parameters()
+    num_reactions = len(model.reaction_ids)
+    carries_flux = np.zeros(num_reactions, dtype=bool)
+    try:
+        for j in range(num_reactions):
+            # Maximise, then minimise, the flux of each reaction not known to carry flux yet
+            for direction in (swiglpk.GLP_MAX, swiglpk.GLP_MIN):
+                if carries_flux[j]:
+                    break
+                swiglpk.glp_set_obj_dir(problem, direction)
+                swiglpk.glp_set_obj_coef(problem, j + 1, 1.0)
+                status = swiglpk.glp_simplex(problem, parameters)
+                swiglpk.glp_set_obj_coef(problem, j + 1, 0.0)
+                if status == 0 and swiglpk.glp_get_status(problem) == swiglpk.GLP_UNBND:
+                    carries_flux[j] = True
+                    continue
+                if status != 0 or swiglpk.glp_get_status(problem) != swiglpk.GLP_OPT:
+                    raise RuntimeError(f"flux variability of {model.reaction_ids[j]} could not be solved "
+                                       f"(status {swiglpk.glp_get_status(problem)})")
+                fluxes = np.array([swiglpk.glp_get_col_prim(problem, col) for col in range(1, num_reactions + 1)])
+                carries_flux |= np.abs(fluxes) > flux_tolerance
+    finally:
+        swiglpk.glp_delete_prob(problem)
+    return ~carries_flux
+
+
+def compress_model(model):
+    """
+    Reduces a model to the reactions that can carry flux, and merges linear chains of reactions. The exchange
+    reactions and the objective are kept as they are, so the reduced model has the same exchanges and, for any
+    uptake bounds, the same growth rate.
+
+    A metabolite taken part in by exactly two reactions forces their fluxes into a fixed ratio. The second
+    reaction is then folded into the first: the stoichiometry of the first becomes that of the pair (without
+    the metabolite), and its bounds the intersection of both. The merged reaction keeps the ID of the first.
+
+    Parameters:
+        model (CompiledModel): The model.
+
+    Returns:
+        tuple: The reduced model (CompiledModel), the number of blocked reactions removed and the number of
+            reactions merged into others.
+    """
+    num_reactions = len(model.reaction_ids)
+    # Exchanges report their fluxes to the simulator, and the objective its growth rate
+    protected = np.zeros(num_reactions, dtype=bool)
+    protected[model.exchange_reactions] = True
+    protected[model.objective != 0] = True
+    kept = ~blocked_reactions(model) | protected
+    blocked = int(np.sum(~kept))
+
+    columns = [dict() for _ in range(num_reactions)]
+    for row, col, value in zip(model.stoichiometry_rows.tolist(), model.stoichiometry_cols.tolist(),
+                               model.stoichiometry_values.tolist()):
+        columns[col][row] = value
+    lower_bounds, upper_bounds = model.lower_bounds.tolist(), model.upper_bounds.tolist()
+    reactions_of = collections.defaultdict(set)  # kept reactions of each metabolite
+    for j in np.flatnonzero(kept).tolist():
+        for row in columns[j]:
+            reactions_of[row].add(j)
+
+    merged = 0
+    queue = sorted(reactions_of)
+    while queue:
+        metabolite = queue.pop()
+        if len(reactions_of[metabolite]) != 2:
+            continue
+        first, second = sorted(reactions_of[metabolite])
+        if protected[first] or protected[second]:
+            continue
+        # Steady state of the metabolite: flux of the second = ratio * flux of the first
+        ratio = -columns[first][metabolite] / columns[second][metabolite]
+        column = dict(columns[first])
+        for row, value in columns[second].items():
+            column[row] = column.get(row, 0.0) + ratio * value
+        column.pop(metabolite)
+        column = {row: value for row, value in column.items() if abs(value) > 1e-12}
+        if len(column) < 2:
+            continue  # a reaction of a single metabolite would be taken for a boundary reaction
+        if ratio > 0:
+            lower_bound, upper_bound = lower_bounds[second] / ratio, upper_bounds[second] / ratio
+        else:
+            lower_bound, upper_bound = upper_bounds[second] / ratio, lower_bounds[second] / ratio
+        lower_bound, upper_bound = max(lower_bounds[first], lower_bound), min(upper_bounds[first], upper_bound)
+        if lower_bound > upper_bound:
+            continue
+
+        for row in columns[first]:
+            reactions_of[row].discard(first)
+        for row in columns[second]:
+            reactions_of[row].discard(second)
+        for row in column:
+            reactions_of[row].add(first)
+        columns[first], columns[second] = column, dict()
+        lower_bounds[first], upper_bounds[first] = lower_bound, upper_bound
+        kept[second] = False
+        merged += 1
+        queue.extend(column)  # their number of reactions may have dropped to two
+
+    # Metabolites that no kept reaction takes part in are dropped; the order of the rest is unchanged
+    reactions = np.flatnonzero(kept)
+    metabolites = np.array(sorted(row for row, js in reactions_of.items() if js), dtype=np.int64)
+    metabolite_index = np.full(len(model.metabolite_ids), -1, dtype=np.int64)
+    metabolite_index[metabolites] = np.arange(len(metabolites))
+    reaction_index = np.full(num_reactions, -1, dtype=np.int64)
+    reaction_index[reactions] = np.arange(len(reactions))
+
+    rows, cols, values = [], [], []
+    for j in reactions.tolist():
+        for row, value in columns[j].items():
+            rows.append(metabolite_index[row])
+            cols.append(reaction_index[j])
+            values.append(value)
+
+    arrays = dict(vars(model))
+    arrays.update({
+        "metabolite_ids": model.metabolite_ids[metabolites],
+        "metabolite_names": model.metabolite_names[metabolites],
+        "metabolite_compartments": model.metabolite_compartments[metabolites],
+        "reaction_ids": model.reaction_ids[reactions],
+        "reaction_names": model.reaction_names[reactions],
+        "lower_bounds": np.array(lower_bounds, dtype=np.float64)[reactions],
+        "upper_bounds": np.array(upper_bounds, dtype=np.float64)[reactions],
+        "objective": model.objective[reactions],
+        "stoichiometry_rows": np.array(rows, dtype=np.int32),
+        "stoichiometry_cols": np.array(cols, dtype=np.int32),
+        "stoichiometry_values": np.array(values, dtype=np.float64),
+        "exchange_reactions": reaction_index[model.exchange_reactions].astype(np.int32),
+        "exchange_metabolites": metabolite_index[model.exchange_metabolites].astype(np.int32),
+        "variant": "reduced",
+    })
+    return CompiledModel(arrays), blocked, merged
+
+
+def solve_growth(model, exchange_lower_bounds, repeats=3):
+    """
+    Solves a model from the standard basis, as a species solve does, for the given exchange lower bounds.
+
+    Returns:
+        tuple: Growth rate (None if there is no optimal solution), simplex iterations and the shortest solve
+            time of the repeats (in seconds).
+    """
+    lower_bounds = model.lower_bounds.copy()
+    lower_bounds[model.exchange_reactions] = exchange_lower_bounds
+    problem = _problem(model, lower_bounds)
+    parameters = _parameters()
+    swiglpk.glp_set_obj_dir(problem, swiglpk.GLP_MAX)
+    for j in np.flatnonzero(model.objective).tolist():
+        swiglpk.glp_set_obj_coef(problem, j + 1, float(model.objective[j]))
+    try:
+        seconds = []
+        for _ in range(repeats):
+            swiglpk.glp_std_basis(problem)
+            iterations = swiglpk.glp_get_it_cnt(problem)
+            start = time.perf_counter()
+            status = swiglpk.glp_simplex(problem, parameters)
+            seconds.append(time.perf_counter() - start)
+            iterations = swiglpk.glp_get_it_cnt(problem) - iterations
+        optimal = status == 0 and swiglpk.glp_get_status(problem) == swiglpk.GLP_OPT
+        return swiglpk.glp_get_obj_val(problem) if optimal else None, iterations, min(seconds)
+    finally:
+        swiglpk.glp_delete_prob(problem)
+
+
+def uptake_regimes(model, count=3, seed=0):
+    # Exchange lower bounds the growth rates of a model and its reduced form are compared under: those of the
+    # model, all uptakes open, and random uptake limits over the range the simulator gives them
+    rng = np.random.default_rng(seed)
+    num_exchanges = len(model.exchange_reactions)
+    return [model.lower_bounds[model.exchange_reactions], np.full(num_exchanges, -1000.0)] + \
+        [-10 ** rng.uniform(-6, 3, num_exchanges) for _ in range(count)]
+
+
+def _reduced_file(sbml_path, cache_dir):
+    # Worker task: reduce one model and check it, and return the report of the reduction, or None if the model
+    # cannot be read
+    logging.getLogger("cobra").setLevel(logging.ERROR)
+    try:
+        source_hash = file_hash(sbml_path)
+        model = CompiledModel.load(compile_model(sbml_path, cache_dir))  # the full model, never the reduced one
+        start = time.perf_counter()
+        reduced, blocked, merged = compress_model(model)
+        report = {"hash": source_hash, "seconds": time.perf_counter() - start, "blocked": blocked, "merged": merged,
+                  "reactions": [len(model.reaction_ids), len(reduced.reaction_ids)],
+                  "metabolites": [len(model.metabolite_ids), len(reduced.metabolite_ids)],
+                  "nonzeros": [len(model.stoichiometry_values), len(reduced.stoichiometry_values)],
+                  "solve_ms": [0.0, 0.0], "iterations": [0, 0]}
+
+        # The reduced model must give the same growth rates, and cobra must find the same exchanges in it
+        for exchange_lower_bounds in uptake_regimes(model):
+            solves = [solve_growth(m, exchange_lower_bounds) for m in (model, reduced)]
+            (growth, _, _), (reduced_growth, _, _) = solves
+            if (growth is None) != (reduced_growth is None) or growth is not None and \
+                    abs(reduced_growth - growth) > growth_tolerance * abs(growth) + growth_absolute_tolerance:
+                report["rejected"] = f"growth rate {reduced_growth} instead of {growth}"
+                return report
+            for k, (_, iterations, seconds) in enumerate(solves):
+                report["solve_ms"][k] += seconds * 1e3
+                report["iterations"][k] += iterations
+        exchanges = [exchange.id for exchange in reduced.to_cobra().exchanges]
+        if exchanges != model.reaction_ids[model.exchange_reactions].tolist():
+            report["rejected"] = "exchange reactions differ"
+            return report
+
+        reduced.save(compiled_path(sbml_path, source_hash, cache_dir, reduced=True))
+        return report
+    except Exception as e:
+        print(f"Skipping {sbml_path}: {e}")
+        return None
+
+
+def compress_files(sbml_paths, cache_dir=compiled_dir, max_workers=None):
+    """
+    Writes the reduced form of several models, in parallel, next to their compiled forms. Models reduced (or
+    found not to be reducible) by an earlier run from a source with the same hash are not reduced again.
+
+    Parameters:
+        sbml_paths (list): Paths to the SBML files.
+        cache_dir (str): Directory holding the compiled models.
+        max_workers (int): Number of worker processes (default: number of CPUs).
+
+    Returns:
+        dict: Report of the reduction of each model: its number of reactions, metabolites and stoichiometric
+            coefficients and the time (in ms) and simplex iterations it takes to solve under a few uptake
+            regimes, before and after, the numbers of reactions removed and merged, and why the reduced model
+            was rejected, if it was.
+    """
+    report = dict()
+    if os.path.exists(report_path):
+        with open(report_path, "r", encoding="utf-8") as f:
+            report = json.load(f)
+
+    def unchanged(path):
+        entry = report.get(path)
+        return entry is not None and entry["hash"] == file_hash(path) and \
+            ("rejected" in entry or os.path.exists(compiled_path(path, entry["hash"], cache_dir, reduced=True)))
+
+    stale = [path for path in sbml_paths if not unchanged(path)]
+    if stale:
+        print(f"Reducing {len(stale)} models ({len(sbml_paths) - len(stale)} unchanged)")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for path, result in zip(stale, executor.map(_reduced_file, stale, [cache_dir] * len(stale))):
+                if result is not None:
+                    report[path] = result
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+
+    return {path: report[path] for path in sbml_paths if path in report}
+
+
+def format_report(report):
+    """
+    Returns:
+        str: One line per model with its LP size and solve time before and after the reduction.
+    """
+    lines = [f"{'model':<48} {'reactions':>11} {'metabolites':>11} {'nonzeros':>11} {'solve ms':>13} {'speedup':>7}"]
+    for path, entry in report.items():
+        name = os.path.splitext(os.path.basename(path))[0][:48]
+        if "rejected" in entry:
+            lines.append(f"{name:<48} rejected: {entry['rejected']}")
+            continue
+        sizes = " ".join(f"{before:>5}>{after:<5}" for before, after in
+                         (entry["reactions"], entry["metabolites"], entry["nonzeros"]))
+        before, after = entry["solve_ms"]
+        lines.append(f"{name:<48} {sizes} {before:>6.1f}>{after:<6.1f} {before / max(after, 1e-9):>6.2f}x")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    from multiprocessing import freeze_support
+
+    freeze_support()  # Freeze support for multiprocessing
+
+    parser = argparse.ArgumentParser(description="Remove the blocked reactions of the AGORA and host models, and "
+                                                 "merge their linear reaction chains.")
+    parser.add_argument("paths", nargs="*", default=["AGORA_1_03_sbml", "MODEL1310110020_url_small.xml",
+                                                     "MODEL1310110043_url_large_cleaned.xml"],
+                        help="SBML files and directories of SBML files (default: the AGORA and host models)")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args()
+
+    sbml_files = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            sbml_files += [os.path.join(path, file) for file in sorted(os.listdir(path)) if file.endswith(".xml")]
+        elif os.path.exists(path):
+            sbml_files.append(path)
+        else:
+            print(f"Skipping {path}: not found")
+
+    print(format_report(compress_files(sbml_files, max_workers=args.workers)))
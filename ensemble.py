@@ -0,0 +1,132 @@
+import os
+import time
+import argparse
+import concurrent.futures
+import numpy as np
+from simulate import simulate, sim_time
+from worker_pool import create_pool
+from recorder import OutputSpec
+from solution_cache import SolutionCache
+from utilities import model_cache_report
+
+
+def run_ensemble(duration, diet_files, num_seeds, base_seed=5240, max_workers=None, max_concurrent=None,
+                 results_root="results", cache_path=None, model_cache_mb=None, backend="process", daemons=None,
+                 **simulate_kwargs):
+    """
+    Runs every combination of diet and seed as one ensemble sharing a single worker pool, and
+    therefore a single per-worker model cache, and a single cache of species FBA solutions.
+
+    Members are simulated in threads of this process. Each of them submits its species solves to the
+    shared pool, so while one member is busy with serial work (host model, transit, recording) the
+    species solves of the others keep the workers busy.
+
+    Every member gets its own random streams: child s of np.random.SeedSequence(base_seed) is used for
+    seed s of every diet, so the diets are compared under common random numbers and any member can be
+    reproduced on its own with simulate(..., seed=np.random.SeedSequence(base_seed).spawn(num_seeds)[s]).
+
+    Parameters:
+    - duration (int): Duration of each simulation (in hours).
+    - diet_files (list): Paths to the diet CSV files.
+    - num_seeds (int): Number of seeds per diet.
+    - base_seed (int): Seed from which the member seeds are derived.
+    - max_workers (int): Number of worker processes or threads (default: number of CPUs).
+    - max_concurrent (int): Number of members simulated at the same time (default: one per four workers,
+      and at least two).
+    - results_root (str): Directory in which the ensemble folder is created.
+    - cache_path (str): Path of an on-disk solution cache to use and extend (default: memory only).
+    - model_cache_mb (float): Memory budget of the AGORA models kept loaded by each worker (in MB). If given,
+      every strain is also solved on a single worker (see WorkerPool). The daemons of the remote backend are given
+      their budget when they are started, and every strain is then solved on a single daemon.
+    - backend (str): Where the species are solved: "serial", "thread", "process" or "remote" (see
+      worker_pool.create_pool()).
+    - daemons (list): "host:port" addresses of the worker daemons, for the remote backend.
+    - **simulate_kwargs: Other options of simulate() given to every member, e.g. prune_threshold, strain_library,
+      engine, schedule, outputs or reuse_tolerance.
+
+    Returns:
+    - dict: Results folder of each (diet file, seed index) member.
+    """
+    member_options = set(simulate_kwargs) & {"seed", "pool", "run_name", "results_root", "verbose", "solution_cache",
+                                            "resume"}
+    if member_options:
+        raise ValueError(f"The ensemble sets {', '.join(sorted(member_options))} of every member itself")
+
+    member_seeds = np.random.SeedSequence(base_seed).spawn(num_seeds)
+    members = [(diet_file, s) for diet_file in diet_files for s in range(num_seeds)]
+
+    ensemble_dir = os.path.join(results_root, f"{sim_time}_ensemble")
+    pool = create_pool(backend, max_workers, model_cache_mb=model_cache_mb, affinity=model_cache_mb is not None,
+                       addresses=daemons)
+    solution_cache = SolutionCache(path=cache_path)
+    if max_concurrent is None:
+        max_concurrent = max(2, pool.max_workers // 4)
+    max_concurrent = min(max_concurrent, len(members))
+
+    def run_member(diet_file, s):
+        run_name = f"{os.path.basename(diet_file).split('_')[0]}_seed{s}"
+        start = time.time()
+        simulate(duration, diet_file, seed=member_seeds[s], pool=pool, run_name=run_name, results_root=ensemble_dir,
+                 verbose=False, solution_cache=solution_cache, **simulate_kwargs)
+        print(f"{run_name} finished in {(time.time() - start) / 60:.2f} minutes")
+        return os.path.join(ensemble_dir, run_name)
+
+    results = dict()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent) as members_executor:
+            futures = {members_executor.submit(run_member, diet_file, s): (diet_file, s) for diet_file, s in members}
+            for future in concurrent.futures.as_completed(futures):
+                results[futures[future]] = future.result()
+    finally:
+        print(pool.report())
+        if pool.affinity:
+            print(model_cache_report(pool))
+        print(solution_cache.report())
+        pool.shutdown()
+        solution_cache.close()
+
+    return results
+
+
+if __name__ == "__main__":
+    from multiprocessing import freeze_support
+
+    freeze_support()  # Freeze support for multiprocessing
+
+    parser = argparse.ArgumentParser(description="Run an ensemble of simulations over diets and seeds.")
+    parser.add_argument("--duration", type=int, default=24 * 365, help="duration of each simulation in hours")
+    parser.add_argument("--diets", nargs="+", default=["keto_diet.csv", "vegetarian_diet.csv"],
+                        help="diet CSV files")
+    parser.add_argument("--seeds", type=int, default=10, help="number of seeds per diet")
+    parser.add_argument("--base-seed", type=int, default=5240, help="seed from which member seeds are derived")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes or threads")
+    parser.add_argument("--concurrent", type=int, default=None, help="number of members run at the same time")
+    parser.add_argument("--cache", default=None, help="on-disk solution cache shared between runs")
+    parser.add_argument("--strains", default="representative_strains.json",
+                        help="representative strains JSON file, or AGORA folder to sample all strains from")
+    parser.add_argument("--model-cache-mb", type=float, default=None,
+                        help="memory budget of the models kept loaded by each worker, in MB")
+    parser.add_argument("--engine", choices=["pool", "community"], default="pool",
+                        help="how the species of a compartment are solved at every step (see simulate())")
+    parser.add_argument("--schedule", choices=["sequential", "pipelined"], default="pipelined",
+                        help="order of the compartment steps of a day (see simulate())")
+    parser.add_argument("--backend", choices=["serial", "thread", "process", "remote"], default="process",
+                        help="where the species are solved")
+    parser.add_argument("--daemons", nargs="+", default=None,
+                        help="host:port of every worker daemon (remote backend, see worker_pool.py)")
+    parser.add_argument("--outputs", default=None,
+                        help="JSON file of the output spec: what is recorded, and how often (see recorder.OutputSpec)")
+    parser.add_argument("--reuse-tolerance", type=float, default=None,
+                        help="reuse the last solution of a species while the changes of its bounds cannot raise its "
+                             "growth rate by more than this fraction, 0 for exact reuse (default: solve every species "
+                             "at every step)")
+    args = parser.parse_args()
+
+    start = time.time()
+    run_ensemble(args.duration, args.diets, args.seeds, base_seed=args.base_seed, max_workers=args.workers,
+                 max_concurrent=args.concurrent, cache_path=args.cache, strain_library=args.strains,
+                 model_cache_mb=args.model_cache_mb, backend=args.backend, daemons=args.daemons,
+                 engine=args.engine, schedule=args.schedule,
+                 outputs=OutputSpec.load(args.outputs) if args.outputs else None,
+                 reuse_tolerance=args.reuse_tolerance)
+    print(f"\nTime taken = {(time.time() - start) / 60} minutes")
@@ -0,0 +1,115 @@
+import numpy as np
+from sample_diet import load_diet, gas_volume_stats
+from sample_phyla import load_strain_library
+from metabolites import registry
+from utilities import child_seeds
+
+
+class InputSchedule:
+    """
+    Daily inputs of the small intestine: the perturbed diet together with the swallowed gases, and the
+    microbial inoculum. Instead of sampling these one day at a time, the diet and strain library are
+    parsed once and the inputs of many days are drawn as arrays in one go, then handed out day by day.
+
+    Each kind of draw (diet perturbation, gas volumes, inoculum size, inoculum composition) has its own
+    random stream, and NumPy draws the rows of a batch one after the other from it. The inputs of a day
+    therefore only depend on the seed and on the day, not on how many days are drawn per batch, and are
+    the same as what sample_diet(), sample_gases() and sample_microbial_library() return for that stream.
+    """
+
+    def __init__(self, diet_csv_path, representative_data_path, seed, batch_days=365, variability=0.1,
+                 T=310, R=0.08206, P=1):
+        """
+        Parameters:
+            diet_csv_path (str): Path to the diet CSV file.
+            representative_data_path (str): Path to JSON file with representative strain data, or to a folder
+                of AGORA models to sample the inoculum from all of them (see load_strain_library()).
+            seed (int or np.random.SeedSequence): Seed from which the random streams are derived.
+            batch_days (int): Number of days drawn at a time.
+            variability (float): Relative variability of the diet (see sample_diet()).
+            T (float): Temperature in Kelvin (see sample_gases()).
+            R (float): Ideal gas constant in L·atm/(mol·K).
+            P (float): Total pressure in atm.
+        """
+        self.diet_rng, self.gas_rng, self.size_rng, self.inoculum_rng = [np.random.default_rng(s)
+                                                                          for s in child_seeds(seed, 4)]
+
+        self.metabolite_ids, self.amounts = load_diet(diet_csv_path)
+        self.strain_ids, self.probs = load_strain_library(representative_data_path)
+        self.gas_ids = list(gas_volume_stats.keys())
+        self.gas_means = np.array([mean for mean, std in gas_volume_stats.values()])
+        self.gas_stds = np.array([std for mean, std in gas_volume_stats.values()])
+
+        # Gases come after the diet, so that they take precedence like in sampled_diet.update(sampled_gases)
+        self.metabolite_index = registry.register(list(self.metabolite_ids) + self.gas_ids)
+
+        self.batch_days = batch_days
+        self.variability = variability
+        self.T, self.R, self.P = T, R, P
+        self.N_sim = 10 ** 6
+
+        self._batch_start = None  # stream states from which the current batch was drawn
+        self._metabolites = None
+        self._inocula = None
+        self._day = 0  # position in the current batch
+
+    def _draw_batch(self):
+        rngs = [self.diet_rng, self.gas_rng, self.size_rng, self.inoculum_rng]
+        self._batch_start = [rng.bit_generator.state for rng in rngs]
+        days = self.batch_days
+
+        # Diet (see sample_diet())
+        diet = self.amounts * self.diet_rng.uniform(1 - self.variability, 1 + self.variability,
+                                                    size=(days, len(self.amounts)))
+
+        # Gases (see sample_gases())
+        volumes = np.maximum(0, self.gas_rng.normal(self.gas_means, self.gas_stds, size=(days, len(self.gas_ids))))
+        total_volumes = volumes.sum(axis=1, keepdims=True)
+        gases = 1000 * (volumes / total_volumes) * self.P * (total_volumes / 1000) / (self.R * self.T)
+
+        # Microbial inocula (see sample_microbial_library())
+        N_realistic = self.size_rng.integers(10 ** 9, 10 ** 11, endpoint=True, size=days)
+        sampled_counts = self.inoculum_rng.multinomial(self.N_sim, self.probs, size=days)
+        self._inocula = (sampled_counts / self.N_sim * N_realistic[:, None]).round().astype(np.int64)
+
+        self._metabolites = np.hstack([diet, gases])
+        self._day = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """
+        Returns:
+            tuple: Metabolome of the day's intake (np.ndarray indexed by the metabolite registry) and the
+                day's microbial inoculum (dict of strain file name to cell count).
+        """
+        if self._metabolites is None or self._day == self.batch_days:
+            self._draw_batch()
+        day = self._day
+        self._day += 1
+
+        metabolome = np.zeros(len(registry))
+        metabolome[self.metabolite_index] = self._metabolites[day]
+        inoculum = {self.strain_ids[i] + ".xml": int(self._inocula[day, i])
+                    for i in np.flatnonzero(self._inocula[day] > 0)}
+        return metabolome, inoculum
+
+    def get_state(self):
+        """
+        Returns the stream states the current batch was drawn from and the position in it.
+        """
+        return {"batch_start": self._batch_start, "batch_days": self.batch_days, "day": self._day}
+
+    def set_state(self, state):
+        """
+        Restores the state returned by get_state(), redrawing the current batch.
+        """
+        if state["batch_start"] is None:
+            return
+        for rng, rng_state in zip([self.diet_rng, self.gas_rng, self.size_rng, self.inoculum_rng],
+                                  state["batch_start"]):
+            rng.bit_generator.state = rng_state
+        self.batch_days = state["batch_days"]
+        self._draw_batch()
+        self._day = state["day"]
@@ -1,81 +1,174 @@
 import os
-from cobra.io import read_sbml_model
+import re
 import csv
+import json
+import collections
+import concurrent.futures
+import xml.etree.ElementTree as ET
+from cobra.medium.annotations import compartment_shortlist, excludes, sbo_terms
+from compile_models import file_hash, compiled_dir
 
-# Path to the folder containing all AGORA SBML models
-path_to_agora = "AGORA_1_03_sbml"
-agora_files = os.listdir(path_to_agora)
-
-# Dictionaries to map metabolite names to IDs and vice versa
-metabolites_names_id = dict()
-metabolites_id_names = dict()
-
-# Loop over each AGORA model file
-for file in agora_files:
-    filepath = os.path.join(path_to_agora, file)
-
-    # Load the metabolic model from SBML
-    model = read_sbml_model(filepath)
-    print(file, len(model.exchanges))  # Log the number of exchange reactions
-
-    # For each exchange reaction, extract the metabolite being exchanged
-    for exchange in model.exchanges:
-        metabolite = list(exchange.metabolites.keys())[0]  # Only one metabolite per exchange
-
-        # Map metabolite name → ID(s)
-        if metabolite.name not in metabolites_names_id:
-            metabolites_names_id[metabolite.name] = {metabolite.id}
-        else:
-            metabolites_names_id[metabolite.name].add(metabolite.id)
-
-        # Map metabolite ID → name(s)
-        if metabolite.id not in metabolites_id_names:
-            metabolites_id_names[metabolite.id] = {metabolite.name}
-        else:
-            metabolites_id_names[metabolite.id].add(metabolite.name)
-
-# Load and process the small intestine model
-small_intestine_model = "MODEL1310110020_url_small.xml"
-model = read_sbml_model(small_intestine_model)
-for exchange in model.exchanges:
-    metabolite = list(exchange.metabolites.keys())[0]
-
-    if metabolite.name not in metabolites_names_id:
-        metabolites_names_id[metabolite.name] = {metabolite.id}
-    else:
-        metabolites_names_id[metabolite.name].add(metabolite.id)
+# Per-file record of the exchanged metabolites found by earlier runs, so that a re-run only reads new or
+# changed models
+manifest_path = os.path.join(compiled_dir, "metabolite_index.json")
 
-    if metabolite.id not in metabolites_id_names:
-        metabolites_id_names[metabolite.id] = {metabolite.name}
-    else:
-        metabolites_id_names[metabolite.id].add(metabolite.name)
+# Files written by the indexer (metabolite name → IDs, and ID → names)
+names_to_ids_path = "metabolites_names_to_ids.csv"
+ids_to_names_path = "metabolites_ids_to_names.csv"
 
-# Load and process the large intestine model
-large_intestine_model = "MODEL1310110043_url_large_cleaned.xml"
-model = read_sbml_model(large_intestine_model)
-for exchange in model.exchanges:
-    metabolite = list(exchange.metabolites.keys())[0]
+# SBML escapes of the characters not allowed in IDs, e.g. "__91__" for "["
+_escaped_character = re.compile(r"__(\d+)__")
 
-    if metabolite.name not in metabolites_names_id:
-        metabolites_names_id[metabolite.name] = {metabolite.id}
-    else:
-        metabolites_names_id[metabolite.name].add(metabolite.id)
 
-    if metabolite.id not in metabolites_id_names:
-        metabolites_id_names[metabolite.id] = {metabolite.name}
+def _sbml_id(sid, prefix):
+    # Same conversion as cobra's SBML reader: unescape the characters and clip the prefix
+    sid = _escaped_character.sub(lambda match: chr(int(match.group(1))), sid)
+    return sid[len(prefix):] if sid.startswith(prefix) else sid
+
+
+def exchange_metabolites(filepath):
+    """
+    Lists the (ID, name) pairs of the metabolites exchanged by a model. The SBML file is streamed and
+    only its compartments, species and reactions are looked at; the exchanges are found with the same
+    rules as cobra's model.exchanges (a single metabolite, in the external compartment, and not a
+    demand or sink by its annotation or ID).
+
+    Parameters:
+        filepath (str): Path to the SBML file.
+
+    Returns:
+        list: (metabolite ID, metabolite name) for each exchange reaction.
+    """
+    compartments = []
+    species = dict()  # SBML ID → (cobra ID, name, compartment)
+    boundary = []  # (reaction ID, SBO term, SBML ID of the metabolite) of each single-metabolite reaction
+    for _, element in ET.iterparse(filepath, events=("end",)):
+        tag = element.tag.rsplit("}", 1)[-1]
+        if tag == "compartment":
+            compartments.append(element.get("id"))
+        elif tag == "species":
+            species[element.get("id")] = (_sbml_id(element.get("id"), "M_"), element.get("name", ""),
+                                          element.get("compartment"))
+        elif tag == "reaction":
+            references = {reference.get("species") for reference in element.iter()
+                          if reference.tag.endswith("}speciesReference")}
+            if len(references) == 1:
+                boundary.append((_sbml_id(element.get("id"), "R_"), element.get("sboTerm", "").upper(),
+                                 references.pop()))
+        elif tag == "listOfReactions":
+            break  # nothing after the reactions is needed
+        if tag in ("compartment", "species", "reaction"):
+            element.clear()
+
+    # External compartment (see cobra.medium.find_external_compartment): the one named like it, or else
+    # the one with the most boundary reactions
+    like_external = [c for c in compartments if c in compartment_shortlist["e"] + ["e"]]
+    if len(like_external) == 1:
+        external = like_external[0]
     else:
-        metabolites_id_names[metabolite.id].add(metabolite.name)
-
-# Write the name → ID mapping to a CSV file
-with open("metabolites_names_to_ids.csv", mode="w", newline="") as f:
-    writer = csv.writer(f)
-    writer.writerow(["Metabolite Name", "Metabolites IDs"])
-    for met_name, met_ids in metabolites_names_id.items():
-        writer.writerow([met_name, "; ".join(sorted(met_ids))])
-
-# Write the ID → name mapping to another CSV file
-with open("metabolites_ids_to_names.csv", mode="w", newline="") as f:
-    writer = csv.writer(f)
-    writer.writerow(["Metabolite ID", "Metabolites Names"])
-    for met_id, met_names in metabolites_id_names.items():
-        writer.writerow([met_id, "; ".join(sorted(met_names))])
+        counts = collections.Counter(species[metabolite][2] for _, _, metabolite in boundary)
+        candidates = [c for c in like_external if c in counts] or list(counts)
+        external = max(candidates, key=lambda c: counts[c]) if candidates else None
+
+    other_terms = [term for kind, term in sbo_terms.items() if kind != "exchange"]
+    metabolites = []
+    for reaction_id, sbo_term, metabolite in boundary:
+        if sbo_term != sbo_terms["exchange"]:
+            if sbo_term in other_terms or species[metabolite][2] != external or \
+                    any(word in reaction_id for word in excludes["exchange"]):
+                continue
+        metabolites.append(species[metabolite][:2])
+    return metabolites
+
+
+def _indexed_file(filepath):
+    # Worker task: hash and exchanged metabolites of one file, or None if it cannot be read
+    try:
+        return file_hash(filepath), exchange_metabolites(filepath)
+    except Exception as e:
+        print(f"Skipping {filepath}: {e}")
+        return None
+
+
+def index_files(filepaths, max_workers=None):
+    """
+    Reads the exchanged metabolites of several models, in parallel. Files whose hash is in the manifest
+    of an earlier run are not read again.
+
+    Parameters:
+        filepaths (list): Paths to the SBML files.
+        max_workers (int): Number of worker processes (default: number of CPUs).
+
+    Returns:
+        dict: (metabolite ID, metabolite name) pairs of each file that could be read.
+    """
+    manifest = dict()
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+
+    stale = [path for path in filepaths if path not in manifest or manifest[path]["hash"] != file_hash(path)]
+    if stale:
+        print(f"Indexing {len(stale)} models ({len(filepaths) - len(stale)} unchanged)")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for path, result in zip(stale, executor.map(_indexed_file, stale, chunksize=8)):
+                if result is not None:
+                    manifest[path] = {"hash": result[0], "metabolites": result[1]}
+        os.makedirs(compiled_dir, exist_ok=True)
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+
+    return {path: [tuple(pair) for pair in manifest[path]["metabolites"]] for path in filepaths if path in manifest}
+
+
+def build_index(file_metabolites):
+    """
+    Maps metabolite names to IDs and IDs to names, over all the files.
+
+    Parameters:
+        file_metabolites (dict): (metabolite ID, metabolite name) pairs of each file.
+
+    Returns:
+        tuple: Dictionaries of name → set of IDs, and of ID → set of names.
+    """
+    metabolites_names_id = dict()
+    metabolites_id_names = dict()
+    for metabolites in file_metabolites.values():
+        for met_id, met_name in metabolites:
+            metabolites_names_id.setdefault(met_name, set()).add(met_id)
+            metabolites_id_names.setdefault(met_id, set()).add(met_name)
+    return metabolites_names_id, metabolites_id_names
+
+
+def write_index(metabolites_names_id, metabolites_id_names):
+    # Write the name → ID mapping to a CSV file
+    with open(names_to_ids_path, mode="w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Metabolite Name", "Metabolites IDs"])
+        for met_name, met_ids in metabolites_names_id.items():
+            writer.writerow([met_name, "; ".join(sorted(met_ids))])
+
+    # Write the ID → name mapping to another CSV file
+    with open(ids_to_names_path, mode="w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Metabolite ID", "Metabolites Names"])
+        for met_id, met_names in metabolites_id_names.items():
+            writer.writerow([met_id, "; ".join(sorted(met_names))])
+
+
+if __name__ == "__main__":
+    from multiprocessing import freeze_support
+
+    freeze_support()  # Freeze support for multiprocessing
+
+    # All AGORA SBML models, and the small and large intestine models
+    path_to_agora = "AGORA_1_03_sbml"
+    filepaths = [os.path.join(path_to_agora, file) for file in sorted(os.listdir(path_to_agora))
+                 if file.endswith(".xml")]
+    filepaths += ["MODEL1310110020_url_small.xml", "MODEL1310110043_url_large_cleaned.xml"]
+
+    file_metabolites = index_files([path for path in filepaths if os.path.exists(path)])
+    for path, metabolites in file_metabolites.items():
+        print(path, len(metabolites))  # Log the number of exchange reactions
+
+    write_index(*build_index(file_metabolites))
@@ -0,0 +1,76 @@
+import threading
+import numpy as np
+import pandas as pd
+
+
+class MetaboliteRegistry:
+    """
+    Maps metabolite IDs (e.g. "10fthf[e]") to positions in the dense metabolome vectors held by
+    the compartments. Indices are handed out once and never change, so a model's exchanges can
+    be mapped to an index array when it is first seen and reused for the rest of the run.
+    """
+
+    def __init__(self, metabolite_ids=()):
+        self.ids = []
+        self.index = dict()
+        self._lock = threading.Lock()  # ensemble members running in threads share the registry
+        self.register(metabolite_ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def register(self, metabolite_ids):
+        """
+        Returns the indices of the given metabolites, registering any that are new.
+
+        Parameters:
+            metabolite_ids (iterable): Metabolite IDs.
+
+        Returns:
+            np.ndarray: Index of each metabolite.
+        """
+        indices = []
+        with self._lock:
+            for metabolite in metabolite_ids:
+                if metabolite not in self.index:
+                    self.index[metabolite] = len(self.ids)
+                    self.ids.append(metabolite)
+                indices.append(self.index[metabolite])
+        return np.array(indices, dtype=np.int64)
+
+    def register_diet(self, diet_csv_path):
+        return self.register(pd.read_csv(diet_csv_path)["Metabolite ID"])
+
+    def to_vector(self, metabolites, size=None):
+        """
+        Converts a metabolite → amount dictionary to a dense vector.
+
+        Parameters:
+            metabolites (dict): Amount of each metabolite.
+            size (int): Length of the vector (default: current size of the registry).
+
+        Returns:
+            np.ndarray: Dense vector of amounts.
+        """
+        indices = self.register(metabolites.keys())
+        vector = np.zeros(max(size or 0, len(self.ids)))
+        vector[indices] = list(metabolites.values())
+        return vector
+
+    def to_dict(self, vector, threshold=0.0):
+        """
+        Converts a dense vector back to a metabolite → amount dictionary.
+
+        Parameters:
+            vector (np.ndarray): Dense vector of amounts.
+            threshold (float): Entries whose magnitude is below this value are left out.
+
+        Returns:
+            dict: Amount of each metabolite present.
+        """
+        present = np.flatnonzero((np.abs(vector) >= threshold) & (vector != 0))
+        return dict(zip([self.ids[i] for i in present], vector[present].tolist()))
+
+
+# Registry shared by every compartment of the process
+registry = MetaboliteRegistry()
@@ -0,0 +1,257 @@
+import os
+import re
+import json
+import numpy as np
+import pandas as pd
+
+# Layout of one stored value: time point, index of the row key (metabolite, species, ...) and value
+record_dtype = np.dtype([("t", "<i8"), ("key", "<i4"), ("value", "<f8")])
+# Same layout with single precision values
+record_dtype_float32 = np.dtype([("t", "<i8"), ("key", "<i4"), ("value", "<f4")])
+
+
+class StreamingRecorder:
+    """
+    Append-only recorder for one simulated quantity (metabolome, microbiome or growth rate).
+
+    Every call to record() appends the values of one time point to a binary file of
+    (time, key index, value) records, and any key seen for the first time to a key index file.
+    The cost of a time step therefore does not grow with the length of the simulation. The
+    wide CSV layout (one row per key, one column per time point) is only built by finalise().
+    """
+
+    def __init__(self, filename, resume_from=None, select=None, average=1, float32=False):
+        """
+        Parameters:
+            filename (str): Path of the CSV file written by finalise(). The binary store is kept
+                next to it, in <name>.bin (values) and <name>.keys (one key per line).
+            resume_from (dict): Position returned by position() during an earlier run. The store
+                is cut back to that position and appended to, instead of being started afresh.
+            select (callable): Whether a key is recorded (default: every key).
+            average (int): Number of consecutive time points averaged into one stored time point,
+                at the last of them. A key missing from a time point counts as zero there.
+            float32 (bool): Whether the values are stored in single precision. It must be the same
+                as in the run being resumed.
+        """
+        self.filename = filename
+        stem = os.path.splitext(filename)[0]
+        self.values_file = stem + ".bin"
+        self.keys_file = stem + ".keys"
+        self.select = select
+        self.average = average
+        self.dtype = record_dtype_float32 if float32 else record_dtype
+
+        self.keys = dict()
+        self.records = 0
+        self.integer = True  # whether every recorded value was an integer (e.g. cell counts)
+        self._selected = dict()  # whether each key seen so far is recorded
+        self._window = {"points": 0, "sums": dict(), "t": None}  # time points averaged so far, their sums and last time
+        if resume_from is None:
+            self._values = open(self.values_file, "wb")
+            self._keys = open(self.keys_file, "w", encoding="utf-8")
+            return
+
+        # Anything written after the position was recorded belongs to time points that will be simulated again
+        with open(self.keys_file, "r", encoding="utf-8") as f:
+            keys = f.read().splitlines()[:resume_from["keys"]]
+        self.keys = {key: i for i, key in enumerate(keys)}
+        self.records = resume_from["records"]
+        self.integer = resume_from["integer"]
+        if "window" in resume_from:
+            self._window = dict(resume_from["window"], sums=dict(resume_from["window"]["sums"]))
+        with open(self.keys_file, "w", encoding="utf-8") as f:
+            f.write("".join(key + "\n" for key in keys))
+        with open(self.values_file, "r+b") as f:
+            f.truncate(self.records * self.dtype.itemsize)
+        self._values = open(self.values_file, "ab")
+        self._keys = open(self.keys_file, "a", encoding="utf-8")
+
+    def record(self, t, data):
+        """
+        Appends the values recorded at time 't'.
+
+        Parameters:
+            t (int): Time point of data collection.
+            data (dict or float): Mapping of key to value, or a single value (stored under key 0).
+        """
+        if not isinstance(data, dict):
+            data = {0: data}
+        if self.select is not None:
+            for key in data.keys() - self._selected.keys():
+                self._selected[key] = self.select(str(key))
+            data = {key: value for key, value in data.items() if self._selected[key]}
+
+        if self.average > 1:
+            sums = self._window["sums"]
+            for key, value in data.items():
+                sums[key] = sums.get(key, 0) + value
+            self._window["points"] += 1
+            self._window["t"] = t
+            if self._window["points"] == self.average:
+                self._flush_window()
+            return
+        self._write(t, data)
+
+    def _flush_window(self):
+        # Store the mean of the time points of the current window at the last of them, and start a new window
+        window = self._window
+        self._window = {"points": 0, "sums": dict(), "t": None}
+        self._write(window["t"], {key: value / window["points"] for key, value in window["sums"].items()})
+
+    def _write(self, t, data):
+        new_keys = [str(key) for key in data.keys() if str(key) not in self.keys]
+        for key in new_keys:
+            self.keys[key] = len(self.keys)
+        if new_keys:
+            self._keys.write("".join(key + "\n" for key in new_keys))
+            self._keys.flush()
+
+        records = np.empty(len(data), dtype=self.dtype)
+        records["t"] = t
+        records["key"] = [self.keys[str(key)] for key in data.keys()]
+        records["value"] = list(data.values())
+        self.integer = self.integer and all(isinstance(value, (int, np.integer)) for value in data.values())
+
+        records.tofile(self._values)
+        self._values.flush()
+        self.records += len(records)
+
+    def position(self):
+        """
+        Returns:
+            dict: Number of records and keys written so far, and the time points of the current
+                window if values are averaged, to resume the store from later.
+        """
+        return {"records": self.records, "keys": len(self.keys), "integer": self.integer,
+                "window": dict(self._window, sums=dict(self._window["sums"]))}
+
+    def to_frame(self):
+        """
+        Builds the wide table of everything recorded so far.
+
+        Returns:
+            pd.DataFrame: One row per key (sorted), one column per time point (ascending),
+                NaN where a key was not recorded.
+        """
+        with open(self.keys_file, "r", encoding="utf-8") as f:
+            keys = f.read().splitlines()
+        records = np.fromfile(self.values_file, dtype=self.dtype)
+
+        times, columns = np.unique(records["t"], return_inverse=True)
+        table = np.full((len(keys), len(times)), np.nan, dtype=self.dtype["value"])
+        table[records["key"], columns] = records["value"]
+
+        df = pd.DataFrame(table, index=keys, columns=[str(t) for t in times]).sort_index()
+        if self.integer and not df.isna().values.any():
+            df = df.astype(np.int64)
+        return df
+
+    def finalise(self):
+        """
+        Closes the store and exports it to the CSV layout used by the analysis notebook. If values
+        are averaged, the time points of the last, incomplete, window are stored as their mean.
+        """
+        if self._window["points"]:
+            self._flush_window()
+        self._values.close()
+        self._keys.close()
+        self.to_frame().to_csv(self.filename)
+
+
+class OutputSpec:
+    """
+    Declares what a simulation records: which compartments, which quantities, which metabolites,
+    at what cadence and in what precision. The analytics of the run (see analytics.py) are always
+    computed from every metabolite and every time point.
+    """
+    compartments_available = ("small_intestine", "large_intestine")
+    quantities_available = ("microbiome", "metabolome", "growth")
+    cadences = {"step": 1, "daily": 1, "weekly": 7}  # time points averaged, with one time point per day
+
+    def __init__(self, compartments=compartments_available, quantities=quantities_available, metabolites=None,
+                 metabolite_patterns=None, cadence="step", float32=False):
+        """
+        Parameters:
+            compartments (list): Compartments recorded, among "small_intestine" and "large_intestine".
+            quantities (list): Quantities recorded for each of them, among "microbiome", "metabolome" and
+                "growth" (growth rate of the host).
+            metabolites (list): IDs of the metabolites recorded, e.g. ["ac[e]", "but[e]"]. Every metabolite is
+                recorded if neither these nor patterns are given.
+            metabolite_patterns (list): Regular expressions matching the whole ID of other metabolites
+                recorded, e.g. [r"ppa.*"].
+            cadence (str or int): "step" records every time point (one per simulated day for each
+                compartment), "daily" their daily means (the same here), "weekly" their weekly means, and
+                an int the means of that many time points.
+            float32 (bool): Whether the metabolite amounts and growth rates are stored in single precision.
+                Cell counts are always stored in double precision, as they are beyond the integers that
+                single precision represents exactly.
+        """
+        unknown = set(compartments) - set(self.compartments_available) | \
+            set(quantities) - set(self.quantities_available)
+        if unknown:
+            raise ValueError(f"Unknown compartments or quantities: {sorted(unknown)}")
+        if not isinstance(cadence, int) and cadence not in self.cadences:
+            raise ValueError(f"Unknown cadence {cadence!r}, expected one of {list(self.cadences)} or an int")
+        self.compartments = list(compartments)
+        self.quantities = list(quantities)
+        self.metabolites = None if metabolites is None else list(metabolites)
+        self.metabolite_patterns = None if metabolite_patterns is None else list(metabolite_patterns)
+        self.cadence = cadence
+        self.float32 = float32
+
+        self._metabolite_ids = set(self.metabolites or [])
+        self._metabolite_regex = re.compile("|".join(f"(?:{p})" for p in self.metabolite_patterns)) \
+            if self.metabolite_patterns else None
+
+    @classmethod
+    def from_dict(cls, spec):
+        return cls(**spec)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a spec from a JSON file of the parameters of OutputSpec, e.g.
+        {"compartments": ["large_intestine"], "metabolites": ["ac[e]", "but[e]"], "cadence": "weekly"}.
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+    def to_dict(self):
+        return {"compartments": list(self.compartments), "quantities": list(self.quantities),
+                "metabolites": self.metabolites, "metabolite_patterns": self.metabolite_patterns,
+                "cadence": self.cadence, "float32": self.float32}
+
+    def records(self, compartment, quantity):
+        """
+        Returns:
+            bool: Whether 'quantity' of 'compartment' is recorded.
+        """
+        return compartment in self.compartments and quantity in self.quantities
+
+    def select_metabolite(self, metabolite):
+        """
+        Returns:
+            bool: Whether the amount of 'metabolite' is recorded.
+        """
+        if self.metabolites is None and self._metabolite_regex is None:
+            return True
+        return metabolite in self._metabolite_ids or \
+            (self._metabolite_regex is not None and self._metabolite_regex.fullmatch(metabolite) is not None)
+
+    def recorder(self, filename, compartment, quantity, resume_from=None):
+        """
+        Opens the recorder of 'quantity' of 'compartment'.
+
+        Parameters:
+            filename (str): Path of the CSV file of the recorder.
+            compartment (str): Compartment recorded.
+            quantity (str): Quantity recorded.
+            resume_from (dict): Position of the recorder in the run being resumed.
+
+        Returns:
+            StreamingRecorder: Recorder following the spec.
+        """
+        select = self.select_metabolite if quantity == "metabolome" else None
+        average = self.cadences.get(self.cadence, self.cadence)
+        return StreamingRecorder(filename, resume_from, select=select, average=average,
+                                 float32=self.float32 and quantity != "microbiome")
@@ -1,122 +1,254 @@
-from cobra.io import read_sbml_model
-from ete3 import NCBITaxa
+from compile_models import file_hash, compiled_dir
 from collections import defaultdict
+import xml.etree.ElementTree as ET
+import concurrent.futures
 import os
 import numpy as np
 import json
 
 # Directory containing SBML model files
 model_dir = "AGORA_1_03_sbml"
-# List of all model files with XML extension in the directory
-model_files = [f for f in os.listdir(model_dir) if f.endswith(".xml")]
-# Initialize the NCBITaxa object to fetch taxonomic information
-ncbi = NCBITaxa()
-
-# Map strain IDs to their corresponding model file names
-strain_to_file = {f.split(".")[0]: f for f in model_files}
-# Dictionary to store phylum information for each strain
-strain_to_phylum = {}
-# Dictionary to store strains grouped by phylum
-phylum_to_strains = defaultdict(list)
-
-# Loop over each strain to gather phylum information
-for strain_id in strain_to_file:
+# Reaction IDs and phyla found by earlier runs, so that a re-run only processes new or changed models
+reaction_sets_cache = os.path.join(compiled_dir, "reaction_sets.json")
+taxonomy_cache = os.path.join(compiled_dir, "taxonomy.json")
+
+
+def read_reaction_ids(model_path):
+    """
+    Reads the reaction IDs of an SBML model without building the model: the file is streamed and only
+    the <reaction> elements are looked at.
+
+    Parameters:
+        model_path (str): Path to the SBML file.
+
+    Returns:
+        tuple: Hash of the file and its reaction IDs (list), or None if the file cannot be read.
+    """
     try:
-        # Extract genus and species from strain_id
-        name = strain_id.replace("_", " ").split(" ")[0:2]
-        # Get the taxonomic ID from the strain name using NCBITaxa
-        taxid = ncbi.get_name_translator([" ".join(name)])
-        if not taxid:
-            continue  # Skip if taxonomic ID is not found
-        # Extract taxonomic ID and lineage
-        taxid = list(taxid.values())[0][0]
-        lineage = ncbi.get_lineage(taxid)
-        # Get taxonomic names and ranks along the lineage
-        names = ncbi.get_taxid_translator(lineage)
-        ranks = ncbi.get_rank(lineage)
-        # Extract the phylum name from the lineage
-        phylum = [names[t] for t in lineage if ranks[t] == "phylum"]
-        if phylum:
-            # Assign phylum to strain and add strain to the corresponding phylum list
-            strain_to_phylum[strain_id] = phylum[0]
-            phylum_to_strains[phylum[0]].append(strain_id)
+        reaction_ids = []
+        for _, element in ET.iterparse(model_path, events=("end",)):
+            if element.tag.endswith("}reaction"):
+                reaction_ids.append(element.get("id"))
+            elif element.tag.endswith("}listOfReactions"):
+                break  # nothing after the reactions is needed
+            element.clear()  # elements are only looked at once they are complete
+        return file_hash(model_path), reaction_ids
     except Exception as e:
-        # Log any error that occurs during processing of the strain
-        print(f"Skipping {strain_id}: {e}")
+        print(f"Skipping {model_path}: {e}")
+        return None
+
+
+def load_json(path):
+    if not os.path.exists(path):
+        return dict()
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_json(data, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+
+def reaction_sets(model_files, max_workers=None):
+    """
+    Reads the reaction IDs of every model, in parallel, reusing those of models that have not changed
+    since the last run.
+
+    Parameters:
+        model_files (list): SBML file names in model_dir.
+        max_workers (int): Number of worker processes (default: number of CPUs).
+
+    Returns:
+        dict: Reaction IDs (list) of each model file that could be read.
+    """
+    cache = load_json(reaction_sets_cache)
+    # Only the hash of a cached model has to be computed to know whether it changed
+    stale = [f for f in model_files if f not in cache or cache[f]["hash"] != file_hash(os.path.join(model_dir, f))]
+
+    if stale:
+        print(f"Reading the reactions of {len(stale)} models ({len(model_files) - len(stale)} unchanged)")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            paths = [os.path.join(model_dir, f) for f in stale]
+            for f, result in zip(stale, executor.map(read_reaction_ids, paths, chunksize=8)):
+                if result is not None:
+                    cache[f] = {"hash": result[0], "reactions": result[1]}
+        save_json(cache, reaction_sets_cache)
+
+    return {f: cache[f]["reactions"] for f in model_files if f in cache}
 
-# Dictionary to store the representative strain for each phylum
-representatives = {}
 
-# Loop over each phylum and calculate representative strain based on Jaccard distance
-for phylum, strains in phylum_to_strains.items():
+def strain_phyla(strain_ids):
+    """
+    Looks up the phylum of every strain in the NCBI taxonomy, from the genus and species in its ID. All
+    the names are translated in a few batched queries, and the phylum of every name is cached, so the
+    taxonomy database is only opened for names that were never looked up.
 
-    print("\n", phylum, len(strains))
+    Parameters:
+        strain_ids (list): AGORA strain IDs.
 
-    # If only one strain exists for the phylum, it is automatically the representative
-    if len(strains) == 1:
-        representatives[phylum] = (strains[0], 0, 0)
-        continue
+    Returns:
+        dict: Phylum of each strain whose phylum was found.
+    """
+    # Extract genus and species from every strain ID
+    names = {strain_id: " ".join(strain_id.replace("_", " ").split(" ")[0:2]) for strain_id in strain_ids}
+    cache = load_json(taxonomy_cache)
+    missing = sorted(set(names.values()) - set(cache))
 
-    reaction_sets = []
-    strain_ids = []
+    if missing:
+        from ete3 import NCBITaxa  # only needed when some names were never looked up
 
-    # Loop over strains in the current phylum to gather their reactions
-    for sid in strains:
-        print(sid)
-        model_path = os.path.join(model_dir, strain_to_file[sid])
+        # Initialize the NCBITaxa object to fetch taxonomic information
+        ncbi = NCBITaxa()
         try:
-            # Read the SBML model for the strain
-            model = read_sbml_model(model_path)
-            # Collect reactions for this model
-            reaction_sets.append(set(r.id for r in model.reactions))
-            strain_ids.append(sid)
-        except:
-            continue  # Skip strains that cannot be read
-
-    # If fewer than two reaction sets were found, assign the first strain as representative
-    if len(reaction_sets) < 2:
-        representatives[phylum] = (strain_ids[0], 0, 0)
-        continue
-
-    n = len(reaction_sets)
-    # Initialize a matrix to store pairwise Jaccard distances between reaction sets
-    dist_matrix = np.zeros((n, n))
-
-    # Calculate pairwise Jaccard distances between reaction sets
-    for i in range(n):
-        for j in range(i+1, n):
-            # Jaccard distance = 1 - (intersection size / union size)
-            d = 1 - len(reaction_sets[i] & reaction_sets[j]) / len(reaction_sets[i] | reaction_sets[j])
-            dist_matrix[i, j] = dist_matrix[j, i] = d
-
-    # Calculate average distance for each strain
-    avg_dist = dist_matrix.mean(axis=1)
-    # Find the index of the strain with the smallest average distance
-    rep_idx = np.argmin(avg_dist)
-    # Store the representative strain and distance metrics for the phylum
-    representatives[phylum] = (strain_ids[rep_idx], np.min(avg_dist), np.mean(avg_dist))
-
-# Print the selected representative strain for each phylum
-print("\nRepresentative strains per phylum:")
-for phylum, (strain, min_avg_dist, mean_avg_dist) in representatives.items():
-    print(f"{phylum}: {strain}")
-
-# Define output file path to save the representative strains data
-output_path = "representative_strains.json"
-
-# Prepare data in a format suitable for JSON serialization
-serialisable_dict = {
-    phylum: {
-        "phylum_size": len(phylum_to_strains[phylum]),
-        "representative_strain": strain,
-        "min_jaccard_distance": float(min_dist),
-        "avg_jaccard_distance": float(avg_dist)
+            # Taxonomic IDs of the names, their lineages, and the ranks and names along the lineages
+            taxids = {name: ids[0] for name, ids in ncbi.get_name_translator(missing).items() if ids}
+            lineages = ncbi.get_lineage_translator(list(taxids.values()))
+            lineage_taxids = sorted({t for lineage in lineages.values() for t in lineage})
+            ranks = ncbi.get_rank(lineage_taxids)
+            phylum_names = ncbi.get_taxid_translator([t for t in lineage_taxids if ranks.get(t) == "phylum"])
+        except Exception as e:
+            # Log any error that occurs during the lookup, and try again on the next run
+            print(f"Taxonomy lookup failed: {e}")
+        else:
+            for name in missing:
+                phylum = [phylum_names[t] for t in lineages.get(taxids.get(name), []) if t in phylum_names]
+                cache[name] = phylum[0] if phylum else None  # None: known not to be found
+            save_json(cache, taxonomy_cache)
+
+    return {strain_id: cache[name] for strain_id, name in names.items() if cache.get(name) is not None}
+
+
+def jaccard_distances(reaction_sets, block_size=256):
+    """
+    Computes the pairwise Jaccard distances between reaction sets. The sets are turned into a binary
+    strain × reaction matrix, and the intersection sizes are the entries of its product with its own
+    transpose, computed a block of rows at a time.
+
+    The matrix is dense: scipy is not a dependency of the project, and AGORA strains share a large part
+    of their reactions (from a fifth to a half of the entries are ones), so a sparse product would not save
+    much. The matrix of the largest phylum (a few hundred strains by a few thousand reactions) takes a few
+    MB in float32, the blocks bound the size of the intermediate products, and the products run in BLAS.
+
+    Parameters:
+        reaction_sets (list): Reaction IDs of each strain.
+        block_size (int): Number of strains per block of rows.
+
+    Returns:
+        np.ndarray: Symmetric matrix of the Jaccard distances, with zeros on the diagonal.
+    """
+    reaction_index = dict()
+    rows, cols = [], []
+    for i, reactions in enumerate(reaction_sets):
+        for reaction in set(reactions):
+            rows.append(i)
+            cols.append(reaction_index.setdefault(reaction, len(reaction_index)))
+    # Reaction counts are far below 2^24, so the products are exact in float32
+    matrix = np.zeros((len(reaction_sets), len(reaction_index)), dtype=np.float32)
+    matrix[rows, cols] = 1
+
+    sizes = matrix.sum(axis=1, dtype=np.float64)
+    dist_matrix = np.empty((len(reaction_sets), len(reaction_sets)))
+    for start in range(0, len(reaction_sets), block_size):
+        block = slice(start, start + block_size)
+        intersection = (matrix[block] @ matrix.T).astype(np.float64)
+        union = sizes[block, None] + sizes[None, :] - intersection
+        # Jaccard distance = 1 - (intersection size / union size)
+        dist_matrix[block] = 1 - intersection / union
+    np.fill_diagonal(dist_matrix, 0)
+    return dist_matrix
+
+
+def select_representatives(phylum_to_strains, strain_reactions):
+    """
+    Picks the strain with the smallest average Jaccard distance to the others of its phylum.
+
+    Returns:
+        dict: Representative strain, smallest and mean average distance of every phylum.
+    """
+    representatives = {}
+
+    # Loop over each phylum and calculate representative strain based on Jaccard distance
+    for phylum, strains in phylum_to_strains.items():
+
+        print("\n", phylum, len(strains))
+
+        # If only one strain exists for the phylum, it is automatically the representative
+        if len(strains) == 1:
+            representatives[phylum] = (strains[0], 0, 0)
+            continue
+
+        # Skip strains that cannot be read
+        strain_ids = [sid for sid in strains if sid in strain_reactions]
+
+        # If no strain can be read, the phylum has no representative
+        if not strain_ids:
+            print(f"No readable model for {phylum}, skipping it")
+            continue
+
+        # If only one reaction set was found, its strain is the representative
+        if len(strain_ids) == 1:
+            representatives[phylum] = (strain_ids[0], 0, 0)
+            continue
+
+        dist_matrix = jaccard_distances([strain_reactions[sid] for sid in strain_ids])
+
+        # Calculate average distance for each strain
+        avg_dist = dist_matrix.mean(axis=1)
+        # Find the index of the strain with the smallest average distance
+        rep_idx = np.argmin(avg_dist)
+        # Store the representative strain and distance metrics for the phylum
+        representatives[phylum] = (strain_ids[rep_idx], np.min(avg_dist), np.mean(avg_dist))
+
+    return representatives
+
+
+if __name__ == "__main__":
+    from multiprocessing import freeze_support
+
+    freeze_support()  # Freeze support for multiprocessing
+
+    # List of all model files with XML extension in the directory
+    model_files = sorted(f for f in os.listdir(model_dir) if f.endswith(".xml"))
+    # Map strain IDs to their corresponding model file names
+    strain_to_file = {f.split(".")[0]: f for f in model_files}
+
+    # Group the strains by phylum
+    strain_to_phylum = strain_phyla(list(strain_to_file))
+    phylum_to_strains = defaultdict(list)
+    for strain_id, phylum in strain_to_phylum.items():
+        phylum_to_strains[phylum].append(strain_id)
+
+    # Gather the reactions of the strains that have a phylum
+    reactions = reaction_sets([strain_to_file[sid] for sid in strain_to_phylum])
+    strain_reactions = {sid: reactions[strain_to_file[sid]] for sid in strain_to_phylum
+                        if strain_to_file[sid] in reactions}
+
+    # Dictionary to store the representative strain for each phylum
+    representatives = select_representatives(phylum_to_strains, strain_reactions)
+
+    # Print the selected representative strain for each phylum
+    print("\nRepresentative strains per phylum:")
+    for phylum, (strain, min_avg_dist, mean_avg_dist) in representatives.items():
+        print(f"{phylum}: {strain}")
+
+    # Define output file path to save the representative strains data
+    output_path = "representative_strains.json"
+
+    # Prepare data in a format suitable for JSON serialization
+    serialisable_dict = {
+        phylum: {
+            "phylum_size": len(phylum_to_strains[phylum]),
+            "representative_strain": strain,
+            "min_jaccard_distance": float(min_dist),
+            "avg_jaccard_distance": float(avg_dist)
+        }
+        for phylum, (strain, min_dist, avg_dist) in representatives.items()
     }
-    for phylum, (strain, min_dist, avg_dist) in representatives.items()
-}
 
-# Write the serializable dictionary to a JSON file
-with open(output_path, "w") as f:
-    json.dump(serialisable_dict, f, indent=4)
+    # Write the serializable dictionary to a JSON file
+    with open(output_path, "w") as f:
+        json.dump(serialisable_dict, f, indent=4)
 
-print(f"\nSaved representative strains to {output_path}")
+    print(f"\nSaved representative strains to {output_path}")
@@ -1,8 +1,36 @@
+import functools
 import pandas as pd
 import numpy as np
 
+# Mean and standard deviation of the volume (in mL) of each gas taken in per day
+gas_volume_stats = {
+    "o2[e]": (0.58, 0.43),
+    "co2[e]": (9.7, 2.4),
+    "n2[e]": (64, 52),
+    "h2[e]": (14, 9.9),
+    "ch4[e]": (5.6, 7.6)
+}
 
-def sample_diet(diet_csv_path, variability=0.1):
+
+@functools.lru_cache(maxsize=None)
+def load_diet(diet_csv_path):
+    """
+    Reads a dietary composition file. Each file is only parsed once per process.
+
+    Args:
+        diet_csv_path (str): Path to a CSV file with columns:
+            'Metabolite ID', 'Amount (mmol)'.
+
+    Returns:
+        tuple: Metabolite IDs (tuple) and their nominal amounts in mmol (read-only np.ndarray).
+    """
+    df = pd.read_csv(diet_csv_path)
+    amounts = df["Amount (mmol)"].to_numpy(dtype=np.float64)
+    amounts.flags.writeable = False
+    return tuple(df["Metabolite ID"]), amounts
+
+
+def sample_diet(diet_csv_path, variability=0.1, rng=None):
     """
     Randomly samples metabolite amounts from a dietary composition file,
     assuming fixed nominal amounts with optional variability.
@@ -12,24 +40,26 @@ def sample_diet(diet_csv_path, variability=0.1):
             'Metabolite ID', 'Amount (mmol)'.
         variability (float): Percentage variability to simulate dietary fluctuation.
                              Default is 0.1 (i.e., ±10%).
+        rng (np.random.Generator): Random number generator (default: the global np.random state).
 
     Returns:
         dict: A dictionary where keys are metabolite IDs and values are
               randomly perturbed amounts in mmol.
     """
 
-    df = pd.read_csv(diet_csv_path)
+    if rng is None:
+        rng = np.random.mtrand._rand
 
-    df["Sampled Amount (mmol)"] = df["Amount (mmol)"] * np.random.uniform(
-        1 - variability, 1 + variability, size=len(df)
-    )
+    metabolite_ids, amounts = load_diet(diet_csv_path)
 
-    sampled_amounts = dict(zip(df["Metabolite ID"], df["Sampled Amount (mmol)"]))
+    sampled_amounts = dict(zip(metabolite_ids, amounts * rng.uniform(
+        1 - variability, 1 + variability, size=len(amounts)
+    )))
 
     return sampled_amounts
 
 
-def sample_gases(T=310, R=0.08206, P=1):
+def sample_gases(T=310, R=0.08206, P=1, rng=None):
     """
     Samples gas volumes from normal distributions and converts to mmol.
 
@@ -37,22 +67,18 @@ def sample_gases(T=310, R=0.08206, P=1):
         T (float): Temperature in Kelvin (default: 310 K).
         R (float): Ideal gas constant in L·atm/(mol·K) (default: 0.08206).
         P (float): Total pressure in atm (default: 1 atm).
+        rng (np.random.Generator): Random number generator (default: the global np.random state).
 
     Returns:
         dict: Mapping from gas metabolite ID to amount in mmol.
     """
 
-    gas_volume_stats = {
-        "o2[e]": (0.58, 0.43),
-        "co2[e]": (9.7, 2.4),
-        "n2[e]": (64, 52),
-        "h2[e]": (14, 9.9),
-        "ch4[e]": (5.6, 7.6)
-    }
+    if rng is None:
+        rng = np.random.mtrand._rand
 
     # Sample individual gas volumes in mL
     sampled_volumes_ml = {
-        gas: max(0, np.random.normal(mean, std))  # Clip to avoid negative volumes
+        gas: max(0, rng.normal(mean, std))  # Clip to avoid negative volumes
         for gas, (mean, std) in gas_volume_stats.items()
     }
 
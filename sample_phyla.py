@@ -1,27 +1,22 @@
-import random
+import os
 import json
+import random
+import functools
 import numpy as np
 
 
-def sample_microbial_library(representative_data_path):
+@functools.lru_cache(maxsize=None)
+def load_representative_strains(representative_data_path):
     """
-    Simulates sampling of a large microbial library from a list of phylogenetically
-    representative strains. The sampling probability for each strain is proportional
-    to its phylum size.
-
-    Since directly sampling 10^11 cells can cause integer overflows and memory issues,
-    this function samples a smaller number (10^6) and scales the results up.
+    Reads the representative strains of the phyla with more than two strains, and the probability of
+    sampling each of them (proportional to its phylum size). Each file is only parsed once per process.
 
     Parameters:
         representative_data_path (str): Path to JSON file with representative strain data.
 
     Returns:
-        dict: Mapping of strain ID to estimated cell count (total ≈ 10^11).
+        tuple: Strain IDs (tuple) and their sampling probabilities (read-only np.ndarray).
     """
-    # Define realistic and safe sampling numbers
-    N_realistic = random.randint(10**9, 10**11)  # Target total number of cells (scaled)
-    N_sim = 10**6                                # Safe sample size for multinomial draw
-
     # Load representative strain data from JSON
     with open(representative_data_path, "r") as f:
         representative_data = json.load(f)
@@ -37,9 +32,90 @@ def sample_microbial_library(representative_data_path):
 
     # Convert phylum sizes into probabilities
     probs = np.array(weights) / np.sum(weights)
+    probs.flags.writeable = False
+    return tuple(strain_ids), probs
+
+
+@functools.lru_cache(maxsize=None)
+def load_agora_strains(path_to_agora):
+    """
+    Lists every AGORA strain of a model folder, each with the same sampling probability. Since the
+    representative strains are sampled in proportion to the size of their phylum, sampling the full
+    collection uniformly keeps the same expected share of every phylum. The cleaned copies written
+    next to the models by clean_sbml.py are skipped.
+
+    Parameters:
+        path_to_agora (str): Directory holding the AGORA models.
+
+    Returns:
+        tuple: Strain IDs (tuple, sorted) and their sampling probabilities (read-only np.ndarray).
+    """
+    strain_ids = tuple(sorted(os.path.splitext(file)[0] for file in os.listdir(path_to_agora)
+                              if file.endswith(".xml") and not file.endswith("_cleaned.xml")))
+    probs = np.full(len(strain_ids), 1 / len(strain_ids))
+    probs.flags.writeable = False
+    return strain_ids, probs
+
+
+def load_strain_library(library_path):
+    """
+    Reads the strains a microbial library is sampled from: the representative strains if given their
+    JSON file, or every strain of the AGORA collection if given its folder.
+
+    Parameters:
+        library_path (str): Path to JSON file with representative strain data, or to a folder of AGORA models.
+
+    Returns:
+        tuple: Strain IDs (tuple) and their sampling probabilities (read-only np.ndarray).
+    """
+    if os.path.isdir(library_path):
+        return load_agora_strains(library_path)
+    return load_representative_strains(library_path)
+
+
+def strain_model_folder(library_path, path_to_agora="AGORA_1_03_sbml"):
+    """
+    Returns the folder holding the models of the strains of a microbial library.
+
+    Parameters:
+        library_path (str): Path to JSON file with representative strain data, or to a folder of AGORA models.
+        path_to_agora (str): Directory holding the AGORA models the representative strains are taken from.
+
+    Returns:
+        str: The library itself if it is a folder of models, and otherwise the AGORA models.
+    """
+    return library_path if os.path.isdir(library_path) else path_to_agora
+
+
+def sample_microbial_library(representative_data_path, rng=None):
+    """
+    Simulates sampling of a large microbial library from a list of phylogenetically
+    representative strains. The sampling probability for each strain is proportional
+    to its phylum size.
+
+    Since directly sampling 10^11 cells can cause integer overflows and memory issues,
+    this function samples a smaller number (10^6) and scales the results up.
+
+    Parameters:
+        representative_data_path (str): Path to JSON file with representative strain data, or to a folder
+            of AGORA models to sample from all of them (see load_strain_library()).
+        rng (np.random.Generator): Random number generator (default: the global random and np.random states).
+
+    Returns:
+        dict: Mapping of strain ID to estimated cell count (total ≈ 10^11).
+    """
+    # Define realistic and safe sampling numbers
+    if rng is None:
+        N_realistic = random.randint(10**9, 10**11)  # Target total number of cells (scaled)
+        rng = np.random.mtrand._rand
+    else:
+        N_realistic = int(rng.integers(10**9, 10**11, endpoint=True))
+    N_sim = 10**6                                # Safe sample size for multinomial draw
+
+    strain_ids, probs = load_strain_library(representative_data_path)
 
     # Sample N_sim cells and scale to N_realistic
-    sampled_counts = np.random.multinomial(N_sim, probs)
+    sampled_counts = rng.multinomial(N_sim, probs)
     scaled_counts = (sampled_counts / N_sim * N_realistic).round().astype(np.int64)
 
     # Construct the final result as a dictionary
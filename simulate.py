@@ -1,11 +1,19 @@
 from utilities import *
-from sample_diet import sample_diet, sample_gases
-from sample_phyla import sample_microbial_library
+from input_schedule import InputSchedule
+from sample_phyla import strain_model_folder
+from worker_pool import WorkerPool
+from recorder import OutputSpec
+from analytics import CompartmentSummary, save_summary
+from checkpoint import Checkpointer, load_checkpoint
+from compile_models import use_reduced_models
+from solution_cache import SolutionCache
+from tracing import Tracer, set_tracer, current_tracer, max_rss
+import concurrent.futures
+import contextlib
 import warnings
 import logging
 import time
 import os
-import pandas as pd
 from datetime import datetime
 
 # Suppress warnings during execution
@@ -15,171 +23,308 @@ warnings.filterwarnings("ignore")
 sim_time = datetime.now().strftime('%d-%m-%Y-%H-%M-%S')
 
 
-# Function to record metabolome data into a CSV file
-def record_metabolome(t, metabolome, filename):
-    """
-    Appends the metabolome data at time 't' to the specified file.
-
-    Parameters:
-    - t (int): Time point of data collection.
-    - metabolome (dict): Dictionary containing metabolite data.
-    - filename (str): Path to the CSV file where data will be recorded.
-    """
-    metabolome = pd.DataFrame({str(t): metabolome})
-
-    # Check if file already exists
-    if os.path.exists(filename):
-        df = pd.read_csv(filename, index_col=0)
-        df = df.join(metabolome, how='outer')
-    else:
-        df = metabolome
-
-    # Sort the columns by time (ascending)
-    df = df[sorted(df.columns, key=int)]
-    df.to_csv(filename)
-
-
-# Function to record microbiome data into a CSV file
-def record_microbiome(t, microbiome, filename):
-    """
-    Appends the microbiome data at time 't' to the specified file.
-
-    Parameters:
-    - t (int): Time point of data collection.
-    - microbiome (dict): Dictionary containing microbiome species data.
-    - filename (str): Path to the CSV file where data will be recorded.
-    """
-    microbiome = pd.DataFrame({str(t): microbiome})
-
-    # Check if file already exists
-    if os.path.exists(filename):
-        df = pd.read_csv(filename, index_col=0)
-        df = df.join(microbiome, how='outer')
-    else:
-        df = microbiome
-
-    # Sort the columns by time (ascending)
-    df = df[sorted(df.columns, key=int)]
-
-    df.to_csv(filename)
-
-
-# Function to record growth rate data into a CSV file
-def record_growth_rate(t, growth_rate, filename):
-    """
-    Appends the growth rate data at time 't' to the specified file.
-
-    Parameters:
-    - t (int): Time point of data collection.
-    - growth_rate (float): Growth rate of the microbiome.
-    - filename (str): Path to the CSV file where data will be recorded.
-    """
-    growth_rate_df = pd.DataFrame({str(t): [growth_rate]})
-
-    # Check if file already exists
-    if os.path.exists(filename):
-        df = pd.read_csv(filename, index_col=0)
-        df = df.join(growth_rate_df, how='outer')
-    else:
-        df = growth_rate_df
-
-    # Sort the columns by time (ascending)
-    df = df[sorted(df.columns, key=int)]
-    df.to_csv(filename)
-
-
 # Main simulation function
-def simulate(duration, diet_file, seed=5240):
+def simulate(duration, diet_file, seed=5240, pool=None, prune_threshold=1e-8, run_name=None,
+             results_root="results", verbose=True, checkpoint_every=24, resume=None, solution_cache=None,
+             engine="pool", trace_file=None, host_models=None, strain_library="representative_strains.json",
+             model_cache_mb=None, schedule="pipelined", outputs=None, reuse_tolerance=None):
     """
     Simulates the gut microbiome and metabolome over a specified duration.
 
     Parameters:
     - duration (int): Total duration of the simulation (in hours).
     - diet_file (str): Path to the diet CSV file to sample diet data.
-    - seed (int): Random seed for reproducibility.
+    - seed (int or np.random.SeedSequence): Random seed for reproducibility. Separate streams are
+      derived from it for the daily inputs and for the transit between compartments.
+    - pool (Pool): Worker pool to solve the species models on, of any backend (see worker_pool.create_pool()). If
+      not given, a process pool is started for this simulation and shut down at the end.
+    - prune_threshold (float): Metabolite amounts (in mmol) below this magnitude are dropped from the
+      metabolome after every step, and therefore from the output.
+    - run_name (str): Name of the results folder and prefix of the output files
+      (default: "<start time>_<diet name>").
+    - results_root (str): Directory in which the results folder is created.
+    - verbose (bool): Whether to print the simulation time at every step.
+    - checkpoint_every (int): Interval (in hours) at which the state of the simulation is checkpointed to
+      "<run name>_checkpoint.pkl" in the results folder. The last state is always checkpointed, so a finished
+      run can be extended. None disables checkpointing.
+    - resume (str): Path to a checkpoint of an earlier run with the same diet. The run continues from it, in
+      its results folder, exactly as it would have without the interruption; 'seed' and 'run_name' are then
+      taken from the checkpoint.
+    - solution_cache (SolutionCache): Cache of species FBA solutions, e.g. one shared with other runs. If not
+      given, an in-memory cache is used for this simulation.
+    - engine (str): How the species models of a compartment are solved at every step: "pool" solves one
+      problem per species on the worker pool, "community" solves all of them as one problem in this process,
+      with the species sharing the metabolites of the compartment (see CommunityLP).
+    - trace_file (str): Path of a JSON lines trace of the time spent in every phase of every step (see Tracer).
+      Nothing is traced if not given.
+    - host_models (tuple): SBML files of the small and large intestine host models (default:
+      utilities.small_intestine_model and utilities.large_intestine_model).
+    - strain_library (str): Strains the daily inoculum is sampled from: the JSON file of the representative
+      strains, or a folder of AGORA models to sample from all of them (see load_strain_library()). The models of
+      the species are loaded from that folder, or from utilities.agora_models for the representative strains.
+    - model_cache_mb (float): Memory budget of the AGORA models kept loaded by each worker (in MB). If given, the
+      pool started for this simulation also gives every strain to a single worker (see WorkerPool). Use it
+      with a large strain library; a given pool keeps its own settings.
+    - schedule (str): Order of the compartment steps: "sequential" steps one compartment at a time, "pipelined"
+      solves the species of the small intestine for the next day while the large intestine finishes the current
+      one. Both give exactly the same results.
+    - outputs (OutputSpec): Compartments, quantities and metabolites recorded to the CSV files, at what cadence and
+      in what precision (default: everything, at every time point, in double precision). On resume, the spec of
+      the checkpointed run is used.
+    - reuse_tolerance (float): If given, the last solution of a species is reused instead of solving it again while
+      it is still feasible for the new exchange bounds, and the changes of the bounds cannot have raised its growth
+      rate by more than this fraction (see SolveTracker; pool engine only). With 0, a solution is only reused if
+      it is still optimal. The number of reused solves and the largest bound on the growth rate error they
+      introduced are printed at the end. The exchange fluxes of a reused solution can differ from those of a new
+      solve with the same growth rate, so the results differ from those of a run without reuse. By default every
+      species is solved at every step.
     """
-    np.random.seed(seed)  # Set random seed for reproducibility
+    if schedule not in ("sequential", "pipelined"):
+        raise ValueError(f"Unknown schedule {schedule!r}, expected 'sequential' or 'pipelined'")
+    checkpoint = load_checkpoint(resume) if resume is not None else None
+    if checkpoint is not None and checkpoint["diet_file"] != diet_file:
+        raise ValueError(f"Checkpoint {resume} is of a simulation with {checkpoint['diet_file']}, not {diet_file}")
+    if checkpoint is not None and checkpoint.get("strain_library", "representative_strains.json") != strain_library:
+        raise ValueError(f"Checkpoint {resume} is of a simulation sampling {checkpoint['strain_library']}, "
+                         f"not {strain_library}")
+    if checkpoint is not None and checkpoint.get("reduced_models", use_reduced_models()) != use_reduced_models():
+        variant = "reduced" if checkpoint["reduced_models"] else "full"
+        raise ValueError(f"Checkpoint {resume} is of a simulation with the {variant} models (see compress_models.py), "
+                         f"set USE_REDUCED_MODELS={int(checkpoint['reduced_models'])} to resume it")
+
+    # Derive independent random streams for the inputs and the transit from the seed
+    input_seed, transit_seed = child_seeds(seed, 2)
+    transit_rng = np.random.default_rng(transit_seed)  # Transit between compartments
+    if checkpoint is not None:
+        transit_rng.bit_generator.state = checkpoint["transit_rng"]
 
     logging.getLogger("cobra").setLevel(logging.ERROR)  # Suppress cobra library warnings
 
     # Extract diet name from the diet file for folder naming
     diet_name = diet_file.split("_")[0]
-    folder_name = f"{sim_time}_{diet_name}"
+    if checkpoint is not None:
+        run_name = checkpoint["run_name"]
+    elif run_name is None:
+        run_name = f"{sim_time}_{diet_name}"
 
     # Create directory to store results
-    results_dir = os.path.join("results", folder_name)
+    results_dir = os.path.dirname(resume) if checkpoint is not None else os.path.join(results_root, run_name)
     os.makedirs(results_dir, exist_ok=True)
 
     # Define file paths for saving data
-    small_intestine_metabolome_file = os.path.join(results_dir,
-                                                   f"{sim_time}_{diet_name}_small_intestine_metabolome.csv")
-    small_intestine_microbiome_file = os.path.join(results_dir,
-                                                   f"{sim_time}_{diet_name}_small_intestine_microbiome.csv")
-    large_intestine_metabolome_file = os.path.join(results_dir,
-                                                   f"{sim_time}_{diet_name}_large_intestine_metabolome.csv")
-    large_intestine_microbiome_file = os.path.join(results_dir,
-                                                   f"{sim_time}_{diet_name}_large_intestine_microbiome.csv")
-    small_intestine_growth_file = os.path.join(results_dir, f"{sim_time}_{diet_name}_small_intestine_growth.csv")
-    large_intestine_growth_file = os.path.join(results_dir, f"{sim_time}_{diet_name}_large_intestine_growth.csv")
-
-    # Instantiate small and large intestine objects
-    small_intestine = SmallIntestine()
-    large_intestine = LargeIntestine()
-
-    # Start simulation time
-    t = 0
-
-    # Run the simulation for the specified duration
-    while t < duration:
-
-        si_growth_rates = dict()
-        li_growth_rates = dict()
-
-        # Simulate for small intestine at intervals based on input frequency
-        if t % small_intestine.input_frequency == 0:
-            print(t)
-
-            # Sample diet and gases and update the small intestine
-            sampled_diet = sample_diet(diet_file)
-            sampled_gases = sample_gases()
-            sampled_diet.update(sampled_gases)
-            small_intestine.add_to_metabolome(sampled_diet)
-
-            # Sample microbial library and add to small intestine microbiome
-            sampled_microbes = sample_microbial_library("representative_strains.json")
-            small_intestine.add_to_microbiome(sampled_microbes)
+    summary_file = os.path.join(results_dir, f"{run_name}_summary.json")
+    checkpoint_file = os.path.join(results_dir, f"{run_name}_checkpoint.pkl")
+
+    # Open an append-only recorder for each output file of the spec ("<run name>_<compartment>_<quantity>.csv"),
+    # continuing from the checkpointed positions on resume
+    if checkpoint is not None:
+        outputs = OutputSpec.from_dict(checkpoint["outputs"]) if "outputs" in checkpoint else None
+    outputs = outputs or OutputSpec()
+    positions = checkpoint["recorders"] if checkpoint is not None else dict()
+    recorders = dict()
+    for compartment in OutputSpec.compartments_available:
+        for quantity in OutputSpec.quantities_available:
+            if outputs.records(compartment, quantity):
+                name = f"{compartment}_{quantity}"
+                recorders[name] = outputs.recorder(os.path.join(results_dir, f"{run_name}_{name}.csv"), compartment,
+                                                   quantity, positions.get(name))
+
+    def record(compartment_name, compartment):
+        # Record the quantities of a compartment that are in the spec, and update its analytics. The metabolome is
+        # built from the state vector on every access, so it is only built once.
+        metabolome = compartment.metabolome
+        for quantity, data in (("microbiome", compartment.microbiome), ("metabolome", metabolome),
+                               ("growth", compartment.growth_rate)):
+            if f"{compartment_name}_{quantity}" in recorders:
+                recorders[f"{compartment_name}_{quantity}"].record(t, data)
+        summaries[compartment_name].update(t, compartment.microbiome, metabolome)
+
+    # Analytics of each compartment, updated at every recorded time point and written next to the CSV files
+    summaries = {"small_intestine": CompartmentSummary(), "large_intestine": CompartmentSummary()}
+    if checkpoint is not None:
+        for name, summary in summaries.items():
+            if "summaries" in checkpoint:
+                summary.set_state(checkpoint["summaries"][name])
+            else:
+                # Checkpoint from before the analytics: summarise what was recorded up to it
+                summary.update_from_frames(recorders[f"{name}_microbiome"].to_frame(),
+                                           recorders[f"{name}_metabolome"].to_frame())
+
+    # Trace the phases of every step if asked to
+    set_tracer(Tracer(trace_file) if trace_file is not None else None)
+    tracer = current_tracer()
+
+    # The worker pool, the solver threads and the trace file are released however the simulation ends (they are
+    # released in the reverse order of their creation)
+    with contextlib.ExitStack() as cleanup:
+        cleanup.callback(set_tracer, None)
+        cleanup.callback(tracer.close)
+
+        # Start the worker pool shared by both compartments for the whole simulation
+        owns_pool = pool is None
+        if owns_pool:
+            # A bounded model cache only keeps a high hit rate if each worker sees a fixed share of the strains
+            pool = WorkerPool(model_cache_mb=model_cache_mb, affinity=model_cache_mb is not None)
+            cleanup.callback(pool.shutdown)
+        owns_cache = solution_cache is None
+        if owns_cache:
+            solution_cache = SolutionCache()
+
+        # Daily diet, gases and microbial inoculum, drawn a year at a time. This also registers the diet
+        # metabolites; the host and AGORA exchanges are registered as their models are loaded.
+        inputs = InputSchedule(diet_file, strain_library, input_seed)
+        if checkpoint is not None:
+            inputs.set_state(checkpoint["inputs"])
+
+        # Instantiate small and large intestine objects
+        small_intestine_host, large_intestine_host = host_models or (small_intestine_model, large_intestine_model)
+        path_to_agora = strain_model_folder(strain_library, agora_models)
+        small_intestine = SmallIntestine(pool=pool, prune_threshold=prune_threshold, rng=transit_rng,
+                                         cache=solution_cache, engine=engine, model_path=small_intestine_host,
+                                         reuse_tolerance=reuse_tolerance, path_to_agora=path_to_agora)
+        large_intestine = LargeIntestine(pool=pool, prune_threshold=prune_threshold, rng=transit_rng,
+                                         cache=solution_cache, engine=engine, model_path=large_intestine_host,
+                                         reuse_tolerance=reuse_tolerance, path_to_agora=path_to_agora)
+
+        # Start simulation time
+        t = 0
+        if checkpoint is not None:
+            small_intestine.set_state(checkpoint["small_intestine"])
+            large_intestine.set_state(checkpoint["large_intestine"])
+            t = checkpoint["t"]
+
+        def save_checkpoint(small_intestine_state=None, inputs_state=None):
+            # Taken between two days, when every quantity computed during a day has been used and recorded. If the
+            # small intestine already started the next day, its state and that of the inputs from before are given.
+            checkpointer.save({"run_name": run_name,
+                               "diet_file": diet_file,
+                               "strain_library": strain_library,
+                               "reduced_models": use_reduced_models(),
+                               "t": t,
+                               "small_intestine": small_intestine_state or small_intestine.get_state(),
+                               "large_intestine": large_intestine.get_state(),
+                               "inputs": inputs_state or inputs.get_state(),
+                               "transit_rng": transit_rng.bit_generator.state,
+                               "outputs": outputs.to_dict(),
+                               "recorders": {name: recorder.position() for name, recorder in recorders.items()},
+                               "summaries": {name: summary.get_state() for name, summary in summaries.items()}})
+
+        checkpointer = Checkpointer(checkpoint_file) if checkpoint_every is not None else None
+        last_checkpoint = t
+
+        # Threads waiting for the species solves of a compartment on the worker pool, while the other compartment is
+        # stepped (only with the pipelined schedule)
+        solver_threads = concurrent.futures.ThreadPoolExecutor(max_workers=2) if schedule == "pipelined" else None
+        if solver_threads is not None:
+            cleanup.callback(solver_threads.shutdown)
+
+        def start_small_intestine_day(day):
+            # Take the day's diet and gases, and microbial inoculum, update the small intestine, and start solving
+            # its species
+            if verbose:
+                print(day)
+
+            tracer.set_context(t=day, compartment="small_intestine")
+            with tracer.span("inputs"):
+                sampled_diet, sampled_microbes = next(inputs)
+                small_intestine.add_to_metabolome(sampled_diet)
+                small_intestine.add_to_microbiome(sampled_microbes)
+
+            with tracer.span("metabolise"):
+                return small_intestine.start_metabolise(solver_threads)
+
+        # Run the simulation for the specified duration, a day at a time
+        si_step = None  # Small intestine step of the day, if it was started during the previous day
+        while t < duration:
+            checkpoint_states = (None, None)
 
             # Simulate metabolism and get growth rates for the small intestine
-            si_growth_rates = small_intestine.metabolise()
+            if si_step is None:
+                si_step = start_small_intestine_day(t)
+            tracer.set_context(t=t, compartment="small_intestine")
+            with tracer.span("metabolise"):
+                si_growth_rates = small_intestine.finish_metabolise(si_step)
+            si_step = None
 
             t += small_intestine.output_frequency  # Update time by the small intestine output frequency
 
             # Record data for small intestine
-            record_microbiome(t, small_intestine.microbiome, small_intestine_microbiome_file)
-            record_metabolome(t, small_intestine.metabolome, small_intestine_metabolome_file)
-            record_growth_rate(t, small_intestine.growth_rate, small_intestine_growth_file)
+            with tracer.span("record"):
+                record("small_intestine", small_intestine)
 
-        # Simulate transfer from small intestine to large intestine at specific time intervals
-        if t % small_intestine.input_frequency == 4:
-            print(t)
+            # Simulate transfer from small intestine to large intestine
+            if verbose:
+                print(t)
 
-            small_intestine.transfer(large_intestine, si_growth_rates)
+            tracer.set_context(t=t, compartment="small_intestine")
+            with tracer.span("transfer"):
+                small_intestine.transfer(large_intestine, si_growth_rates)
 
-            # Simulate metabolism for the large intestine
-            li_growth_rates = large_intestine.metabolise()
+            # Start simulating metabolism for the large intestine
+            tracer.set_context(compartment="large_intestine")
+            with tracer.span("metabolise"):
+                li_step = large_intestine.start_metabolise(solver_threads)
 
-            t += large_intestine.output_frequency - 4  # Update time by the large intestine output frequency
+            # The next day of the small intestine only depends on its state after the transfer, so with the pipelined
+            # schedule its species are solved while the large intestine finishes this day. The transit draws, which
+            # both compartments take from the same stream, stay in the order of the sequential schedule.
+            next_day = t + large_intestine.output_frequency - 4
+            if solver_threads is not None and next_day < duration:
+                if checkpointer is not None and next_day - last_checkpoint >= checkpoint_every:
+                    checkpoint_states = (small_intestine.get_state(), inputs.get_state())
+                si_step = start_small_intestine_day(next_day)
 
-            # Record data for large intestine
-            record_microbiome(t, large_intestine.microbiome, large_intestine_microbiome_file)
-            record_metabolome(t, large_intestine.metabolome, large_intestine_metabolome_file)
-            record_growth_rate(t, large_intestine.growth_rate, large_intestine_growth_file)
+            tracer.set_context(t=t, compartment="large_intestine")
+            with tracer.span("metabolise"):
+                li_growth_rates = large_intestine.finish_metabolise(li_step)
 
-        # Simulate further transfer and interactions within large intestine at specific intervals
-        if t % large_intestine.output_frequency == 0:
-            print(t)
+            t = next_day  # Update time by the large intestine output frequency
 
-            large_intestine.transfer(li_growth_rates)
+            # Record data for large intestine
+            with tracer.span("record"):
+                record("large_intestine", large_intestine)
+
+            # Simulate further transfer and interactions within large intestine
+            if verbose:
+                print(t)
+
+            tracer.set_context(t=t, compartment="large_intestine")
+            with tracer.span("transfer"):
+                large_intestine.transfer(li_growth_rates)
+
+            # Checkpoint the state in the background
+            if checkpointer is not None and t - last_checkpoint >= checkpoint_every:
+                tracer.set_context(t=t, compartment=None)
+                with tracer.span("checkpoint"):
+                    save_checkpoint(*checkpoint_states)
+                last_checkpoint = t
+
+            if tracer.enabled:
+                tracer.counter("max_rss", kB=max_rss())
+
+        if checkpointer is not None:
+            if t != last_checkpoint:
+                save_checkpoint()
+            checkpointer.wait()
+
+        # Export the recorded data to the wide CSV files used by the analysis notebook
+        for recorder in recorders.values():
+            recorder.finalise()
+        save_summary(summary_file, summaries)
+
+        failures = solve_failure_report(small_intestine, large_intestine)
+        if failures is not None:
+            print(f"{run_name}: {failures}")
+        reuse = solve_reuse_report(small_intestine, large_intestine)
+        if reuse is not None:
+            print(f"{run_name}: {reuse}")
+
+        if owns_pool:
+            print(pool.report())
+            if pool.affinity:
+                print(model_cache_report(pool))
+        if owns_cache:
+            print(solution_cache.report())
 
 
 # Entry point of the simulation
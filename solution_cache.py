@@ -0,0 +1,251 @@
+import sqlite3
+import hashlib
+import threading
+import collections
+import numpy as np
+import swiglpk
+
+# Version of the cached solutions. Increase it whenever what a solution depends on besides the model, its bounds,
+# the solver version and the settings of the species solves changes, so that solutions stored on disk before are not
+# reused.
+cache_format = 1
+
+
+def solution_version():
+    """
+    Returns:
+        str: Version the solutions computed here are cached under: that of the cache format and of the solver, and
+            the settings of the species solves that can change their results (see utilities.species_iteration_limit).
+    """
+    from utilities import species_iteration_limit, species_time_limit, species_presolve  # utilities imports this
+    return (f"{cache_format}/glpk-{swiglpk.glp_version()}/iterations-{species_iteration_limit}/"
+            f"time-{species_time_limit}/presolve-{species_presolve}")
+
+
+def bounds_key(lower_bounds):
+    """
+    Key of an exchange lower bound vector. The bounds are already quantised (rounded to 3 decimals, and
+    capped at -1e-6), so vectors that give the same FBA problem have the same bytes.
+
+    Parameters:
+        lower_bounds (np.ndarray): Lower bound of each exchange reaction.
+
+    Returns:
+        bytes: Digest of the vector.
+    """
+    return hashlib.blake2b(np.ascontiguousarray(lower_bounds, dtype=np.float64).tobytes(), digest_size=16).digest()
+
+
+class SolutionCache:
+    """
+    Memoises species FBA solutions, keyed by the model (the hash of its SBML file and its variant, see
+    CompiledModel.model_key()), the version of the solutions (see solution_version()) and its exchange lower
+    bounds. A reused model is reset to its initial basis before every solve, so a solution only depends
+    on these and can be returned without solving again.
+
+    Recently used solutions are kept in memory (least recently used ones are evicted first). If a path is
+    given, every solution is also stored in an SQLite database there, which can be shared between runs.
+    """
+
+    def __init__(self, max_entries=10000, path=None, version=None):
+        """
+        Parameters:
+            max_entries (int): Number of solutions kept in memory.
+            path (str): Path of the on-disk database (default: memory only).
+            version (str): Version of the solutions stored and looked up (default: solution_version()).
+        """
+        self.max_entries = max_entries
+        self.path = path
+        self.version = version if version is not None else solution_version()
+        self.memory = collections.OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()  # shared by ensemble members running in threads
+
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            # Databases written before solutions had a version keep them in a "solutions" table, which is ignored
+            self._db.execute("CREATE TABLE IF NOT EXISTS species_solutions (model_hash TEXT, version TEXT, "
+                             "bounds_key BLOB, growth_rate REAL, fluxes BLOB, "
+                             "PRIMARY KEY (model_hash, version, bounds_key))")
+            self._db.commit()
+
+    def _remember(self, key, solution):
+        self.memory[key] = solution
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, model_hash, lower_bounds):
+        """
+        Looks up the solution of a model for the given bounds.
+
+        Parameters:
+            model_hash (str): Key of the model (see CompiledModel.model_key()).
+            lower_bounds (np.ndarray): Lower bound of each exchange reaction.
+
+        Returns:
+            tuple or None: Growth rate and exchange fluxes, or None if the solution is not cached.
+        """
+        key = (model_hash, self.version, bounds_key(lower_bounds))
+        with self._lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return self.memory[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT growth_rate, fluxes FROM species_solutions WHERE model_hash = ? AND "
+                                       "version = ? AND bounds_key = ?", key).fetchone()
+                if row is not None:
+                    solution = (row[0], np.frombuffer(row[1], dtype=np.float64))
+                    self._remember(key, solution)
+                    self.disk_hits += 1
+                    return solution
+
+            self.misses += 1
+            return None
+
+    def put_many(self, entries):
+        """
+        Stores solutions.
+
+        Parameters:
+            entries (list): (model hash, lower bounds, growth rate, exchange fluxes) tuples.
+        """
+        rows = []
+        with self._lock:
+            for model_hash, lower_bounds, growth_rate, fluxes in entries:
+                key = (model_hash, self.version, bounds_key(lower_bounds))
+                fluxes = np.array(fluxes, dtype=np.float64)
+                fluxes.flags.writeable = False
+                self._remember(key, (growth_rate, fluxes))
+                rows.append(key + (growth_rate, fluxes.tobytes()))
+            if self._db is not None and rows:
+                self._db.executemany("INSERT OR REPLACE INTO species_solutions VALUES (?, ?, ?, ?, ?)", rows)
+                self._db.commit()
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "lookups": lookups,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0,
+            "entries": len(self.memory),
+        }
+
+    def report(self):
+        stats = self.stats()
+        return (f"Solution cache: {stats['lookups']} lookups, {stats['hit_rate']:.1%} hit rate "
+                f"({stats['memory_hits']} from memory, {stats['disk_hits']} from disk), "
+                f"{stats['entries']} solutions in memory")
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class SolveTracker:
+    """
+    Remembers the last FBA solution of every species of a compartment, and reuses it instead of solving
+    again while the change of the exchange lower bounds of the species cannot have changed its growth rate by
+    more than a tolerance.
+
+    The bounds are compared with those of the last solve. The solution is only reused if its fluxes are still
+    within the new bounds (the upper bounds never change), so that it is still feasible. Its growth rate can then
+    only be below the optimum, when some uptake it was limited by is now allowed to be larger. The optimal
+    growth rate is a concave function of the bounds, so the marginal growth of every uptake at the last solve
+    bounds how much: by the sum of the marginal growth times the loosening of each bound. Most daily changes
+    are to bounds that did not limit the growth, and the solution is then still optimal. Solutions taken from a
+    SolutionCache come without marginals, and are only reused if none of the uptakes they were limited by was
+    loosened.
+
+    The fluxes of a reused solution that is still optimal are not necessarily those a new solve would find, as
+    FBA problems usually have several optimal flux distributions. Runs that reuse solves therefore do not
+    reproduce runs that do not exactly.
+    """
+
+    def __init__(self, tolerance=0.0):
+        """
+        Parameters:
+            tolerance (float): Largest bound on the growth rate error of a reuse, relative to the growth rate of the
+                last solve. With 0, a solution is only reused if it is still optimal.
+        """
+        self.tolerance = tolerance
+        self.last = dict()  # species → (lower bounds, growth rate, exchange fluxes, marginal growth of the uptakes)
+        self.solves = 0  # solutions remembered
+        self.reused = 0
+        self.max_error = 0.0  # largest bound on the growth rate error of a reuse (in 1/h)
+        self.max_relative_error = 0.0  # same, relative to the growth rate
+
+    def get(self, species, lower_bounds):
+        """
+        Looks up a solution that can be reused for the given bounds.
+
+        Parameters:
+            species (str): AGORA model file name.
+            lower_bounds (np.ndarray): Lower bound of each exchange reaction.
+
+        Returns:
+            tuple or None: Growth rate and exchange fluxes, or None if the species must be solved.
+        """
+        record = self.last.get(species)
+        if record is None:
+            return None
+        solved_bounds, growth_rate, fluxes, marginals = record
+        if len(lower_bounds) != len(solved_bounds) or np.any(fluxes < lower_bounds - 1e-9):
+            return None
+        loosening = solved_bounds - lower_bounds
+        if marginals is None:
+            if np.any(loosening[fluxes <= solved_bounds + 1e-9] > 0):
+                return None
+            error = 0.0
+        else:
+            error = max(0.0, float(marginals @ loosening))
+        if error > self.tolerance * abs(growth_rate):
+            return None
+        self.reused += 1
+        self.max_error = max(self.max_error, error)
+        if error:
+            self.max_relative_error = max(self.max_relative_error, error / abs(growth_rate))
+        return growth_rate, fluxes
+
+    def remember(self, species, lower_bounds, growth_rate, fluxes, marginals=None):
+        """
+        Stores the solution of a species solved for the given bounds.
+
+        Parameters:
+            species (str): AGORA model file name.
+            lower_bounds (np.ndarray): Lower bound of each exchange reaction.
+            growth_rate (float): Optimal growth rate.
+            fluxes (np.ndarray): Flux of each exchange reaction.
+            marginals (np.ndarray): Growth gained per unit of extra uptake allowed through each exchange reaction
+                (the dual value of its lower bound), if known.
+        """
+        self.last[species] = (lower_bounds, growth_rate, fluxes, marginals)
+        self.solves += 1
+
+    def forget(self, species):
+        self.last.pop(species, None)
+
+    def get_state(self):
+        # The stored arrays are never modified, so copying the dictionary is enough
+        return {"last": dict(self.last), "solves": self.solves, "reused": self.reused, "max_error": self.max_error,
+                "max_relative_error": self.max_relative_error}
+
+    def set_state(self, state):
+        self.last = dict(state["last"])
+        self.solves = state["solves"]
+        self.reused = state["reused"]
+        self.max_error = state["max_error"]
+        self.max_relative_error = state["max_relative_error"]
+
+    def stats(self):
+        lookups = self.solves + self.reused
+        return {"solves": self.solves, "reused": self.reused, "reuse_rate": self.reused / lookups if lookups else 0,
+                "max_error": self.max_error, "max_relative_error": self.max_relative_error}
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules live at the top of the repository and read their data files relative to it
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+os.chdir(repo_root)
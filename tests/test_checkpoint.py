@@ -0,0 +1,39 @@
+import os
+import pandas as pd
+from benchmark import host_models
+from worker_pool import create_pool
+from solution_cache import SolutionCache
+from simulate import simulate
+
+diet_file = "keto_diet.csv"
+
+
+def run(duration, results_root, pool, **kwargs):
+    simulate(duration, diet_file, seed=11, pool=pool, results_root=results_root, verbose=False,
+             solution_cache=SolutionCache(), host_models=host_models(), **kwargs)
+
+
+def outputs(directory, run_name):
+    return {file[len(run_name) + 1:]: pd.read_csv(os.path.join(directory, file), index_col=0)
+            for file in sorted(os.listdir(directory)) if file.endswith(".csv")}
+
+
+def test_resume_continues_the_run(tmp_path):
+    pool = create_pool("serial")
+    try:
+        run(48, tmp_path / "full", pool, run_name="full", checkpoint_every=None)
+        run(24, tmp_path / "resumed", pool, run_name="resumed", checkpoint_every=24)
+        checkpoint = tmp_path / "resumed" / "resumed" / "resumed_checkpoint.pkl"
+        assert checkpoint.exists()
+        run(48, tmp_path / "resumed", pool, resume=str(checkpoint), checkpoint_every=24)
+    finally:
+        pool.shutdown()
+
+    expected = outputs(tmp_path / "full" / "full", "full")
+    actual = outputs(tmp_path / "resumed" / "resumed", "resumed")
+    assert expected.keys() == actual.keys()
+    for name, frame in expected.items():
+        # The host LP restored from the checkpoint is factorised afresh, which can change the last digit of its
+        # objective value; the cells and metabolites carried over must be the same
+        exact = not name.endswith("_growth.csv")
+        pd.testing.assert_frame_equal(actual[name], frame, check_exact=exact, rtol=1e-12, atol=0, obj=name)
@@ -0,0 +1,51 @@
+import os
+import numpy as np
+import pytest
+from cobra.io import read_sbml_model
+from benchmark import synthetic_model
+from compile_models import CompiledModel
+from utilities import agora_models
+
+
+def agora_model():
+    files = sorted(file for file in os.listdir(agora_models) if file.endswith(".xml"))
+    if not files:
+        pytest.skip("No AGORA model available")
+    return read_sbml_model(os.path.join(agora_models, files[0]))
+
+
+def synthetic():
+    return synthetic_model("synthetic", ["glc_D[e]", "o2[e]", "nh4[e]", "pi[e]"], 30, 120, 0)
+
+
+@pytest.mark.parametrize("build", [synthetic, agora_model])
+def test_to_cobra_round_trip(build):
+    model = build()
+    rebuilt = CompiledModel.from_cobra(model, source_hash="hash").to_cobra()
+
+    assert [metabolite.id for metabolite in rebuilt.metabolites] == [metabolite.id for metabolite in model.metabolites]
+    assert [reaction.id for reaction in rebuilt.reactions] == [reaction.id for reaction in model.reactions]
+    assert rebuilt.compartments == model.compartments
+    for original, copy in zip(model.reactions, rebuilt.reactions):
+        assert (copy.lower_bound, copy.upper_bound) == (original.lower_bound, original.upper_bound)
+        assert copy.objective_coefficient == original.objective_coefficient
+        assert {metabolite.id: coefficient for metabolite, coefficient in copy.metabolites.items()} == \
+               {metabolite.id: coefficient for metabolite, coefficient in original.metabolites.items()}
+    assert [exchange.id for exchange in rebuilt.exchanges] == [exchange.id for exchange in model.exchanges]
+
+    for exchange in model.exchanges:
+        exchange.lower_bound = -1
+    for exchange in rebuilt.exchanges:
+        exchange.lower_bound = -1
+    expected, actual = model.optimize(), rebuilt.optimize()
+    assert actual.status == expected.status == "optimal"
+    assert np.isclose(actual.objective_value, expected.objective_value, rtol=1e-9, atol=1e-12)
+
+
+def test_save_and_load(tmp_path):
+    compiled = CompiledModel.from_cobra(synthetic(), source_hash="hash")
+    compiled.save(tmp_path / "model.npz")
+    loaded = CompiledModel.load(tmp_path / "model.npz")
+    assert loaded.model_key() == "hash"
+    for key, value in vars(compiled).items():
+        np.testing.assert_array_equal(getattr(loaded, key), value)
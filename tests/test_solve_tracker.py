@@ -0,0 +1,63 @@
+import numpy as np
+from solution_cache import SolveTracker
+
+# Three uptakes: the first limits the growth (its flux is at its bound), the others do not
+bounds = np.array([-10.0, -5.0, -5.0])
+fluxes = np.array([-10.0, -2.0, 0.0])
+marginals = np.array([0.05, 0.0, 0.0])
+
+
+def tracker(tolerance=0.0, with_marginals=True):
+    solve_tracker = SolveTracker(tolerance)
+    solve_tracker.remember("species.xml", bounds, 0.5, fluxes, marginals if with_marginals else None)
+    return solve_tracker
+
+
+def test_unknown_species_is_solved():
+    assert SolveTracker().get("species.xml", bounds) is None
+
+
+def test_same_bounds_are_reused():
+    solve_tracker = tracker()
+    growth_rate, reused_fluxes = solve_tracker.get("species.xml", bounds.copy())
+    assert growth_rate == 0.5
+    np.testing.assert_array_equal(reused_fluxes, fluxes)
+    assert solve_tracker.stats()["reused"] == 1
+
+
+def test_loosening_a_non_limiting_bound_is_reused():
+    for with_marginals in [True, False]:
+        assert tracker(with_marginals=with_marginals).get("species.xml", np.array([-10.0, -8.0, -20.0])) is not None
+
+
+def test_tightening_below_the_fluxes_is_refused():
+    # The solution takes up 2 of the second metabolite, which is no longer allowed
+    assert tracker().get("species.xml", np.array([-10.0, -1.0, -5.0])) is None
+
+
+def test_tightening_above_the_fluxes_is_reused():
+    assert tracker().get("species.xml", np.array([-10.0, -3.0, -1.0])) is not None
+
+
+def test_loosening_a_limiting_bound_is_refused():
+    assert tracker().get("species.xml", np.array([-11.0, -5.0, -5.0])) is None
+    assert tracker(with_marginals=False).get("species.xml", np.array([-11.0, -5.0, -5.0])) is None
+
+
+def test_loosening_within_the_tolerance_is_reused():
+    # Error bound 0.05 * 1 = 0.05, a tenth of the growth rate
+    new_bounds = np.array([-11.0, -5.0, -5.0])
+    assert tracker(tolerance=0.09).get("species.xml", new_bounds) is None
+    solve_tracker = tracker(tolerance=0.1)
+    assert solve_tracker.get("species.xml", new_bounds) is not None
+    assert np.isclose(solve_tracker.max_error, 0.05)
+    assert np.isclose(solve_tracker.max_relative_error, 0.1)
+    # Without marginals the error cannot be bounded, whatever the tolerance
+    assert tracker(tolerance=10, with_marginals=False).get("species.xml", new_bounds) is None
+
+
+def test_changed_exchanges_and_forgotten_species_are_solved():
+    solve_tracker = tracker()
+    assert solve_tracker.get("species.xml", np.array([-10.0, -5.0])) is None
+    solve_tracker.forget("species.xml")
+    assert solve_tracker.get("species.xml", bounds) is None
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+from utilities import capped_multinomial, sample_transit
+
+
+def test_capped_multinomial_respects_caps_and_total():
+    rng = np.random.default_rng(0)
+    caps = np.array([5, 0, 20, 3, 100])
+    propensity = np.array([10.0, 5.0, 1.0, 0.0, 0.1])
+    for n in [0, 1, 7, 28, 128]:
+        drawn = capped_multinomial(n, propensity, caps, rng)
+        assert drawn.sum() == n
+        assert np.all(drawn >= 0) and np.all(drawn <= caps)
+    # Everything: every category is filled up to its cap, whatever its propensity
+    np.testing.assert_array_equal(capped_multinomial(caps.sum(), propensity, caps, rng), caps)
+
+
+def test_capped_multinomial_follows_propensity_below_the_caps():
+    rng = np.random.default_rng(1)
+    propensity = np.array([1.0, 2.0, 7.0])
+    caps = np.array([10 ** 6] * 3)
+    draws = np.array([capped_multinomial(1000, propensity, caps, rng) for _ in range(500)])
+    np.testing.assert_allclose(draws.mean(axis=0), 1000 * propensity / propensity.sum(), rtol=0.02)
+
+
+def test_capped_multinomial_falls_back_to_room():
+    # Only categories without propensity have room left
+    rng = np.random.default_rng(2)
+    drawn = capped_multinomial(6, np.array([1.0, 0.0, 0.0]), np.array([2, 3, 3]), rng)
+    assert drawn.sum() == 6
+    assert drawn[0] == 2
+
+
+@pytest.mark.parametrize("num_cells", [1, 150, 500, 999, 1000, 5000])
+def test_sample_transit_moves_exactly_the_target(num_cells):
+    rng = np.random.default_rng(3)
+    microbiome = {"a": 600, "b": 300, "c": 100, "d": 0}
+    growth_rates = {"a": 0.5, "b": 0.2, "c": 0.1, "d": 0.3}
+    transferred = sample_transit(microbiome, growth_rates, num_cells, rng)
+    assert sum(transferred.values()) == min(num_cells, sum(microbiome.values()))
+    assert all(0 < count <= microbiome[s] for s, count in transferred.items())
+
+
+def test_sample_transit_nothing_to_move():
+    rng = np.random.default_rng(4)
+    assert sample_transit({"a": 10}, {"a": 0.1}, 0, rng) == dict()
+    assert sample_transit({"a": 10}, {"a": 0.1}, -5, rng) == dict()
+    assert sample_transit({"a": 0}, {"a": 0.1}, 5, rng) == dict()
+
+
+def test_sample_transit_washes_out_slow_growers():
+    # Same cell counts: the species with the lowest growth rate loses the most cells on average
+    rng = np.random.default_rng(5)
+    microbiome = {"fast": 1000, "medium": 1000, "slow": 1000}
+    growth_rates = {"fast": 0.6, "medium": 0.3, "slow": 0.1}
+    totals = {s: 0 for s in microbiome}
+    for _ in range(200):
+        for s, count in sample_transit(microbiome, growth_rates, 900, rng).items():
+            totals[s] += count
+    assert totals["slow"] > totals["medium"] > totals["fast"]
+
+
+def test_sample_transit_spares_species_without_weight():
+    # Species without a growth rate have weight 0 and are only touched once all others are empty
+    rng = np.random.default_rng(6)
+    microbiome = {"a": 100, "b": 100, "new": 1000}
+    growth_rates = {"a": 0.5, "b": 0.1}
+    for _ in range(20):
+        assert "new" not in sample_transit(microbiome, growth_rates, 150, rng)
+    transferred = sample_transit(microbiome, growth_rates, 700, rng)
+    assert transferred["a"] == 100 and transferred["b"] == 100 and transferred["new"] == 500
+
+
+def test_sample_transit_is_reproducible():
+    microbiome = {f"s{i}": 50 * (i + 1) for i in range(20)}
+    growth_rates = {f"s{i}": 0.05 * i for i in range(20)}
+    first = sample_transit(microbiome, growth_rates, 2000, np.random.default_rng(7))
+    second = sample_transit(microbiome, growth_rates, 2000, np.random.default_rng(7))
+    assert first == second
@@ -0,0 +1,201 @@
+import os
+import sys
+import json
+import time
+import resource
+import threading
+
+# Tracer of the simulation running in the current thread (simulations of an ensemble run in threads)
+_local = threading.local()
+
+
+def max_rss():
+    """
+    Returns:
+        int: Peak resident set size of this process (in kB).
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss  # bytes on macOS, kB elsewhere
+
+
+class _NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+class NullTracer:
+    """
+    Tracer used when tracing is disabled: every call returns immediately.
+    """
+    enabled = False
+
+    def set_context(self, **values):
+        pass
+
+    def span(self, name, **args):
+        return _null_span
+
+    def complete(self, name, start, duration, pid=None, tid=None, **args):
+        pass
+
+    def counter(self, name, pid=None, **values):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Span:
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.complete(self.name, self.start, time.perf_counter() - self.start, **self.args)
+        return False
+
+    def set(self, **args):
+        """
+        Adds arguments to the event (e.g. results known only at the end of the span).
+        """
+        self.args.update(args)
+
+
+class Tracer:
+    """
+    Writes a trace of the simulation as JSON lines, one event per line. Every event has the fields of a
+    Chrome trace event ("name", "ph", "ts" and "dur" in microseconds, "pid", "tid", "args"), so the file can
+    be diffed between releases as it is, or converted with export_chrome_trace() and opened in a trace viewer
+    (chrome://tracing, Perfetto).
+
+    The values in 'context' (e.g. the simulation time and the compartment) are added to the arguments of
+    every event recorded by the thread that set them. Times are taken with time.perf_counter(), which is the
+    same clock in all the processes of a machine, so events reported by worker processes line up with those
+    of the simulation.
+    """
+    enabled = True
+
+    def __init__(self, path):
+        """
+        Parameters:
+            path (str): Path of the JSON lines file.
+        """
+        self.path = path
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+        self._contexts = threading.local()  # each thread stepping the simulation has a context of its own
+        self._file = open(path, "w", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def _write(self, event):
+        line = json.dumps(event, separators=(",", ":")) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+    @property
+    def context(self):
+        if not hasattr(self._contexts, "values"):
+            self._contexts.values = dict()
+        return self._contexts.values
+
+    def set_context(self, **values):
+        """
+        Sets values added to the arguments of every following event of this thread.
+        """
+        self.context.update(values)
+
+    def span(self, name, **args):
+        """
+        Returns a context manager recording the time spent in it as an event.
+        """
+        return _Span(self, name, args)
+
+    def complete(self, name, start, duration, pid=None, tid=None, **args):
+        """
+        Records an event that started at 'start' (time.perf_counter(), in any process) and lasted 'duration'
+        seconds.
+        """
+        self._write({"name": name, "ph": "X", "ts": round((start - self.origin) * 1e6, 1),
+                     "dur": round(duration * 1e6, 1), "pid": pid or self.pid, "tid": tid or threading.get_ident(),
+                     "args": {**self.context, **args}})
+
+    def counter(self, name, pid=None, **values):
+        """
+        Records the current value of one or more counters (e.g. memory use).
+        """
+        self._write({"name": name, "ph": "C", "ts": round((time.perf_counter() - self.origin) * 1e6, 1),
+                     "pid": pid or self.pid, "args": values})
+
+    def close(self):
+        self._file.close()
+
+
+_null_tracer = NullTracer()
+
+
+def current_tracer():
+    """
+    Returns:
+        Tracer or NullTracer: Tracer of the simulation running in this thread.
+    """
+    return getattr(_local, "tracer", _null_tracer)
+
+
+def set_tracer(tracer):
+    """
+    Makes 'tracer' the tracer of this thread (None disables tracing).
+    """
+    _local.tracer = tracer if tracer is not None else _null_tracer
+
+
+def submit_traced(executor, fn, *args):
+    """
+    Submits fn(*args) to a thread pool, to run with the tracer of this thread and its current context, so that
+    the events of the task are attributed to the step that started it.
+
+    Returns:
+        concurrent.futures.Future: Result of the call.
+    """
+    tracer = current_tracer()
+    context = dict(tracer.context) if tracer.enabled else dict()
+
+    def run():
+        set_tracer(tracer)
+        tracer.set_context(**context)
+        return fn(*args)
+
+    return executor.submit(run)
+
+
+def export_chrome_trace(jsonl_path, output_path):
+    """
+    Converts a JSON lines trace to the Chrome trace (JSON object) format.
+
+    Parameters:
+        jsonl_path (str): Path of the trace written by a Tracer.
+        output_path (str): Path of the Chrome trace file.
+    """
+    with open(jsonl_path, "r", encoding="utf-8") as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+if __name__ == "__main__":
+    export_chrome_trace(sys.argv[1], sys.argv[2])
@@ -1,41 +1,734 @@
 import numpy as np
 import os
-from cobra.io import read_sbml_model
-import random
+from compile_models import read_model, load_compiled_model, file_hash
+from worker_pool import WorkerPool, shared_arrays
+from metabolites import registry
+from community_lp import CommunityLP
+from solution_cache import SolveTracker
+from tracing import current_tracer, submit_traced, max_rss
+import time
+import threading
+import collections
 import concurrent.futures
-import multiprocessing
-import copy
+import swiglpk
+from cobra.io import read_sbml_model
+
+
+# AGORA models loaded by each thread of this process (see _model_cache()). A model must not be used by two threads at
+# once, so the threads of a thread pool each keep their own.
+_model_caches = threading.local()
+
+# Memory the loaded AGORA models of a thread may take (in bytes, None for no limit), see set_model_cache_budget()
+_model_cache_budget = None
+
+# Approximate memory taken by a loaded cobra model per reaction and per metabolite (measured on AGORA models)
+model_bytes_per_element = 3000
+
+# Limits of a species solve. A solve from the initial basis takes about a thousand simplex iterations; one that
+# reaches the iteration limit has stalled on degenerate bounds, and is solved again with the LP presolver (which
+# the solver interface does by itself). The iteration limit does not depend on the speed of the machine, so the
+# results stay reproducible; the time limit (in seconds) is only a backstop, and the only limit with solvers other
+# than GLPK.
+species_iteration_limit = 20000
+species_time_limit = 30
+species_presolve = "auto"  # presolve only when a solve from the current basis fails, as described above
+
+# Folder of the AGORA models, where the representative strains are taken from
+agora_models = "AGORA_1_03_sbml"
+
+# Registry indices of the metabolites exchanged by each AGORA model, in the order of model.exchanges,
+# and the key its solutions are cached under (see CompiledModel.model_key()), keyed by the path of the model
+# (filled in by the parent process)
+_exchange_metabolites = dict()
+_model_hashes = dict()
+
+# Host models of the compartments
+small_intestine_model = "MODEL1310110020_url_small.xml"
+large_intestine_model = "MODEL1310110043_url_large_cleaned.xml"
+
+# Pool used by compartments that were not given one
+_default_pool = None
+
+
+def child_seeds(seed, n):
+    """
+    Derives independent seeds from a seed. Unlike seed.spawn(n), the result does not depend on how often
+    the seed has been spawned from before, so the same seed always gives the same streams.
+
+    Parameters:
+        seed (int or np.random.SeedSequence): Parent seed.
+        n (int): Number of child seeds.
+
+    Returns:
+        list: The child np.random.SeedSequence objects.
+    """
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return [np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key + (i,), pool_size=seed.pool_size)
+            for i in range(n)]
+
+
+def default_pool():
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = WorkerPool()
+    return _default_pool
+
+
+def save_basis(model):
+    if model.solver.interface.__name__ != "optlang.glpk_interface":
+        return None
+    problem = model.solver.problem
+    row_status = [swiglpk.glp_get_row_stat(problem, i) for i in range(1, swiglpk.glp_get_num_rows(problem) + 1)]
+    col_status = [swiglpk.glp_get_col_stat(problem, j) for j in range(1, swiglpk.glp_get_num_cols(problem) + 1)]
+    return row_status, col_status
+
+
+def lp_iterations(model):
+    # Simplex iterations done on the model's LP so far (GLPK only)
+    if model.solver.interface.__name__ != "optlang.glpk_interface":
+        return None
+    return swiglpk.glp_get_it_cnt(model.solver.problem)
+
+
+def restore_basis(model, basis):
+    # Warm-starting from the previous solve can land on a different optimum, so a reused model is put back
+    # on the basis it was loaded with to give the same solution as a freshly parsed one
+    if basis is None:
+        return
+    problem = model.solver.problem
+    row_status, col_status = basis
+    for i, status in enumerate(row_status, start=1):
+        swiglpk.glp_set_row_stat(problem, i, status)
+    for j, status in enumerate(col_status, start=1):
+        swiglpk.glp_set_col_stat(problem, j, status)
+
+
+def _model_cache():
+    # AGORA models loaded by this thread, keyed by model path, least recently used first, and the statistics of the
+    # cache. Each entry holds the model and its exchanges together with the exchange bounds and the LP basis it was
+    # loaded with, so that it can be reset before every reuse, the estimated memory it takes and the key its
+    # solutions are cached under.
+    if not hasattr(_model_caches, "models"):
+        _model_caches.models = collections.OrderedDict()
+        _model_caches.stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+    return _model_caches.models, _model_caches.stats
+
+
+def set_model_cache_budget(megabytes):
+    """
+    Worker initialiser: bounds the memory taken by the AGORA models kept loaded by each thread of this process
+    (a worker process only loads models in one thread). Once the estimated size of the loaded models exceeds
+    it, the least recently used ones are dropped (and loaded again from their compiled or SBML file if they
+    are needed later).
+
+    Parameters:
+    - megabytes (float): Memory budget (in MB), or None for no limit.
+    """
+    global _model_cache_budget
+    _model_cache_budget = megabytes * 1e6 if megabytes is not None else None
+    _evict_models()
+
+
+def _evict_models():
+    # Keeps at least the most recently used model, even if it does not fit in the budget on its own
+    models, stats = _model_cache()
+    while _model_cache_budget is not None and stats["bytes"] > _model_cache_budget and len(models) > 1:
+        _, entry = models.popitem(last=False)
+        stats["bytes"] -= entry[4]
+        stats["evictions"] += 1
+
+
+def model_cache_stats():
+    """
+    Worker task: returns the process ID and the AGORA model cache statistics of this thread.
+    """
+    models, stats = _model_cache()
+    return os.getpid(), {**stats, "models": len(models), "budget": _model_cache_budget}
+
+
+def model_cache_report(pool):
+    """
+    Returns:
+    - str: Summary of the AGORA model caches of the workers of a pool with strain affinity.
+    """
+    stats = [result[1] for result in pool.broadcast(model_cache_stats) if isinstance(result, tuple)]
+    hits = sum(s["hits"] for s in stats)
+    lookups = hits + sum(s["misses"] for s in stats)
+    return (f"Model caches: {lookups} lookups, {hits / lookups if lookups else 0:.1%} hit rate, "
+            f"{sum(s['evictions'] for s in stats)} evictions, "
+            f"{sum(s['models'] for s in stats)} models ({sum(s['bytes'] for s in stats) / 1e6:.0f} MB) "
+            f"loaded across {len(stats)} workers")
+
+
+def load_agora_model(species, path_to_agora=agora_models):
+    models, stats = _model_cache()
+    filepath = os.path.join(path_to_agora, species)
+    if filepath in models:
+        model, exchanges, default_bounds, basis, _, _ = models[filepath]
+        models.move_to_end(filepath)
+        stats["hits"] += 1
+        for exchange, bounds in zip(exchanges, default_bounds):
+            exchange.bounds = bounds
+        restore_basis(model, basis)
+        return model, exchanges
+
+    compiled = load_compiled_model(filepath)
+    if compiled is not None:
+        model, model_key = compiled.to_cobra(), compiled.model_key()
+    else:
+        model, model_key = read_sbml_model(filepath), file_hash(filepath)
+    model.solver.configuration.timeout = species_time_limit
+    model.solver.configuration.presolve = species_presolve
+    if model.solver.interface.__name__ == "optlang.glpk_interface":
+        model.solver.configuration._smcp.it_lim = species_iteration_limit  # not exposed by the solver interface
+    exchanges = list(model.exchanges)
+    size = model_bytes_per_element * (len(model.reactions) + len(model.metabolites))
+    models[filepath] = (model, exchanges, [exchange.bounds for exchange in exchanges], save_basis(model), size,
+                        model_key)
+    stats["misses"] += 1
+    stats["bytes"] += size
+    _evict_models()
+    return model, exchanges
+
+
+def agora_exchange_metabolites(species, path_to_agora=agora_models):
+    # Runs in a worker: loading the model here also warms that worker's model cache. The key returned is that of
+    # the form of the model loaded (full or reduced).
+    model, exchanges = load_agora_model(species, path_to_agora)
+    models, _ = _model_cache()
+    return models[os.path.join(path_to_agora, species)][5], [list(exchange.metabolites.keys())[0].id
+                                                             for exchange in exchanges]
+
+
+def get_exchange_metabolites(species_list, pool, path_to_agora=agora_models):
+    missing = [species for species in species_list if os.path.join(path_to_agora, species) not in _exchange_metabolites]
+    if missing:
+        for species, result in zip(missing, pool.map(agora_exchange_metabolites, [(s, path_to_agora) for s in missing],
+                                                      keys=missing)):
+            if isinstance(result, tuple):
+                filepath = os.path.join(path_to_agora, species)
+                _model_hashes[filepath], metabolites = result
+                _exchange_metabolites[filepath] = registry.register(metabolites)
+    return {species: _exchange_metabolites.get(os.path.join(path_to_agora, species)) for species in species_list}
+
+
+def species_lower_bounds(metabolome, metabolite_indices, biomass, total_biomass, duration):
+    # Each species may take up its biomass share of every available metabolite over the given duration
+    availability = metabolome[metabolite_indices]
+    species_share = availability * (biomass / total_biomass)
+    return np.minimum(-1e-6, np.round(-species_share / (biomass * duration), 3))
+
+
+def optimize_species(model, species):
+    """
+    Solves a species model, raising instead of returning a solution that is not optimal (a failed solve
+    must not be mistaken for zero growth).
+
+    Raises:
+    - TimeoutError: If no solution was found within species_time_limit.
+    - RuntimeError: If the problem has no optimal solution (e.g. it is infeasible).
+    """
+    solution = model.optimize()
+    if solution.status == "time_limit":
+        raise TimeoutError(f"{species}: no solution within {species_time_limit} s")
+    if solution.status != "optimal":
+        raise RuntimeError(f"{species}: solver status {solution.status}")
+    return solution
+
+
+def uptake_marginals(exchanges):
+    # Growth gained per unit of extra uptake allowed through each exchange reaction: the dual value of the upper
+    # bound of its reverse variable, which is minus its lower bound
+    return np.array([exchange.reverse_variable.dual for exchange in exchanges])
+
+
+def _untimed():
+    return None
+
+
+def solve_species(species, lower_bounds, trace=False, marginals=False, path_to_agora=agora_models):
+    """
+    Worker task: solves the FBA problem of one species for the given exchange lower bounds.
+
+    Parameters:
+    - species (str): AGORA model file name.
+    - lower_bounds (np.ndarray): Lower bound of each exchange reaction, in the order of model.exchanges.
+    - trace (bool): Whether to also time the phases of the task.
+    - marginals (bool): Whether to also return the growth gained per unit of extra uptake allowed through each
+      exchange reaction (see SolveTracker).
+    - path_to_agora (str): Folder of the model.
+
+    Returns:
+    - tuple: Growth rate and the flux of each exchange reaction (in mmol/gDCW/h). If 'marginals' is set, followed by
+      the marginal growth of each uptake. If 'trace' is set, followed by a dict with the process ID, the start and
+      duration of loading the model, setting its bounds and solving it (in seconds, on the time.perf_counter()
+      clock), the number of simplex iterations and the peak RSS of the worker (in kB).
+
+    Raises:
+    - TimeoutError, RuntimeError: If the solve fails (see optimize_species()).
+    """
+    # The phases are only timed when tracing
+    clock = time.perf_counter if trace else _untimed
+    start = clock()
+    model, exchanges = load_agora_model(species, path_to_agora)
+    loaded = clock()
+    for exchange, lower_bound in zip(exchanges, lower_bounds.tolist()):
+        exchange.lower_bound = lower_bound
+    bounds_set = clock()
+
+    iterations = lp_iterations(model) if trace else None
+    solution = optimize_species(model, species)
+    exchange_fluxes = solution.fluxes[[exchange.id for exchange in exchanges]].values
+    solved = clock()
+
+    result = (solution.objective_value, exchange_fluxes) + ((uptake_marginals(exchanges),) if marginals else ())
+    if not trace:
+        return result
+    if iterations is not None:
+        iterations = lp_iterations(model) - iterations
+    return result + ({
+        "pid": os.getpid(), "start": start, "load": loaded - start, "set_bounds": bounds_set - loaded,
+        "solve": solved - bounds_set, "iterations": iterations, "max_rss": max_rss()},)
+
+
+def share_species_step(pool, metabolome, metabolite_indices, biomasses, total_biomass, duration, marginals=False):
+    """
+    Publishes a metabolism step of a compartment in memory shared with the workers of the pool (see
+    WorkerPool.publish()): the metabolome, and the biomass of each species and the metabolites it exchanges, which
+    solve_shared_species() tasks work out their bounds from, and a species x metabolite array of exchange fluxes
+    they write their solutions to.
+
+    Parameters:
+    - pool (Pool): Pool the species are solved on.
+    - metabolome (np.ndarray): Metabolome of the compartment (in mmol).
+    - metabolite_indices (list): Registry indices of the metabolites exchanged by each species.
+    - biomasses (list): Biomass of each species (in gDCW).
+    - total_biomass (float): Biomass of the whole microbiome (in gDCW).
+    - duration (float): Length of the step (in hours).
+    - marginals (bool): Whether the tasks also write the marginal growth of each uptake (see SolveTracker).
+
+    Returns:
+    - SharedArrays: The step, to be released with pool.release(), or None if the pool does not share memory with
+      its workers.
+    """
+    if not pool.shares_memory:
+        return None
+    arrays = {"metabolome": metabolome,
+              "biomasses": np.array(biomasses, dtype=np.float64),
+              "scalars": np.array([total_biomass, duration], dtype=np.float64),
+              "offsets": np.cumsum([0] + [len(indices) for indices in metabolite_indices], dtype=np.int64),
+              "indices": np.concatenate([np.zeros(0, dtype=np.int64)] + list(metabolite_indices)),
+              "growth_rates": ((len(biomasses),), np.float64),
+              "fluxes": ((len(biomasses), len(metabolome)), np.float64)}
+    if marginals:
+        arrays["marginals"] = ((len(biomasses), len(metabolome)), np.float64)
+    return pool.publish(arrays)
+
+
+def _shared_indices(step, row):
+    # Registry indices of the metabolites exchanged by a species of a step in shared memory
+    return step["indices"][step["offsets"][row]:step["offsets"][row + 1]]
+
+
+def solve_shared_species(species, step, row, trace=False, marginals=False, path_to_agora=agora_models):
+    """
+    Worker task: solve_species() for a species of a step in shared memory (see share_species_step()). Its lower
+    bounds are worked out from the shared metabolome, and its growth rate and exchange fluxes (and the marginal
+    growth of its uptakes) are written to its row of the shared arrays instead of being sent back.
+
+    Parameters:
+    - species (str): AGORA model file name.
+    - step (str): Name of the shared memory block of the step.
+    - row (int): Index of the species in the step.
+    - trace, marginals, path_to_agora: See solve_species().
+
+    Returns:
+    - dict: Timings of the task if 'trace' is set (see solve_species()), else None.
+
+    Raises:
+    - TimeoutError, RuntimeError: If the solve fails (see optimize_species()).
+    """
+    shared = shared_arrays(step)
+    indices = _shared_indices(shared, row)
+    total_biomass, duration = shared["scalars"].tolist()
+    lower_bounds = species_lower_bounds(shared["metabolome"], indices, shared["biomasses"][row].item(),
+                                        total_biomass, duration)
+    result = solve_species(species, lower_bounds, trace, marginals, path_to_agora)
+    shared["growth_rates"][row] = result[0]
+    shared["fluxes"][row, indices] = result[1]
+    if marginals:
+        shared["marginals"][row, indices] = result[2]
+    return result[-1] if trace else None
+
+
+def shared_solution(step, row):
+    """
+    Returns:
+    - tuple: Solution written to a step in shared memory by a solve_shared_species() task, as solve_species() returns
+      it (without its timings).
+    """
+    indices = _shared_indices(step, row)
+    solution = (step["growth_rates"][row].item(), step["fluxes"][row, indices])
+    return solution + ((step["marginals"][row, indices],) if "marginals" in step else ())
+
+
+def shared_exchanges(step, duration):
+    """
+    Sums the exchanges of the species of a step in shared memory per metabolite (see combine_exchanges()).
+
+    Parameters:
+    - step (SharedArrays): The step (see share_species_step()).
+    - duration (float): Length of the step (in hours).
+
+    Returns:
+    - np.ndarray: Amount of every metabolite exchanged by the species together (in mmol).
+    """
+    # The rows are added in species order, as combine_exchanges() adds the species, so the sums are the same
+    return (step["fluxes"] * step["biomasses"][:, np.newaxis] * duration).sum(axis=0)
+
+
+def solve_species_models(payloads, pool, cache=None, tracker=None, path_to_agora=agora_models, step=None):
+    """
+    Solves the FBA problems of several species on the worker pool, taking the solutions already in the
+    cache from there instead.
+
+    Parameters:
+    - payloads (list): (species, lower bounds) pair of each problem.
+    - pool (Pool): Pool to solve the problems on.
+    - cache (SolutionCache): Cache of solutions (default: solve every problem).
+    - tracker (SolveTracker): Last solutions of the species of the compartment. Species whose bound changes since then
+      cannot change their growth rate by more than its tolerance are not solved again, and the solutions of the
+      others are remembered.
+    - path_to_agora (str): Folder of the models of the species.
+    - step (SharedArrays): Step of the species in memory shared with the workers, in the order of the payloads (see
+      share_species_step()). The problems are then solved by solve_shared_species() tasks, and the solutions of
+      all the species are also found in the step.
+
+    Returns:
+    - list: Growth rate and exchange fluxes of each problem, or the exception raised while solving it.
+    """
+    tracer = current_tracer()
+    results = [None] * len(payloads)
+    if tracker is not None:
+        results = [tracker.get(species, lower_bounds) for species, lower_bounds in payloads]
+    reused = [result is not None for result in results]
+    if cache is not None:
+        results = [result if result is not None else
+                   cache.get(_model_hashes[os.path.join(path_to_agora, species)], lower_bounds)
+                   for result, (species, lower_bounds) in zip(results, payloads)]
+    cached = [result is not None and not was_reused for result, was_reused in zip(results, reused)]
+    unsolved = [i for i, result in enumerate(results) if result is None]
+    unsolved_species = [payloads[i][0] for i in unsolved]  # keys of the workers that have the models loaded
+    options = (tracer.enabled, tracker is not None, path_to_agora)
+    if step is None:
+        solved = pool.map(solve_species, [payloads[i] + options for i in unsolved], keys=unsolved_species)
+    else:
+        solved = [result if isinstance(result, Exception) else
+                  shared_solution(step, i) + ((result,) if tracer.enabled else ()) for i, result in
+                  zip(unsolved, pool.map(solve_shared_species, [(payloads[i][0], step.name, i) + options
+                                                                for i in unsolved], keys=unsolved_species))]
+    if tracer.enabled:
+        solved = [trace_species_solve(tracer, payloads[i][0], result) for i, result in zip(unsolved, solved)]
+
+    new_solutions = []
+    for i, result in zip(unsolved, solved):
+        species, lower_bounds = payloads[i]
+        if isinstance(result, Exception):
+            if tracker is not None:
+                tracker.forget(species)
+        else:
+            if tracker is not None:
+                tracker.remember(species, lower_bounds, *result)
+                result = result[:2]
+            new_solutions.append((_model_hashes[os.path.join(path_to_agora, species)], lower_bounds, result[0],
+                                  result[1]))
+        results[i] = result
+    if tracker is not None:
+        for i in np.flatnonzero(cached):
+            tracker.remember(payloads[i][0], payloads[i][1], *results[i])
+    if cache is not None:
+        cache.put_many(new_solutions)
+    if step is not None:
+        # The solutions that were not solved for go to the step as well. A task that failed may have been stopped
+        # while writing its row.
+        for i, result in enumerate(results):
+            if isinstance(result, Exception):
+                step["fluxes"][i] = 0
+            elif reused[i] or cached[i]:
+                step["growth_rates"][i] = result[0]
+                step["fluxes"][i, _shared_indices(step, i)] = result[1]
+    return results
+
 
+def trace_species_solve(tracer, species, result):
+    # Records the phases timed by a traced solve_species() task, and returns its usual result
+    if isinstance(result, Exception):
+        return result
+    *solution, timings = result
+    start, pid = timings["start"], timings["pid"]
+    tracer.complete("load_model", start, timings["load"], pid=pid, tid=pid, species=species)
+    tracer.complete("set_bounds", start + timings["load"], timings["set_bounds"], pid=pid, tid=pid, species=species)
+    tracer.complete("solve", start + timings["load"] + timings["set_bounds"], timings["solve"], pid=pid, tid=pid,
+                    species=species, iterations=timings["iterations"])
+    tracer.counter("max_rss", pid=pid, kB=timings["max_rss"])
+    return tuple(solution)
 
-def read_sbml_with_timeout(filepath, timeout=5):
-    import concurrent.futures
-    import cobra.io
 
-    def load_model():
-        return cobra.io.read_sbml_model(filepath)
+def solve_community(community, payloads, biomasses, duration, availability, pool, cache=None,
+                    path_to_agora=agora_models):
+    """
+    Solves the FBA problems of several species as one community problem, falling back to solving them one
+    by one (see solve_species_models()) if it has no optimal solution.
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-        future = executor.submit(load_model)
-        try:
-            model = future.result(timeout=timeout)
-            return model
-        except concurrent.futures.TimeoutError:
-            return None
+    Parameters:
+    - community (CommunityLP): Community problem of the species, in the order of the payloads.
+    - payloads (list): (species, lower bounds) pair of each species.
+    - biomasses (list): Biomass of each species (in gDCW).
+    - duration (float): Length of the step (in hours).
+    - availability (np.ndarray): Metabolome of the compartment (in mmol).
+    - pool (Pool): Pool to fall back to.
+    - cache (SolutionCache): Cache of solutions used when falling back.
+    - path_to_agora (str): Folder of the models of the species.
+
+    Returns:
+    - list: Growth rate and exchange fluxes of each species, or the exception raised while solving it.
+    """
+    with current_tracer().span("community_solve") as span:
+        iterations = community.iterations
+        results = community.solve([lower_bounds for species, lower_bounds in payloads], biomasses, duration,
+                                  availability)
+        span.set(iterations=community.iterations - iterations)
+    if results is None:
+        results = solve_species_models(payloads, pool, cache, path_to_agora=path_to_agora)
+    return results
+
+
+def _species_solves(payloads, pool, cache, tracker, path_to_agora, step):
+    with current_tracer().span("species_solves", engine="pool", species=len(payloads)) as span:
+        reused = tracker.reused if tracker is not None else 0
+        results = solve_species_models(payloads, pool, cache, tracker, path_to_agora, step)
+        if tracker is not None:
+            span.set(reused=tracker.reused - reused)
+        return results
+
+
+def start_species_solves(payloads, pool, cache=None, executor=None, tracker=None, path_to_agora=agora_models,
+                         step=None):
+    """
+    Starts solving the FBA problems of several species on the worker pool (see solve_species_models()).
+
+    Parameters:
+    - payloads (list): (species, lower bounds) pair of each problem.
+    - pool (Pool): Pool to solve the problems on.
+    - cache (SolutionCache): Cache of solutions (default: solve every problem).
+    - executor (concurrent.futures.ThreadPoolExecutor): Threads to wait for the pool on. If given, the call returns
+      at once, and the caller can step another compartment while the problems are solved.
+    - tracker (SolveTracker): Last solutions of the species, to reuse while the changes of their bounds do not matter.
+    - path_to_agora (str): Folder of the models of the species.
+    - step (SharedArrays): Step of the species in memory shared with the workers (see solve_species_models()).
+
+    Returns:
+    - list or concurrent.futures.Future: Results of solve_species_models(), or their future if 'executor' is given.
+    """
+    if executor is None:
+        return _species_solves(payloads, pool, cache, tracker, path_to_agora, step)
+    return submit_traced(executor, _species_solves, payloads, pool, cache, tracker, path_to_agora, step)
+
+
+def solve_failure_report(*compartments):
+    """
+    Returns:
+    - str: Summary of the species solves that failed in the given compartments, by species, or None if none did.
+    """
+    failures = sum((compartment.failures for compartment in compartments), collections.Counter())
+    if not failures:
+        return None
+    by_species = collections.defaultdict(list)
+    for (species, kind), count in sorted(failures.items()):
+        by_species[species].append(f"{count} {kind}")
+    return (f"Species solve failures ({sum(failures.values())}, counted as no growth): " +
+            ", ".join(f"{species} ({', '.join(kinds)})" for species, kinds in by_species.items()))
+
+
+def solve_reuse_report(*compartments):
+    """
+    Returns:
+    - str: Number of species solves reused in the given compartments, and the largest bound on the growth rate
+      error that introduced, or None if no compartment reuses solves.
+    """
+    reports = []
+    for compartment in compartments:
+        if compartment.tracker is not None:
+            stats = compartment.tracker.stats()
+            reports.append(f"{type(compartment).__name__}: {stats['reused']} of {stats['reused'] + stats['solves']} "
+                           f"species solves reused, growth rate error at most {stats['max_error']:.3g} /h "
+                           f"({stats['max_relative_error']:.3g} relative)")
+    return "Reused solves: " + "; ".join(reports) if reports else None
+
+
+def combine_exchanges(num_metabolites, metabolite_indices, amounts):
+    """
+    Sums the exchanges of the species of a step per metabolite, in one pass over all of them.
+
+    Parameters:
+    - num_metabolites (int): Size of the metabolome (the metabolite registry).
+    - metabolite_indices (list): Registry indices of the metabolites exchanged by each species.
+    - amounts (list): Amount of each of them exchanged by the species (in mmol).
+
+    Returns:
+    - np.ndarray: Amount of every metabolite exchanged by the species together (in mmol).
+    """
+    if not metabolite_indices:
+        return np.zeros(num_metabolites)
+    # bincount adds the amounts in the order they are given, i.e. species by species, as a loop over the species
+    # would: the sums do not depend on which worker finished first, and are the same from run to run
+    return np.bincount(np.concatenate(metabolite_indices), weights=np.concatenate(amounts), minlength=num_metabolites)
+
+
+def capped_multinomial(n, propensity, caps, rng):
+    """
+    Draws n items over categories with probabilities proportional to 'propensity', without exceeding the
+    cap of any category. Items drawn beyond a cap are drawn again over the categories that still have room
+    (falling back to weighting by room when none of those has a positive propensity), so at most one
+    further draw per category is needed.
+
+    Parameters:
+    - n (int): Number of items to draw (at most sum(caps)).
+    - propensity (np.ndarray): Non-negative weight of each category.
+    - caps (np.ndarray): Maximum count of each category.
+    - rng (np.random.Generator): Random number generator.
+
+    Returns:
+    - np.ndarray: Count drawn for each category.
+    """
+    drawn = np.zeros(len(caps), dtype=np.int64)
+    remaining = n
+    while remaining > 0:
+        room = caps - drawn
+        propensity = np.where(room > 0, propensity, 0)
+        if propensity.sum() <= 0:
+            propensity = room.astype(float)
+        extra = np.minimum(rng.multinomial(remaining, propensity / propensity.sum()), room)
+        drawn += extra
+        remaining -= int(extra.sum())
+    return drawn
+
+
+def sample_transit(microbiome, growth_rates, num_cells_to_transfer, rng):
+    """
+    Draws how many cells of each species are moved out of a compartment, in O(number of species).
+
+    Species i is given the transfer weight w_i = 1 - g_i / sum(g), so slower-growing species are more
+    likely to be washed out. Species without a growth rate get weight 0 and negative weights are clipped
+    to 0. If no species with cells has a positive weight (for example when the total growth is zero, where
+    w_i is undefined) all species are weighted equally.
+
+    The sequential process used before picked a species with probability proportional to w_i and moved a
+    uniform random share U of its remaining cells, until the target was reached. Since E[ln(1 - U)] = -1,
+    after K picks species i keeps on average a fraction exp(-K w_i / sum(w)) of its cells. Here the expected
+    number of retained cells is therefore taken as m_i = N_i exp(-c w_i), with c >= 0 solved (by bisection)
+    so that sum(m_i) equals the number of cells that stay, R = sum(N) - num_cells_to_transfer. Whichever of
+    the retained and the transferred cells is the smaller total is then drawn in one multinomial, with
+    probabilities proportional to m_i or to N_i - m_i respectively (see capped_multinomial). Exactly
+    min(num_cells_to_transfer, sum(N)) cells are transferred, where the sequential process could overshoot
+    the target by up to one pick. When the zero-weight species alone hold more than R cells, all other
+    species are emptied and the remainder is taken from them in proportion to their size.
+
+    Parameters:
+    - microbiome (dict): Cell count of each species.
+    - growth_rates (dict): Growth rate of each species in the last metabolism step.
+    - num_cells_to_transfer (int): Number of cells to move out (nothing is moved if not positive).
+    - rng (np.random.Generator): Random number generator.
+
+    Returns:
+    - dict: Number of cells transferred for each species that lost cells.
+    """
+    species = list(microbiome.keys())
+    counts = np.array([microbiome[s] for s in species], dtype=np.int64)
+    num_cells = int(min(max(num_cells_to_transfer, 0), counts.sum()))
+    if num_cells == 0:
+        return dict()
+    num_retained = int(counts.sum()) - num_cells
+
+    total_growth = sum(growth_rates.values())
+    if total_growth != 0:
+        weights = np.array([1 - growth_rates[s] / total_growth if s in growth_rates else 0 for s in species])
+    else:
+        weights = np.array([1.0 if s in growth_rates else 0 for s in species])
+    weights = np.clip(weights, 0, None)
+    if not np.any(weights[counts > 0] > 0):
+        weights = np.ones(len(species))
+    weights = weights / weights.max()
+
+    # Solve sum(N_i exp(-c w_i)) = R for c; the sum decreases with c towards the cells of zero-weight species
+    def expected_retained(c):
+        return counts * np.exp(-c * weights)
+
+    high = 1.0
+    while expected_retained(high).sum() > num_retained and high < 1e4:
+        high *= 2
+    low = 0.0
+    for _ in range(100):
+        middle = (low + high) / 2
+        if expected_retained(middle).sum() > num_retained:
+            low = middle
+        else:
+            high = middle
+    expected = expected_retained(high)
+
+    # Drawing the smaller side keeps the sampling noise small relative to it
+    if num_retained <= num_cells:
+        transferred = counts - capped_multinomial(num_retained, expected, counts, rng)
+    else:
+        transferred = capped_multinomial(num_cells, counts - expected, counts, rng)
+    return {s: int(count) for s, count in zip(species, transferred) if count != 0}
 
 
 class SmallIntestine:
 
-    def __init__(self):
-        self.metabolome = dict()  # in mmol
+    def __init__(self, pool=None, prune_threshold=1e-8, rng=None, cache=None, engine="pool",
+                 model_path=small_intestine_model, reuse_tolerance=None, path_to_agora=agora_models):
         self.microbiome = dict()  # in cell counts
-        self.model = read_sbml_model("MODEL1310110020_url_small.xml")
+        self.model = read_model(model_path)
+        self.exchanges = list(self.model.exchanges)
+        self.exchange_ids = [exchange.id for exchange in self.exchanges]
+        self.exchange_index = registry.register([list(exchange.metabolites.keys())[0].id
+                                                 for exchange in self.exchanges])
+        self.state = np.zeros(len(registry))  # in mmol, indexed by the metabolite registry
+        self.prune_threshold = prune_threshold  # in mmol, smaller amounts are dropped after every step
+        self.pool = pool if pool is not None else default_pool()
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.cache = cache  # SolutionCache of the species FBA solutions, if any
+        self.path_to_agora = path_to_agora  # folder of the species models
+        self.engine = engine  # "pool" (one problem per species, on the workers) or "community" (one joint problem)
+        self.community = None  # CommunityLP of the species present, for the community engine
+        # Last solution of every species, reused while the changes of its bounds do not matter (pool engine)
+        self.tracker = SolveTracker(reuse_tolerance) if reuse_tolerance is not None else None
+        self.failures = collections.Counter()  # failed species solves, by (species, "load"/"timeout"/"error")
         self.growth_rate = float
         self.input_frequency = 24  # in hours
         self.output_frequency = 4  # in hours
         self.biomass = 640  # in gDCW
 
+    @property
+    def metabolome(self):
+        return registry.to_dict(self.state, self.prune_threshold)
+
+    @metabolome.setter
+    def metabolome(self, metabolites):
+        self.state = registry.to_vector(metabolites)
+
+    def expand_state(self):
+        # The registry may have grown since the state vector was allocated
+        if len(self.state) < len(registry):
+            self.state = np.concatenate([self.state, np.zeros(len(registry) - len(self.state))])
+
     def add_to_metabolome(self, metabolites):
-        self.metabolome = metabolites
+        if isinstance(metabolites, dict):
+            self.metabolome = metabolites
+        else:
+            self.state = np.array(metabolites, dtype=np.float64)
 
     def add_to_microbiome(self, microbes):
         for microbe in microbes.keys():
@@ -44,44 +737,49 @@ class SmallIntestine:
             else:
                 self.microbiome[microbe] = microbes[microbe]
 
-    def process_species(self, metabolome, species, total_biomass):
-        path_to_agora = "AGORA_1_03_sbml"
-        filepath = os.path.join(path_to_agora, species)
-
-        try:
-            model = read_sbml_with_timeout(filepath)
-            bacterial_cell_volume = 1e-12  # in cm^3
-            dry_weight_per_unit_volume = 0.33  # in gDCW/cm^3
-            biomass = self.microbiome[species] * bacterial_cell_volume * dry_weight_per_unit_volume  # in gDCW
-
-            for exchange in model.exchanges:
-                metabolite = list(exchange.metabolites.keys())[0].id
-                if metabolite in metabolome.keys():
-                    availability = metabolome[metabolite]
-                    species_share = availability * (biomass / total_biomass)
-                    exchange.lower_bound = min(-1e-6, round(-species_share / (biomass * self.output_frequency), 3))
-                else:
-                    exchange.lower_bound = -1e-6
-
-            solution = model.optimize()
-            growth_rate = solution.objective_value
-            new_cell_count = int(self.microbiome[species] * np.exp(growth_rate * self.output_frequency))
-            self.microbiome[species] = new_cell_count
+    def get_state(self):
+        """
+        Returns a copy of everything that is carried over from one step to the next: the microbiome, the
+        metabolome (by metabolite ID, so it does not depend on the registry order), the host growth rate, the
+        LP basis of the host model, which the next host solve is warm-started from, and the last solutions of
+        the species if they are reused.
+        """
+        present = np.flatnonzero(self.state)
+        return {"microbiome": dict(self.microbiome),
+                "metabolite_ids": [registry.ids[i] for i in present],
+                "metabolite_amounts": self.state[present].copy(),
+                "growth_rate": self.growth_rate,
+                "basis": save_basis(self.model),
+                "tracker": self.tracker.get_state() if self.tracker is not None else None}
 
-            exchanges = dict()
-            for exchange in model.exchanges:
-                metabolite = list(exchange.metabolites.keys())[0].id
-                exchange_flux = solution[exchange.id]
-                exchange_amount = exchange_flux * biomass * self.output_frequency
-                exchanges[metabolite] = exchange_amount
+    def set_state(self, state):
+        """
+        Restores the state returned by get_state().
+        """
+        self.microbiome = dict(state["microbiome"])
+        indices = registry.register(state["metabolite_ids"])
+        self.state = np.zeros(len(registry))
+        self.state[indices] = state["metabolite_amounts"]
+        self.growth_rate = state["growth_rate"]
+        restore_basis(self.model, state["basis"])
+        if self.tracker is not None and state.get("tracker") is not None:
+            self.tracker.set_state(state["tracker"])
 
-            return species, growth_rate, exchanges
+    def metabolise(self):
+        return self.finish_metabolise(self.start_metabolise())
 
-        except:
-            return species, 0, dict()
+    def start_metabolise(self, executor=None):
+        """
+        First half of a metabolism step: works out the uptake bounds of every species from the metabolome, and
+        starts solving their models (see start_species_solves()). The community problem is always solved before
+        returning, as the LP solver must only be used from the thread that owns the models.
 
-    def metabolise(self):
+        Parameters:
+        - executor (concurrent.futures.ThreadPoolExecutor): Threads to wait for the worker pool on.
 
+        Returns:
+        - dict: The step, to be passed to finish_metabolise().
+        """
         total_biomass = 0
         for species in self.microbiome.keys():
             bacterial_cell_volume = 1e-12  # in cm^3
@@ -90,89 +788,155 @@ class SmallIntestine:
             total_biomass += biomass
 
         growth_rates = {species: 0 for species in self.microbiome.keys()}
-        combined_exchanges = {}
-
-        num_cpus = os.cpu_count()
-        current_metabolome = copy.deepcopy(self.metabolome)
-        with concurrent.futures.ProcessPoolExecutor(max_workers=num_cpus) as executor:
-            futures = {executor.submit(self.process_species, current_metabolome, species, total_biomass): species for
-                       species in self.microbiome.keys()}
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    species, growth_rate, exchanges = future.result()
-                    if growth_rate is not None:
-                        growth_rates[species] = growth_rate
-                    for metabolite, amount in exchanges.items():
-                        combined_exchanges[metabolite] = combined_exchanges.get(metabolite, 0) + amount
-                except:
-                    continue
-
-        for metabolite, amount in combined_exchanges.items():
-            if metabolite in self.metabolome and self.metabolome[metabolite] + amount != 0:
-                self.metabolome[metabolite] += amount
-            elif metabolite not in self.metabolome and amount != 0:
-                self.metabolome[metabolite] = amount
-
-        model = self.model
-        for exchange in model.exchanges:
-            metabolite = list(exchange.metabolites.keys())[0].id
-            if metabolite in self.metabolome:
-                availability = self.metabolome[metabolite]
-                exchange.lower_bound = min(-1e-6, round(-availability / (self.biomass * self.output_frequency), 3))
-            else:
-                exchange.lower_bound = -1e-6
-        solution = model.optimize()
-        self.growth_rate = solution.objective_value
-        for exchange in model.exchanges:
-            metabolite = list(exchange.metabolites.keys())[0].id
-            exchange_flux = solution[exchange.id]
-            exchange_amount = exchange_flux * self.biomass * self.output_frequency
-            if metabolite in self.metabolome:
-                self.metabolome[metabolite] += exchange_amount
-            elif metabolite not in self.metabolome and exchange_amount != 0:
-                self.metabolome[metabolite] = exchange_amount
+
+        tracer = current_tracer()
+        with tracer.span("exchange_metabolites"):
+            exchange_metabolites = get_exchange_metabolites(list(self.microbiome.keys()), self.pool,
+                                                            self.path_to_agora)
+        self.expand_state()
+        solved_species = [species for species in self.microbiome.keys() if exchange_metabolites[species] is not None]
+        for species in self.microbiome.keys():
+            if exchange_metabolites[species] is None:
+                self.failures[species, "load"] += 1
+        biomasses = []
+        payloads = []
+        for species in solved_species:
+            bacterial_cell_volume = 1e-12  # in cm^3
+            dry_weight_per_unit_volume = 0.33  # in gDCW/cm^3
+            biomass = self.microbiome[species] * bacterial_cell_volume * dry_weight_per_unit_volume  # in gDCW
+            lower_bounds = species_lower_bounds(self.state, exchange_metabolites[species], biomass,
+                                                total_biomass, self.output_frequency)
+            biomasses.append(biomass)
+            payloads.append((species, lower_bounds))
+
+        shared = None
+        if self.engine == "community" and solved_species:
+            with tracer.span("species_solves", engine=self.engine, species=len(payloads)):
+                if self.community is None or self.community.species_list != solved_species:
+                    self.community = CommunityLP(solved_species, self.path_to_agora)
+                results = solve_community(self.community, payloads, biomasses, self.output_frequency, self.state,
+                                          self.pool, self.cache, self.path_to_agora)
+        else:
+            # With a process pool, the workers read the metabolome and write their solutions in shared memory
+            if solved_species:
+                shared = share_species_step(self.pool, self.state,
+                                            [exchange_metabolites[species] for species in solved_species], biomasses,
+                                            total_biomass, self.output_frequency, self.tracker is not None)
+            results = start_species_solves(payloads, self.pool, self.cache, executor, self.tracker,
+                                           self.path_to_agora, shared)
+        return {"growth_rates": growth_rates, "exchange_metabolites": exchange_metabolites,
+                "solved_species": solved_species, "biomasses": biomasses, "results": results,
+                "shared": shared}
+
+    def finish_metabolise(self, step):
+        """
+        Second half of a metabolism step: waits for the species solutions, and applies their exchanges and
+        those of the host to the metabolome.
+
+        Parameters:
+        - step (dict): The step returned by start_metabolise().
+
+        Returns:
+        - dict: Growth rate of each species.
+        """
+        growth_rates, exchange_metabolites = step["growth_rates"], step["exchange_metabolites"]
+        results = step["results"]
+        if isinstance(results, concurrent.futures.Future):
+            results = results.result()
+        tracer = current_tracer()
+
+        # Results are combined in species order, so the outcome does not depend on which worker finishes first
+        metabolite_indices, amounts = [], []
+        for species, biomass, result in zip(step["solved_species"], step["biomasses"], results):
+            if isinstance(result, Exception):
+                self.failures[species, "timeout" if isinstance(result, TimeoutError) else "error"] += 1
+                continue
+            growth_rate, exchange_fluxes = result
+            growth_rates[species] = growth_rate
+            if step["shared"] is None:
+                metabolite_indices.append(exchange_metabolites[species])
+                amounts.append(exchange_fluxes * biomass * self.output_frequency)
+        if step["shared"] is None:
+            self.state += combine_exchanges(len(self.state), metabolite_indices, amounts)
+        else:
+            self.state += shared_exchanges(step["shared"], self.output_frequency)
+            self.pool.release(step["shared"])
+
+        availability = self.state[self.exchange_index]
+        lower_bounds = np.minimum(-1e-6, np.round(-availability / (self.biomass * self.output_frequency), 3))
+        with tracer.span("host_solve") as span:
+            for exchange, lower_bound in zip(self.exchanges, lower_bounds.tolist()):
+                exchange.lower_bound = lower_bound
+            iterations = lp_iterations(self.model) if tracer.enabled else None
+            solution = self.model.optimize()
+            self.growth_rate = solution.objective_value
+            exchange_fluxes = solution.fluxes[self.exchange_ids].values
+            if iterations is not None:
+                span.set(iterations=lp_iterations(self.model) - iterations)
+        self.state[self.exchange_index] += exchange_fluxes * self.biomass * self.output_frequency
+
+        self.state[np.abs(self.state) < self.prune_threshold] = 0
 
         return growth_rates
 
     def transfer(self, LargeIntestine, growth_rates):
 
-        LargeIntestine.add_to_metabolome(self.metabolome)
-        self.metabolome = dict()
-
-        total_microbiome_growth = sum(growth_rates.values())
-        transfer_probability = {species: 1 - (gr / total_microbiome_growth) for species, gr in growth_rates.items()}
-        num_cells_to_transfer = sum(self.microbiome.values()) - random.randint(10 ** 3, 10 ** 8)
-        cells_transferred = {species: 0 for species in self.microbiome.keys()}
-        num_cells_transferred = 0
-        while num_cells_transferred < num_cells_to_transfer:
-            chosen_species = \
-                random.choices(list(transfer_probability.keys()), weights=list(transfer_probability.values()), k=1)[0]
-            num_species_cells_transferred = random.randint(0, self.microbiome[chosen_species])
-            self.microbiome[chosen_species] -= num_species_cells_transferred
-            num_cells_transferred += num_species_cells_transferred
-            cells_transferred[chosen_species] += num_species_cells_transferred
-        cells_transferred = {species: count for species, count in cells_transferred.items() if count != 0}
+        LargeIntestine.add_to_metabolome(self.state)
+        self.state = np.zeros(len(registry))
+
+        cells_retained = int(self.rng.integers(10 ** 3, 10 ** 8, endpoint=True))
+        num_cells_to_transfer = sum(self.microbiome.values()) - cells_retained
+        cells_transferred = sample_transit(self.microbiome, growth_rates, num_cells_to_transfer, self.rng)
+        for species, count in cells_transferred.items():
+            self.microbiome[species] -= count
         LargeIntestine.add_to_microbiome(cells_transferred)
         self.microbiome = {species: count for species, count in self.microbiome.items() if count != 0}
 
 
 class LargeIntestine:
 
-    def __init__(self):
-        self.metabolome = dict()  # in mmol
+    def __init__(self, pool=None, prune_threshold=1e-8, rng=None, cache=None, engine="pool",
+                 model_path=large_intestine_model, reuse_tolerance=None, path_to_agora=agora_models):
         self.microbiome = dict()  # in cell counts
-        self.model = read_sbml_model("MODEL1310110043_url_large_cleaned.xml")
+        self.model = read_model(model_path)
+        self.exchanges = list(self.model.exchanges)
+        self.exchange_ids = [exchange.id for exchange in self.exchanges]
+        self.exchange_index = registry.register([list(exchange.metabolites.keys())[0].id
+                                                 for exchange in self.exchanges])
+        self.state = np.zeros(len(registry))  # in mmol, indexed by the metabolite registry
+        self.prune_threshold = prune_threshold  # in mmol, smaller amounts are dropped after every step
+        self.pool = pool if pool is not None else default_pool()
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.cache = cache  # SolutionCache of the species FBA solutions, if any
+        self.path_to_agora = path_to_agora  # folder of the species models
+        self.engine = engine  # "pool" (one problem per species, on the workers) or "community" (one joint problem)
+        self.community = None  # CommunityLP of the species present, for the community engine
+        # Last solution of every species, reused while the changes of its bounds do not matter (pool engine)
+        self.tracker = SolveTracker(reuse_tolerance) if reuse_tolerance is not None else None
+        self.failures = collections.Counter()  # failed species solves, by (species, "load"/"timeout"/"error")
         self.growth_rate = float
         self.input_frequency = 4  # in hours
         self.output_frequency = 24  # in hours
         self.biomass = 370  # in gDCW
 
+    @property
+    def metabolome(self):
+        return registry.to_dict(self.state, self.prune_threshold)
+
+    @metabolome.setter
+    def metabolome(self, metabolites):
+        self.state = registry.to_vector(metabolites)
+
+    def expand_state(self):
+        # The registry may have grown since the state vector was allocated
+        if len(self.state) < len(registry):
+            self.state = np.concatenate([self.state, np.zeros(len(registry) - len(self.state))])
+
     def add_to_metabolome(self, metabolites):
-        for metabolite in metabolites.keys():
-            if metabolite in self.metabolome.keys():
-                self.metabolome[metabolite] = self.metabolome[metabolite] + metabolites[metabolite]
-            else:
-                self.metabolome[metabolite] = metabolites[metabolite]
+        if isinstance(metabolites, dict):
+            metabolites = registry.to_vector(metabolites)
+        self.expand_state()
+        self.state[:len(metabolites)] += metabolites
 
     def add_to_microbiome(self, microbes):
         for microbe in microbes.keys():
@@ -181,45 +945,49 @@ class LargeIntestine:
             else:
                 self.microbiome[microbe] = microbes[microbe]
 
-    def process_species(self, metabolome, species, total_biomass):
-        path_to_agora = "AGORA_1_03_sbml"
-        filepath = os.path.join(path_to_agora, species)
+    def get_state(self):
+        """
+        Returns a copy of everything that is carried over from one step to the next: the microbiome, the
+        metabolome (by metabolite ID, so it does not depend on the registry order), the host growth rate, the
+        LP basis of the host model, which the next host solve is warm-started from, and the last solutions of
+        the species if they are reused.
+        """
+        present = np.flatnonzero(self.state)
+        return {"microbiome": dict(self.microbiome),
+                "metabolite_ids": [registry.ids[i] for i in present],
+                "metabolite_amounts": self.state[present].copy(),
+                "growth_rate": self.growth_rate,
+                "basis": save_basis(self.model),
+                "tracker": self.tracker.get_state() if self.tracker is not None else None}
 
-        try:
-            model = read_sbml_with_timeout(filepath)
-            bacterial_cell_volume = 1e-12  # in cm^3
-            dry_weight_per_unit_volume = 0.33  # in gDCW/cm^3
-            biomass = self.microbiome[species] * bacterial_cell_volume * dry_weight_per_unit_volume  # in gDCW
-
-            exchanges = dict()
-            for exchange in model.exchanges:
-                metabolite = list(exchange.metabolites.keys())[0].id
-                if metabolite in metabolome.keys():
-                    availability = metabolome[metabolite]
-                    species_share = availability * (biomass / total_biomass)
-                    exchange.lower_bound = min(-1e-6, round(
-                        -species_share / (biomass * (self.output_frequency - self.input_frequency)), 3))
-                else:
-                    exchange.lower_bound = -1e-6
-
-            solution = model.optimize()
-            growth_rate = solution.objective_value
-            new_cell_count = int(self.microbiome[species] * np.exp(
-                growth_rate * (self.output_frequency - self.input_frequency)))
-            self.microbiome[species] = new_cell_count
-
-            for exchange in model.exchanges:
-                metabolite = list(exchange.metabolites.keys())[0].id
-                exchange_flux = solution[exchange.id]
-                exchange_amount = exchange_flux * biomass * (self.output_frequency - self.input_frequency)
-                exchanges[metabolite] = exchanges.get(metabolite, 0) + exchange_amount
-
-            return species, growth_rate, exchanges
-
-        except concurrent.futures.TimeoutError:
-            return species, 0, dict()
+    def set_state(self, state):
+        """
+        Restores the state returned by get_state().
+        """
+        self.microbiome = dict(state["microbiome"])
+        indices = registry.register(state["metabolite_ids"])
+        self.state = np.zeros(len(registry))
+        self.state[indices] = state["metabolite_amounts"]
+        self.growth_rate = state["growth_rate"]
+        restore_basis(self.model, state["basis"])
+        if self.tracker is not None and state.get("tracker") is not None:
+            self.tracker.set_state(state["tracker"])
 
     def metabolise(self):
+        return self.finish_metabolise(self.start_metabolise())
+
+    def start_metabolise(self, executor=None):
+        """
+        First half of a metabolism step: works out the uptake bounds of every species from the metabolome, and
+        starts solving their models (see start_species_solves()). The community problem is always solved before
+        returning, as the LP solver must only be used from the thread that owns the models.
+
+        Parameters:
+        - executor (concurrent.futures.ThreadPoolExecutor): Threads to wait for the worker pool on.
+
+        Returns:
+        - dict: The step, to be passed to finish_metabolise().
+        """
         total_biomass = 0
         for species in self.microbiome.keys():
             bacterial_cell_volume = 1e-12  # in cm^3
@@ -228,62 +996,107 @@ class LargeIntestine:
             total_biomass += biomass
 
         growth_rates = {species: 0 for species in self.microbiome.keys()}
-        combined_exchanges = {}
-
-        num_cpus = os.cpu_count()
-        current_metabolome = copy.deepcopy(self.metabolome)
-        with concurrent.futures.ProcessPoolExecutor(max_workers=num_cpus) as executor:
-            futures = {executor.submit(self.process_species, current_metabolome, species, total_biomass): species for
-                       species in self.microbiome.keys()}
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    species, growth_rate, exchanges = future.result()
-                    if growth_rate is not None:
-                        growth_rates[species] = growth_rate
-                    for metabolite, amount in exchanges.items():
-                        combined_exchanges[metabolite] = combined_exchanges.get(metabolite, 0) + amount
-                except:
-                    continue
-
-        for metabolite, amount in combined_exchanges.items():
-            if metabolite in self.metabolome and self.metabolome[metabolite] + amount != 0:
-                self.metabolome[metabolite] += amount
-            elif metabolite not in self.metabolome and amount != 0:
-                self.metabolome[metabolite] = amount
-
-        model = self.model
-        for exchange in model.exchanges:
-            metabolite = list(exchange.metabolites.keys())[0].id
-            if metabolite in self.metabolome:
-                availability = self.metabolome[metabolite]
-                exchange.lower_bound = min(-1e-6, round(
-                    -availability / (self.biomass * (self.output_frequency - self.input_frequency)), 3))
-            else:
-                exchange.lower_bound = -1e-6
-        solution = model.optimize()
-        self.growth_rate = solution.objective_value
-        for exchange in model.exchanges:
-            metabolite = list(exchange.metabolites.keys())[0].id
-            exchange_flux = solution[exchange.id]
-            exchange_amount = exchange_flux * self.biomass * (self.output_frequency - self.input_frequency)
-            if metabolite in self.metabolome:
-                self.metabolome[metabolite] += exchange_amount
-            elif metabolite not in self.metabolome and exchange_amount != 0:
-                self.metabolome[metabolite] = exchange_amount
+
+        tracer = current_tracer()
+        with tracer.span("exchange_metabolites"):
+            exchange_metabolites = get_exchange_metabolites(list(self.microbiome.keys()), self.pool,
+                                                            self.path_to_agora)
+        self.expand_state()
+        solved_species = [species for species in self.microbiome.keys() if exchange_metabolites[species] is not None]
+        for species in self.microbiome.keys():
+            if exchange_metabolites[species] is None:
+                self.failures[species, "load"] += 1
+        biomasses = []
+        payloads = []
+        for species in solved_species:
+            bacterial_cell_volume = 1e-12  # in cm^3
+            dry_weight_per_unit_volume = 0.33  # in gDCW/cm^3
+            biomass = self.microbiome[species] * bacterial_cell_volume * dry_weight_per_unit_volume  # in gDCW
+            lower_bounds = species_lower_bounds(self.state, exchange_metabolites[species], biomass, total_biomass,
+                                                self.output_frequency - self.input_frequency)
+            biomasses.append(biomass)
+            payloads.append((species, lower_bounds))
+
+        shared = None
+        if self.engine == "community" and solved_species:
+            with tracer.span("species_solves", engine=self.engine, species=len(payloads)):
+                if self.community is None or self.community.species_list != solved_species:
+                    self.community = CommunityLP(solved_species, self.path_to_agora)
+                results = solve_community(self.community, payloads, biomasses,
+                                          self.output_frequency - self.input_frequency, self.state, self.pool,
+                                          self.cache, self.path_to_agora)
+        else:
+            # With a process pool, the workers read the metabolome and write their solutions in shared memory
+            if solved_species:
+                shared = share_species_step(self.pool, self.state,
+                                            [exchange_metabolites[species] for species in solved_species], biomasses,
+                                            total_biomass, self.output_frequency - self.input_frequency,
+                                            self.tracker is not None)
+            results = start_species_solves(payloads, self.pool, self.cache, executor, self.tracker,
+                                           self.path_to_agora, shared)
+        return {"growth_rates": growth_rates, "exchange_metabolites": exchange_metabolites,
+                "solved_species": solved_species, "biomasses": biomasses, "results": results,
+                "shared": shared}
+
+    def finish_metabolise(self, step):
+        """
+        Second half of a metabolism step: waits for the species solutions, and applies their exchanges and
+        those of the host to the metabolome.
+
+        Parameters:
+        - step (dict): The step returned by start_metabolise().
+
+        Returns:
+        - dict: Growth rate of each species.
+        """
+        growth_rates, exchange_metabolites = step["growth_rates"], step["exchange_metabolites"]
+        results = step["results"]
+        if isinstance(results, concurrent.futures.Future):
+            results = results.result()
+        tracer = current_tracer()
+
+        # Results are combined in species order, so the outcome does not depend on which worker finishes first
+        metabolite_indices, amounts = [], []
+        for species, biomass, result in zip(step["solved_species"], step["biomasses"], results):
+            if isinstance(result, Exception):
+                self.failures[species, "timeout" if isinstance(result, TimeoutError) else "error"] += 1
+                continue
+            growth_rate, exchange_fluxes = result
+            growth_rates[species] = growth_rate
+            if step["shared"] is None:
+                metabolite_indices.append(exchange_metabolites[species])
+                amounts.append(exchange_fluxes * biomass * (self.output_frequency - self.input_frequency))
+        if step["shared"] is None:
+            self.state += combine_exchanges(len(self.state), metabolite_indices, amounts)
+        else:
+            self.state += shared_exchanges(step["shared"], self.output_frequency - self.input_frequency)
+            self.pool.release(step["shared"])
+
+        availability = self.state[self.exchange_index]
+        lower_bounds = np.minimum(-1e-6, np.round(
+            -availability / (self.biomass * (self.output_frequency - self.input_frequency)), 3))
+        with tracer.span("host_solve") as span:
+            for exchange, lower_bound in zip(self.exchanges, lower_bounds.tolist()):
+                exchange.lower_bound = lower_bound
+            iterations = lp_iterations(self.model) if tracer.enabled else None
+            solution = self.model.optimize()
+            self.growth_rate = solution.objective_value
+            exchange_fluxes = solution.fluxes[self.exchange_ids].values
+            if iterations is not None:
+                span.set(iterations=lp_iterations(self.model) - iterations)
+        self.state[self.exchange_index] += exchange_fluxes * self.biomass * (self.output_frequency -
+                                                                             self.input_frequency)
+
+        self.state[np.abs(self.state) < self.prune_threshold] = 0
 
         return growth_rates
 
     def transfer(self, growth_rates):
-        self.metabolome = dict()
-
-        total_microbiome_growth = sum(growth_rates.values())
-        transfer_probability = {species: 1 - (gr / total_microbiome_growth) for species, gr in growth_rates.items()}
-        num_cells_to_transfer = sum(self.microbiome.values()) - random.randint(10 ** 8, 10 ** 10)
-        num_cells_transferred = 0
-        while num_cells_transferred < num_cells_to_transfer:
-            chosen_species = \
-                random.choices(list(transfer_probability.keys()), weights=list(transfer_probability.values()), k=1)[0]
-            num_species_cells_transferred = random.randint(0, self.microbiome[chosen_species])
-            self.microbiome[chosen_species] -= num_species_cells_transferred
-            num_cells_transferred += num_species_cells_transferred
+        self.state = np.zeros(len(registry))
+
+        cells_retained = int(self.rng.integers(10 ** 8, 10 ** 10, endpoint=True))
+        num_cells_to_transfer = sum(self.microbiome.values()) - cells_retained
+        cells_transferred = sample_transit(self.microbiome, growth_rates, num_cells_to_transfer, self.rng)
+        for species, count in cells_transferred.items():
+            self.microbiome[species] -= count
         self.microbiome = {species: count for species, count in self.microbiome.items() if count != 0}
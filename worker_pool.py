@@ -0,0 +1,974 @@
+import os
+import sys
+import time
+import pickle
+import signal
+import argparse
+import threading
+import collections
+import concurrent.futures
+import multiprocessing
+import multiprocessing.connection
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from tracing import current_tracer
+
+# Environment variable holding the key that remote pools and worker daemons authenticate each other with
+authkey_variable = "WORKER_POOL_AUTHKEY"
+
+# Shared memory blocks a worker process keeps attached (see shared_arrays()). A block stays mapped until it is
+# evicted here, even once its owner released it.
+_attached_blocks = 4
+_attached = collections.OrderedDict()
+
+
+def _ping():
+    return os.getpid()
+
+
+def _init_worker(model_cache_mb):
+    if model_cache_mb is not None:
+        from utilities import set_model_cache_budget  # utilities imports this module
+
+        set_model_cache_budget(model_cache_mb)
+
+
+def _exit_with_parent(parent):
+    # A worker whose parent was killed would otherwise wait for tasks forever
+    while os.getppid() == parent:
+        time.sleep(1.0)
+    os._exit(1)
+
+
+def _init_worker_process(model_cache_mb):
+    threading.Thread(target=_exit_with_parent, args=(os.getppid(),), daemon=True).start()
+    _init_worker(model_cache_mb)
+
+
+def _call(fn, args):
+    # Result of a task, or the exception it raised
+    try:
+        return fn(*args)
+    except Exception as e:
+        return e
+
+
+def _cache_lines(size):
+    # Size rounded up to whole cache lines (in bytes)
+    return -(-size // 64) * 64
+
+
+class SharedArrays:
+    """
+    Named arrays in one shared memory block (see WorkerPool.publish()), which worker processes read and write in
+    place instead of being sent them and sending results back. A task is only given the name of the block: the
+    layout of the arrays is stored at its start, and each worker attaches the block once (see shared_arrays()).
+    """
+
+    def __init__(self, memory, layout, start):
+        self.memory = memory
+        self.name = memory.name
+        self.arrays = {key: np.ndarray(shape, dtype, buffer=memory.buf, offset=start + offset)
+                       for key, (offset, shape, dtype) in layout.items()}
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def __contains__(self, key):
+        return key in self.arrays
+
+    @classmethod
+    def create(cls, arrays):
+        """
+        Allocates a shared memory block holding the given arrays.
+
+        Parameters:
+            arrays (dict): Array of each name, copied into the block, or its (shape, dtype) pair (a tuple and a
+                numpy dtype) for an array of zeros.
+
+        Returns:
+            SharedArrays: The arrays, in the block.
+        """
+        # Each array starts on a cache line, after the layout (offset, shape and dtype of every array)
+        layout, size = dict(), 0
+        for key, value in arrays.items():
+            shape, dtype = (value.shape, value.dtype) if isinstance(value, np.ndarray) else value
+            layout[key] = (size, tuple(shape), np.dtype(dtype).str)
+            size += _cache_lines(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        encoded = pickle.dumps(layout, protocol=pickle.HIGHEST_PROTOCOL)
+        start = _cache_lines(8 + len(encoded))
+
+        memory = shared_memory.SharedMemory(create=True, size=start + size)  # a new block is filled with zeros
+        memory.buf[:8] = len(encoded).to_bytes(8, "little")
+        memory.buf[8:8 + len(encoded)] = encoded
+        shared = cls(memory, layout, start)
+        for key, value in arrays.items():
+            if isinstance(value, np.ndarray):
+                shared[key][...] = value
+        return shared
+
+    @classmethod
+    def attach(cls, name):
+        memory = shared_memory.SharedMemory(name=name)
+        length = int.from_bytes(memory.buf[:8], "little")
+        return cls(memory, pickle.loads(memory.buf[8:8 + length]), _cache_lines(8 + length))
+
+    def close(self):
+        # The arrays must not outlive the mapping of the block
+        self.arrays = dict()
+        self.memory.close()
+
+    def unlink(self):
+        self.close()
+        self.memory.unlink()
+
+
+def shared_arrays(name):
+    """
+    Worker side of WorkerPool.publish(): the arrays of the block of the given name, attached on first use.
+
+    Returns:
+        SharedArrays: The arrays.
+    """
+    if name not in _attached:
+        _attached[name] = SharedArrays.attach(name)
+        while len(_attached) > _attached_blocks:
+            try:
+                _attached.popitem(last=False)[1].close()
+            except BufferError:  # an array of the block is still in use, so it stays mapped
+                pass
+    _attached.move_to_end(name)
+    return _attached[name]
+
+
+class Pool:
+    """
+    Base of the pools the species models are solved on. Tasks are plain module-level functions with small
+    payloads, so submitting one never pickles a compartment or its host model. A pool keeps track of its
+    start-up cost and of how many bytes are sent to and received from workers.
+
+    The backends differ in where the tasks run: SerialPool runs them in the calling thread, ThreadPool in
+    threads of this process (only faster than SerialPool with a solver that releases the GIL), WorkerPool in
+    worker processes, and RemotePool on worker daemons, which may be on other machines (see serve()). They all
+    give the same results; see create_pool().
+
+    With strain affinity, all the tasks of a key (e.g. an AGORA model) go to the same worker. Each worker then
+    only loads its share of the models, which keeps its model cache small and its hit rate high even when
+    hundreds of strains are simulated.
+    """
+    backend = None
+    shares_memory = False
+
+    def __init__(self, max_workers, affinity=False):
+        self.max_workers = max_workers
+        self.affinity = affinity
+        self.spawn_time = 0.0
+
+        self.tasks = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.dispatch_time = 0.0
+        self.timeouts = 0  # tasks stopped at their deadline
+        self.resubmitted = 0  # tasks run again because their worker was stopped or died
+        self.recycled = 0  # workers replaced or reconnected
+        self._lock = threading.Lock()  # map() may be called from several threads (e.g. ensemble members)
+
+        # Worker of each key seen so far, and the number of keys given to each worker
+        self._assignments = dict()
+        self._assigned = [0] * (max_workers if affinity else 1)
+        self._next = 0
+
+    def _worker(self, key):
+        # Called with the lock held. A new key goes to the worker with the fewest keys, so the models are
+        # spread evenly, and the assignment only depends on the order in which the keys are first seen.
+        if len(self._assigned) == 1:
+            return 0
+        if key is None:
+            self._next = (self._next + 1) % len(self._assigned)
+            return self._next
+        if key not in self._assignments:
+            worker = self._assigned.index(min(self._assigned))
+            self._assignments[key] = worker
+            self._assigned[worker] += 1
+        return self._assignments[key]
+
+    def _account(self, fn, start, tasks, bytes_sent=0, bytes_received=0, dispatch_time=0.0, timeouts=0,
+                 resubmitted=0):
+        # Records a map() call in the trace and in the totals of the pool
+        current_tracer().complete("pool_map", start, time.perf_counter() - start,
+                                  task=getattr(fn, "__name__", str(fn)), tasks=tasks, bytes_sent=bytes_sent,
+                                  bytes_received=bytes_received, dispatch_time=dispatch_time, timeouts=timeouts,
+                                  resubmitted=resubmitted)
+        with self._lock:
+            self.tasks += tasks
+            self.bytes_sent += bytes_sent
+            self.bytes_received += bytes_received
+            self.dispatch_time += dispatch_time
+            self.timeouts += timeouts
+            self.resubmitted += resubmitted
+
+    def map(self, fn, payloads, keys=None):
+        """
+        Runs fn(*payload) for every payload on the workers.
+
+        Parameters:
+            fn (callable): Module-level function to run.
+            payloads (list): Argument tuples, one per task.
+            keys (list): Affinity key of each task (e.g. the AGORA model it solves). Only used with
+                strain affinity.
+
+        Returns:
+            list: Results in the order of the payloads. A task that raised yields the exception instead.
+        """
+        raise NotImplementedError
+
+    def broadcast(self, fn, *args):
+        """
+        Runs fn(*args) once on every worker.
+
+        Returns:
+            list: Result of each worker (or the exception it raised).
+        """
+        raise NotImplementedError
+
+    def publish(self, arrays):
+        """
+        Puts arrays in memory shared with the workers, which tasks read and write through shared_arrays(), given
+        the name of the block. Only available if shares_memory is set (the workers are processes of this machine).
+
+        Parameters:
+            arrays (dict): Array of each name, or its (shape, dtype) pair for an array of zeros.
+
+        Returns:
+            SharedArrays: The arrays, to be given back to release() once the tasks that use them are done.
+        """
+        raise NotImplementedError
+
+    def release(self, shared):
+        """
+        Frees a block of arrays returned by publish().
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        return {
+            "backend": self.backend,
+            "workers": self.max_workers,
+            "affinity": self.affinity,
+            "keys": len(self._assignments),
+            "spawn_time": self.spawn_time,
+            "tasks": self.tasks,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "bytes_per_task": (self.bytes_sent + self.bytes_received) / self.tasks if self.tasks else 0,
+            "dispatch_time": self.dispatch_time,
+            "timeouts": self.timeouts,
+            "resubmitted": self.resubmitted,
+            "recycled": self.recycled,
+        }
+
+    def report(self):
+        stats = self.stats()
+        affinity = f" (affinity over {stats['keys']} keys)" if stats["affinity"] else ""
+        return (f"Worker pool: {stats['workers']} {stats['backend']} workers{affinity} spawned in "
+                f"{stats['spawn_time']:.2f} s, {stats['tasks']} tasks, {stats['bytes_sent'] / 1e6:.2f} MB sent, "
+                f"{stats['bytes_received'] / 1e6:.2f} MB received "
+                f"({stats['bytes_per_task'] / 1e3:.1f} kB per task), "
+                f"{stats['dispatch_time']:.2f} s spent dispatching" +
+                (f", {stats['timeouts']} tasks timed out, {stats['resubmitted']} resubmitted, "
+                 f"{stats['recycled']} worker restarts" if stats["recycled"] else ""))
+
+    def shutdown(self):
+        pass
+
+
+class SerialPool(Pool):
+    """
+    Runs the tasks one after the other in the calling thread, without pickling anything. Useful to debug and
+    profile tasks, and on machines with a single CPU.
+    """
+    backend = "serial"
+
+    def __init__(self, model_cache_mb=None):
+        """
+        Parameters:
+            model_cache_mb (float): Memory budget of the AGORA models kept loaded by each thread (in MB,
+                default: no limit).
+        """
+        super().__init__(1)
+        _init_worker(model_cache_mb)
+
+    def map(self, fn, payloads, keys=None):
+        start = time.perf_counter()
+        results = [_call(fn, payload) for payload in payloads]
+        self._account(fn, start, len(payloads))
+        return results
+
+    def broadcast(self, fn, *args):
+        return [_call(fn, args)]
+
+
+class ThreadPool(Pool):
+    """
+    Runs the tasks in threads of this process. Each thread keeps models of its own, so tasks never share a
+    model. The solves only run in parallel if the LP solver releases the GIL; GLPK (through swiglpk) does not.
+    Threads cannot be stopped, so the solver's own time limit is the only bound on a task.
+    """
+    backend = "thread"
+
+    def __init__(self, max_workers=None, model_cache_mb=None):
+        """
+        Parameters:
+            max_workers (int): Number of threads (default: number of CPUs).
+            model_cache_mb (float): Memory budget of the AGORA models kept loaded by each thread (in MB,
+                default: no limit).
+        """
+        super().__init__(max_workers or os.cpu_count())
+        _init_worker(model_cache_mb)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def map(self, fn, payloads, keys=None):
+        start = time.perf_counter()
+        futures = [self.executor.submit(_call, fn, payload) for payload in payloads]
+        dispatch_time = time.perf_counter() - start
+        results = [future.result() for future in futures]
+        self._account(fn, start, len(payloads), dispatch_time=dispatch_time)
+        return results
+
+    def broadcast(self, fn, *args):
+        return [_call(fn, args)]
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class WorkerPool(Pool):
+    """
+    Process pool that lives for a whole simulation.
+
+    Every worker process has a queue of its own. With strain affinity, all the tasks of a key go to the same
+    worker; otherwise every task goes to the worker with the fewest unfinished tasks. A worker stopped at the
+    deadline of a task therefore only takes along the tasks queued behind it, which are run again, and never those
+    of the other workers.
+
+    Arrays that many tasks read or write (e.g. the state of a compartment and the solutions of its species) can be
+    put in shared memory once (see publish()) instead of being sent with every task.
+    """
+    backend = "process"
+    shares_memory = True
+
+    def __init__(self, max_workers=None, model_cache_mb=None, affinity=False, task_timeout=120):
+        """
+        Starts the worker processes.
+
+        Parameters:
+            max_workers (int): Number of worker processes (default: number of CPUs).
+            model_cache_mb (float): Memory budget of the AGORA models kept loaded by each worker (in MB, default:
+                no limit).
+            affinity (bool): Whether tasks with the same key always run on the same worker.
+            task_timeout (float): Time a task may run (in seconds) before its worker is stopped and replaced,
+                and the task fails with a TimeoutError. None lets tasks run for as long as they take.
+        """
+        super().__init__(max_workers or os.cpu_count(), affinity)
+        self.model_cache_mb = model_cache_mb
+        self.task_timeout = task_timeout
+        self._published = dict()  # blocks of shared arrays not released yet, by name
+
+        # The workers must register the shared memory blocks they attach with the resource tracker of this process,
+        # which forgets them when they are unlinked here; one of their own would unlink them when they exit
+        resource_tracker.ensure_running()
+        start = time.perf_counter()
+        self.executors = [self._new_executor() for _ in range(self.max_workers)]
+        # Process ID of each worker, as its first task reports it. Workers are started lazily, so make every one of
+        # them answer before measuring the spawn cost.
+        self._pids = [executor.submit(_ping) for executor in self.executors]
+        for future in self._pids:
+            future.result()
+        self.spawn_time = time.perf_counter() - start
+
+        # Number of times each executor was replaced, to tell a stale future from a failed task
+        self._generations = [0] * len(self.executors)
+        # Unfinished futures of each executor, in submission order, with the time each was first seen running (None
+        # before). They are shared by all map() calls, as the tasks of a call may wait behind those of another.
+        self._submitted = [dict() for _ in self.executors]
+
+    def _new_executor(self):
+        return concurrent.futures.ProcessPoolExecutor(max_workers=1, initializer=_init_worker_process,
+                                                      initargs=(self.model_cache_mb,))
+
+    def _least_loaded(self):
+        # Called with the lock held: the worker with the fewest unfinished tasks
+        return min(range(len(self.executors)), key=lambda k: len(self._submitted[k]))
+
+    def _stop_worker(self, k):
+        # Called with the lock held: stops the process of worker k, which may be busy with a task that nothing else
+        # interrupts. Only a live child of this process with the ID the worker reported is stopped.
+        pid = self._pids[k]
+        if not pid.done() or pid.cancelled() or pid.exception() is not None:
+            return  # the worker never ran a task
+        for process in multiprocessing.active_children():
+            if process.pid == pid.result():
+                process.terminate()
+
+    def _recycle(self, k, generation, stop=False):
+        # Called with the lock held: replaces worker k, unless that was already done since the given generation
+        # (e.g. by another thread), after stopping its process if 'stop' is set (it is otherwise known to have died).
+        # The tasks that were queued on it fail with BrokenProcessPool or CancelledError, and are resubmitted by
+        # their map() call; the other workers are not affected.
+        if self._generations[k] != generation:
+            return
+        if stop:
+            self._stop_worker(k)
+        self.executors[k].shutdown(wait=False, cancel_futures=True)
+        self.executors[k] = self._new_executor()
+        self._pids[k] = self.executors[k].submit(_ping)
+        self._submitted[k] = dict()
+        self._generations[k] += 1
+        self.recycled += 1
+
+    def map(self, fn, payloads, keys=None):
+        """
+        Runs fn(*payload) for every payload on the workers.
+
+        A task that runs for longer than task_timeout fails with a TimeoutError, and its worker is replaced
+        so that it does not keep running. Tasks that were waiting on a replaced (or crashed) worker are run
+        again, on any worker without strain affinity, up to three times in all.
+
+        Parameters:
+            fn (callable): Module-level function to run.
+            payloads (list): Argument tuples, one per task.
+            keys (list): Affinity key of each task (e.g. the AGORA model it solves). Only used with
+                strain affinity.
+
+        Returns:
+            list: Results in the order of the payloads. A task that raised yields the exception instead.
+        """
+        start = time.perf_counter()
+        if keys is None:
+            keys = [None] * len(payloads)
+        with self._lock:
+            workers = [self._worker(key) for key in keys] if self.affinity else [None] * len(payloads)
+            for submitted in self._submitted:
+                for future in [future for future in submitted if future.done()]:
+                    del submitted[future]
+
+        futures = [None] * len(payloads)
+        generations = [0] * len(payloads)  # generation of the executor each task was submitted to
+        attempts = [0] * len(payloads)
+
+        def submit(i):
+            with self._lock:
+                if not self.affinity:
+                    workers[i] = self._least_loaded()
+                k = workers[i]
+                futures[i] = self.executors[k].submit(fn, *payloads[i])
+                generations[i] = self._generations[k]
+                self._submitted[k][futures[i]] = None
+            attempts[i] += 1
+
+        bytes_sent = 0
+        for i, payload in enumerate(payloads):
+            bytes_sent += len(pickle.dumps((fn, payload), protocol=pickle.HIGHEST_PROTOCOL))
+            submit(i)
+        dispatch_time = time.perf_counter() - start
+
+        results = [None] * len(payloads)
+        bytes_received = 0
+        timeouts, resubmitted = 0, 0
+        pending = set(range(len(payloads)))
+        while pending:
+            concurrent.futures.wait([futures[i] for i in pending], return_when=concurrent.futures.FIRST_COMPLETED,
+                                    timeout=1.0 if self.task_timeout is not None else None)
+            now = time.perf_counter()
+            started = dict()
+            if self.task_timeout is not None:
+                # An executor hands one task more than it has workers to its queue, and marks it as running; only
+                # the first running task of a worker is actually being run
+                with self._lock:
+                    for k in {workers[i] for i in pending}:
+                        running = 0
+                        for future in list(self._submitted[k]):
+                            if future.done():
+                                del self._submitted[k][future]
+                            elif future.running():
+                                running += 1
+                                if running == 1:
+                                    self._submitted[k][future] = self._submitted[k][future] or now
+                    started = {i: self._submitted[workers[i]].get(futures[i]) for i in pending}
+
+            for i in sorted(pending):
+                future = futures[i]
+                if future.done():
+                    try:
+                        result = future.result()
+                        bytes_received += len(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+                    except (BrokenProcessPool, concurrent.futures.CancelledError) as e:
+                        # The worker was stopped at the deadline of another task, or died
+                        with self._lock:
+                            self._recycle(workers[i], generations[i])
+                        if attempts[i] < 3:
+                            submit(i)
+                            resubmitted += 1
+                            continue
+                        result = e
+                    except Exception as e:
+                        result = e
+                    results[i] = result
+                    pending.discard(i)
+                elif started.get(i) is not None and now - started[i] > self.task_timeout:
+                    results[i] = TimeoutError(f"{getattr(fn, '__name__', fn)} task {i} did not finish within "
+                                              f"{self.task_timeout} s")
+                    pending.discard(i)
+                    timeouts += 1
+                    with self._lock:
+                        self._recycle(workers[i], generations[i], stop=True)
+
+        self._account(fn, start, len(futures), bytes_sent, bytes_received, dispatch_time, timeouts, resubmitted)
+        return results
+
+    def broadcast(self, fn, *args):
+        """
+        Runs fn(*args) once on every worker.
+
+        Returns:
+            list: Result of each worker (or the exception it raised).
+        """
+        results = []
+        for future in [executor.submit(fn, *args) for executor in self.executors]:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def publish(self, arrays):
+        shared = SharedArrays.create(arrays)
+        with self._lock:
+            self._published[shared.name] = shared
+        return shared
+
+    def release(self, shared):
+        with self._lock:
+            if self._published.pop(shared.name, None) is None:
+                return
+        shared.unlink()
+
+    def shutdown(self):
+        for executor in self.executors:
+            executor.shutdown()
+        for shared in list(self._published.values()):
+            self.release(shared)
+
+
+class _RemoteTask:
+    # A task of a RemotePool, from its submission to its result
+
+    def __init__(self, task_id, call, key):
+        self.task_id = task_id
+        self.message = pickle.dumps(("task", task_id, key, call), protocol=pickle.HIGHEST_PROTOCOL)
+        self.key = key
+        self.future = concurrent.futures.Future()
+        self.attempts = 0
+        self.bytes_received = 0
+        self.pinned = False  # must run on the daemon it was queued for (see RemotePool.broadcast())
+
+
+class RemotePool(Pool):
+    """
+    Runs the tasks on worker daemons (see serve()), on this machine or on others, so that a large ensemble can
+    be spread over several machines. Every daemon runs the tasks it is sent on a WorkerPool of its own, which
+    enforces the task deadline and replaces crashed workers; start one daemon per machine.
+
+    The pool talks to the daemons over authenticated connections (multiprocessing.connection), and a
+    dispatcher thread keeps each daemon's workers busy with a few tasks to spare. A daemon whose connection
+    breaks, or that stops answering, is dropped: its tasks are sent to the other daemons (up to three times in
+    all), and the pool keeps trying to reconnect to it in the background. The daemons must run the same code
+    as this process, from a folder with the same model files.
+    """
+    backend = "remote"
+
+    def __init__(self, addresses, authkey=None, affinity=False, daemon_timeout=600, tasks_per_worker=2,
+                 reconnect_interval=5.0):
+        """
+        Connects to the worker daemons.
+
+        Parameters:
+            addresses (list): (host, port) pair or "host:port" string of every daemon.
+            authkey (bytes): Key shared with the daemons (default: the WORKER_POOL_AUTHKEY environment variable).
+            affinity (bool): Whether tasks with the same key always run on the same daemon (while it is up).
+            daemon_timeout (float): Time a daemon with tasks in flight may go without sending a result (in
+                seconds) before it is dropped. It should be well above the task timeout of the daemons.
+            tasks_per_worker (int): Number of tasks sent to a daemon per worker it has, so that its workers do
+                not wait for the next task.
+            reconnect_interval (float): Time between two attempts to reconnect to a dropped daemon (in seconds).
+        """
+        super().__init__(len(addresses), affinity)
+        self.addresses = [parse_address(address) for address in addresses]
+        self.authkey = authkey if authkey is not None else environment_authkey()
+        self.daemon_timeout = daemon_timeout
+        self.tasks_per_worker = tasks_per_worker
+        self.reconnect_interval = reconnect_interval
+
+        self._connections = [None] * len(self.addresses)  # None while a daemon is down
+        self._workers = [0] * len(self.addresses)  # number of workers of each daemon
+        self._last_heard = [0.0] * len(self.addresses)  # when each daemon last sent a result, or was sent a task
+        self._in_flight = [dict() for _ in self.addresses]  # tasks sent to each daemon, by ID
+        self._queues = [collections.deque() for _ in self.addresses]  # tasks waiting for a given daemon
+        self._shared_queue = collections.deque()  # tasks that may run on any daemon
+        self._task_ids = 0
+        self._closed = False
+
+        start = time.perf_counter()
+        for i in range(len(self.addresses)):
+            try:
+                self._connections[i], self._workers[i] = self._connect(i)
+            except OSError as e:
+                print(f"Worker daemon {format_address(self.addresses[i])} is not reachable ({e}), retrying in the "
+                      f"background")
+                self._assigned[i] = float("inf")  # takes no keys until it is up
+                self._start_reconnecting(i)
+        if not any(self._connections):
+            raise ConnectionError("None of the worker daemons is reachable")
+        self.max_workers = sum(self._workers)
+        self.spawn_time = time.perf_counter() - start
+
+        # The dispatcher waits on the connections and on this pipe, which wakes it up when tasks are submitted
+        self._wakeup_reader, self._wakeup_writer = multiprocessing.Pipe(duplex=False)
+        self._dispatcher = threading.Thread(target=self._dispatch, name="RemotePool dispatcher", daemon=True)
+        self._dispatcher.start()
+
+    def _connect(self, i):
+        # Returns the connection to daemon i and the number of workers it has
+        connection = multiprocessing.connection.Client(self.addresses[i], authkey=self.authkey)
+        connection.send_bytes(pickle.dumps(("hello",), protocol=pickle.HIGHEST_PROTOCOL))
+        _, workers = pickle.loads(connection.recv_bytes())
+        return connection, workers
+
+    def _start_reconnecting(self, i):
+        threading.Thread(target=self._reconnect, args=(i,), name=f"RemotePool reconnect {i}", daemon=True).start()
+
+    def _reconnect(self, i):
+        # Runs in a thread of its own, as connecting to an unreachable machine can take long
+        while not self._closed:
+            time.sleep(self.reconnect_interval)
+            try:
+                connection, workers = self._connect(i)
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                continue
+            with self._lock:
+                self._connections[i], self._workers[i] = connection, workers
+                self._assigned[i] = 0
+                self.max_workers = sum(self._workers)
+                self.recycled += 1
+            self._wake()
+            return
+
+    def _wake(self):
+        try:
+            self._wakeup_writer.send_bytes(b"")
+        except OSError:
+            pass  # the pool was shut down
+
+    def _drop(self, i, error):
+        # Called with the lock held: closes the connection to daemon i, sends its tasks back to the queue (or
+        # fails them after three attempts), moves its keys to other daemons and starts reconnecting to it
+        try:
+            self._connections[i].close()
+        except OSError:
+            pass
+        self._connections[i] = None
+        self._workers[i] = 0
+        lost = sorted(self._in_flight[i].values(), key=lambda task: task.task_id) + list(self._queues[i])
+        for task in reversed(lost):
+            if task.pinned or task.attempts >= 3:
+                task.future.set_result(ConnectionError(f"Task {task.task_id} was lost with worker daemon "
+                                                       f"{format_address(self.addresses[i])} ({error}), after "
+                                                       f"{task.attempts} attempts"))
+            else:
+                self._shared_queue.appendleft(task)
+        self._in_flight[i].clear()
+        self._queues[i].clear()
+        self._assignments = {key: worker for key, worker in self._assignments.items() if worker != i}
+        self._assigned[i] = float("inf")  # takes no new keys until it is back
+        if not self._closed:
+            self._start_reconnecting(i)
+
+    def _next_task(self, i):
+        # Called with the lock held: next task for daemon i, from its own queue or else from the shared one. With
+        # affinity, a shared task with a key is moved to the queue of the daemon of that key instead.
+        if self._queues[i]:
+            return self._queues[i].popleft()
+        while self._shared_queue:
+            task = self._shared_queue.popleft()
+            if not self.affinity or task.key is None:
+                return task
+            worker = self._worker(task.key)
+            if worker == i:
+                return task
+            self._queues[worker].append(task)
+        return None
+
+    def _dispatch(self):
+        while not self._closed:
+            now = time.perf_counter()
+            with self._lock:
+                live = [i for i, connection in enumerate(self._connections) if connection is not None]
+                if not live:
+                    # Nothing can run until a daemon is back
+                    for task in self._shared_queue:
+                        task.future.set_result(ConnectionError("None of the worker daemons is reachable"))
+                    self._shared_queue.clear()
+                for i in live:
+                    while self._connections[i] is not None and \
+                            len(self._in_flight[i]) < self._workers[i] * self.tasks_per_worker:
+                        task = self._next_task(i)
+                        if task is None:
+                            break
+                        if not self._in_flight[i]:
+                            self._last_heard[i] = now
+                        self._in_flight[i][task.task_id] = task
+                        task.attempts += 1
+                        try:
+                            self._connections[i].send_bytes(task.message)
+                        except OSError as e:
+                            self._drop(i, e)
+                connections = {self._connections[i]: i for i in live if self._connections[i] is not None}
+
+            ready = multiprocessing.connection.wait(list(connections) + [self._wakeup_reader], timeout=1.0)
+            now = time.perf_counter()
+            with self._lock:
+                if self._wakeup_reader in ready:
+                    while self._wakeup_reader.poll():
+                        self._wakeup_reader.recv_bytes()
+                for connection, i in connections.items():
+                    if self._connections[i] is not connection:
+                        continue  # dropped meanwhile
+                    try:
+                        while connection.poll():
+                            data = connection.recv_bytes()
+                            _, task_id, result = pickle.loads(data)
+                            self._last_heard[i] = now
+                            task = self._in_flight[i].pop(task_id, None)
+                            if task is not None:
+                                task.bytes_received = len(data)
+                                task.future.set_result(result)
+                    except (EOFError, OSError) as e:
+                        self._drop(i, e)
+                        continue
+                    if self._in_flight[i] and now - self._last_heard[i] > self.daemon_timeout:
+                        self._drop(i, f"no result for {self.daemon_timeout} s")
+
+    def map(self, fn, payloads, keys=None):
+        start = time.perf_counter()
+        if keys is None:
+            keys = [None] * len(payloads)
+        tasks = []
+        with self._lock:
+            for payload, key in zip(payloads, keys):
+                self._task_ids += 1
+                tasks.append(_RemoteTask(self._task_ids, pickle.dumps((fn, payload), protocol=pickle.HIGHEST_PROTOCOL),
+                                         key))
+            self._shared_queue.extend(tasks)
+        self._wake()
+        dispatch_time = time.perf_counter() - start
+
+        results = [task.future.result() for task in tasks]
+        self._account(fn, start, len(tasks), sum(len(task.message) * task.attempts for task in tasks),
+                      sum(task.bytes_received for task in tasks), dispatch_time,
+                      sum(isinstance(result, TimeoutError) for result in results),
+                      sum(max(task.attempts - 1, 0) for task in tasks))
+        return results
+
+    def broadcast(self, fn, *args):
+        """
+        Runs fn(*args) once on every daemon that is up (on one of its workers).
+
+        Returns:
+            list: Result of each daemon (or the exception it raised).
+        """
+        call = pickle.dumps((fn, args), protocol=pickle.HIGHEST_PROTOCOL)
+        tasks = []
+        with self._lock:
+            for i, connection in enumerate(self._connections):
+                if connection is not None:
+                    self._task_ids += 1
+                    task = _RemoteTask(self._task_ids, call, None)
+                    task.pinned = True
+                    self._queues[i].append(task)
+                    tasks.append(task)
+        self._wake()
+        return [task.future.result() for task in tasks]
+
+    def shutdown(self):
+        self._closed = True
+        self._wake()
+        self._dispatcher.join()
+        with self._lock:
+            for connection in self._connections:
+                if connection is not None:
+                    connection.close()
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
+
+
+def create_pool(backend="process", max_workers=None, model_cache_mb=None, affinity=False, task_timeout=120,
+                addresses=None, authkey=None):
+    """
+    Starts a pool of the given backend.
+
+    Parameters:
+        backend (str): "serial", "thread", "process" or "remote" (see Pool).
+        max_workers (int): Number of threads or worker processes (default: number of CPUs).
+        model_cache_mb (float): Memory budget of the AGORA models kept loaded by each worker (in MB). The daemons
+            of the remote backend are given theirs when they are started (see serve()).
+        affinity (bool): Whether tasks with the same key always run on the same worker (process backend) or
+            daemon (remote backend).
+        task_timeout (float): Time a task may run (in seconds, process backend; see serve() for the remote one).
+        addresses (list): Addresses of the worker daemons (remote backend).
+        authkey (bytes): Key shared with the worker daemons (remote backend).
+
+    Returns:
+        Pool: The pool.
+    """
+    if backend == "serial":
+        return SerialPool(model_cache_mb)
+    if backend == "thread":
+        return ThreadPool(max_workers, model_cache_mb)
+    if backend == "process":
+        return WorkerPool(max_workers, model_cache_mb, affinity, task_timeout)
+    if backend == "remote":
+        if not addresses:
+            raise ValueError("The remote backend needs the addresses of the worker daemons")
+        return RemotePool(addresses, authkey, affinity)
+    raise ValueError(f"Unknown backend {backend!r}, expected 'serial', 'thread', 'process' or 'remote'")
+
+
+def parse_address(address):
+    # "host:port" → (host, port)
+    if isinstance(address, str):
+        host, port = address.rsplit(":", 1)
+        return host, int(port)
+    return tuple(address)
+
+
+def format_address(address):
+    return f"{address[0]}:{address[1]}"
+
+
+def environment_authkey():
+    authkey = os.environ.get(authkey_variable)
+    if not authkey:
+        raise ValueError(f"Set the {authkey_variable} environment variable to the key shared by the pool and the "
+                         f"worker daemons")
+    return authkey.encode()
+
+
+def _serve_connection(connection, pool):
+    # Runs the tasks received on a connection on the daemon's pool, each in a thread of its own (the pool bounds
+    # how many run at once), and sends back their results
+    send_lock = threading.Lock()
+
+    def run(task_id, key, call):
+        try:
+            fn, args = pickle.loads(call)
+            result = pool.map(fn, [args], keys=[key])[0]
+            data = pickle.dumps(("result", task_id, result), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:  # the task or its result cannot be pickled
+            data = pickle.dumps(("result", task_id, RuntimeError(f"Task {task_id}: {e!r}")),
+                                protocol=pickle.HIGHEST_PROTOCOL)
+        with send_lock:
+            try:
+                connection.send_bytes(data)
+            except OSError:
+                pass  # the pool went away
+
+    with connection:
+        try:
+            while True:
+                message = pickle.loads(connection.recv_bytes())
+                if message[0] == "hello":
+                    with send_lock:
+                        connection.send_bytes(pickle.dumps(("ready", pool.max_workers)))
+                else:
+                    threading.Thread(target=run, args=message[1:], daemon=True).start()
+        except (EOFError, OSError):
+            pass  # the pool closed the connection or went away
+
+
+def serve(address, authkey, max_workers=None, model_cache_mb=None, task_timeout=120, ready=None):
+    """
+    Runs a worker daemon: starts a WorkerPool, and runs on it the tasks sent by every RemotePool that connects,
+    until the process is terminated. Models stay loaded from one pool to the next.
+
+    Parameters:
+        address (tuple): (host, port) to listen on (port 0 picks a free port).
+        authkey (bytes): Key shared with the pools.
+        max_workers (int): Number of worker processes (default: number of CPUs).
+        model_cache_mb (float): Memory budget of the AGORA models kept loaded by each worker (in MB). If given,
+            every strain is also solved on a single worker (see WorkerPool).
+        task_timeout (float): Time a task may run (in seconds), see WorkerPool.
+        ready (multiprocessing.connection.Connection): Connection the address listened on is sent to.
+    """
+    pool = WorkerPool(max_workers, model_cache_mb, affinity=model_cache_mb is not None, task_timeout=task_timeout)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # stop the workers too when terminated
+    try:
+        with multiprocessing.connection.Listener(address, authkey=authkey) as listener:
+            if ready is not None:
+                ready.send(listener.address)
+                ready.close()
+            while True:
+                try:
+                    connection = listener.accept()
+                except (OSError, EOFError, multiprocessing.AuthenticationError):
+                    continue  # e.g. a client with the wrong key
+                threading.Thread(target=_serve_connection, args=(connection, pool), daemon=True).start()
+    finally:
+        pool.shutdown()
+
+
+def start_daemons(num_daemons, authkey, max_workers=1, host="127.0.0.1", **options):
+    """
+    Starts worker daemons on this machine, e.g. to try the remote backend, or as a stand-in for other
+    machines in tests. Each one listens on a free port.
+
+    Parameters:
+        num_daemons (int): Number of daemons.
+        authkey (bytes): Key shared with the pools.
+        max_workers (int): Number of worker processes of each daemon.
+        host (str): Interface to listen on.
+        options: Other arguments of serve().
+
+    Returns:
+        tuple: The daemon processes (to terminate when done), and their addresses.
+    """
+    processes, addresses = [], []
+    for _ in range(num_daemons):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=serve, args=((host, 0), authkey, max_workers),
+                                          kwargs={**options, "ready": sender})
+        process.start()
+        sender.close()
+        addresses.append(receiver.recv())
+        receiver.close()
+        processes.append(process)
+    return processes, addresses
+
+
+if __name__ == "__main__":
+    from multiprocessing import freeze_support
+
+    freeze_support()  # Freeze support for multiprocessing
+
+    parser = argparse.ArgumentParser(description="Run a worker daemon for pools with the remote backend. The key "
+                                                 f"shared with the pools is read from {authkey_variable}.")
+    parser.add_argument("--host", default="127.0.0.1", help="interface to listen on (0.0.0.0 for all)")
+    parser.add_argument("--port", type=int, default=6100, help="port to listen on")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--model-cache-mb", type=float, default=None,
+                        help="memory budget of the models kept loaded by each worker, in MB")
+    parser.add_argument("--task-timeout", type=float, default=120, help="time a task may run, in seconds")
+    args = parser.parse_args()
+
+    print(f"Worker daemon listening on {args.host}:{args.port}", file=sys.stderr)
+    serve((args.host, args.port), environment_authkey(), args.workers, args.model_cache_mb, args.task_timeout)